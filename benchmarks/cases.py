@@ -0,0 +1,367 @@
+# Benchmark cases. Models are constructed with random weights, so nothing is downloaded.
+# Some model families define their encoders through torch.hub (midas_v21, midas_v21_small, depth_anything),
+# these cases only work if the corresponding hub repositories are already cached; otherwise they are reported
+# as failed with the reason.
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.harness import register, load_image, synthetic_image, synthetic_depth, synthetic_depth_i16
+
+IMAGE_SIZE = (1024, 768)
+NET_SIZES = [256, 384, 512]
+MODEL_NAMES = {
+    0: 'res101', 1: 'dpt_beit_large_512', 2: 'dpt_beit_large_384', 3: 'dpt_large_384', 4: 'dpt_hybrid_384',
+    5: 'midas_v21', 6: 'midas_v21_small', 7: 'zoedepth_n', 8: 'zoedepth_k', 9: 'zoedepth_nk', 10: 'marigold',
+    11: 'depth_anything',
+}
+BOOST_MODEL_TYPES = [0, 1, 2, 3, 4, 5, 6, 11]
+STEREO_FILL_ALGOS = ['none', 'naive', 'naive_interpolating', 'polylines_soft', 'polylines_sharp']
+
+
+def build_random_model(model_type):
+    """Same architectures as ModelHolder.load_models, without the weights. Returns (model, resize_mode, normalization)"""
+    from dmidas.transforms import NormalizeImage
+    resize_mode = "minimal"
+    normalization = NormalizeImage(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    if model_type == 0:
+        from lib.multi_depth_model_woauxi import RelDepthModel
+        model = RelDepthModel(backbone='resnext101')
+    elif model_type in [1, 2, 3, 4]:
+        from dmidas.dpt_depth import DPTDepthModel
+        backbone = {1: "beitl16_512", 2: "beitl16_384", 3: "vitl16_384", 4: "vitb_rn50_384"}[model_type]
+        model = DPTDepthModel(path=None, backbone=backbone, non_negative=True)
+    elif model_type in [5, 6]:
+        if model_type == 5:
+            from dmidas.midas_net import MidasNet
+            model = MidasNet(None, non_negative=True)
+        else:
+            from dmidas.midas_net_custom import MidasNet_small
+            model = MidasNet_small(None, features=64, backbone="efficientnet_lite3", exportable=True,
+                                   non_negative=True, blocks={'expand': True})
+        resize_mode = "upper_bound"
+        normalization = NormalizeImage(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    elif model_type in [7, 8, 9]:
+        from dzoedepth.models.builder import build_model
+        from dzoedepth.utils.config import get_config
+        if model_type == 7:
+            conf = get_config("zoedepth", "infer")
+        elif model_type == 8:
+            conf = get_config("zoedepth", "infer", config_version="kitti")
+        else:
+            conf = get_config("zoedepth_nk", "infer")
+        conf.pretrained_resource = None
+        model = build_model(conf)
+    elif model_type == 10:
+        # The diffusers configs are needed to construct the pipeline, use the cached model if there is one
+        from marigold.marigold import MarigoldPipeline
+        model = MarigoldPipeline.from_pretrained("Bingxin/Marigold", local_files_only=True)
+    elif model_type == 11:
+        from depth_anything.dpt import DPT_DINOv2
+        model = DPT_DINOv2(encoder="vitl", features=256, out_channels=[256, 512, 1024, 1024], localhub=False)
+    else:
+        raise ValueError(f'Unknown model type {model_type}')
+    if model_type != 10:
+        model.eval()
+    return model, resize_mode, normalization
+
+
+def build_random_pix2pix():
+    from pix2pix.models.pix2pix4depth_model import Pix2Pix4DepthModel
+    from pix2pix.options.test_options import TestOptions
+    opt = TestOptions().parse()
+    opt.gpu_ids = []
+    model = Pix2Pix4DepthModel(opt)
+    model.eval()
+    return model
+
+
+def make_holder(model_type, boost=False):
+    import torch
+    from src import backbone
+    from src.depthmap_generation import ModelHolder
+    holder = ModelHolder()
+    holder.update_settings(**backbone.gather_ops())
+    # Keep Marigold and BOOST within a reasonable time on CPU
+    holder.update_settings(marigold_ensembles=1, marigold_steps=4, boost_rmax=1024)
+    holder.depth_model, holder.resize_mode, holder.normalization = build_random_model(model_type)
+    holder.depth_model_type = model_type
+    holder.device = torch.device('cpu')
+    if boost:
+        holder.pix2pix_model = build_random_pix2pix()
+    return holder
+
+
+def _register_model_cases():
+    for model_type, name in MODEL_NAMES.items():
+        for net_size in NET_SIZES:
+            def setup(model_type=model_type, net_size=net_size):
+                import torch
+                holder = make_holder(model_type)
+                image = load_image(*IMAGE_SIZE)
+
+                def fn():
+                    with torch.no_grad():
+                        holder.get_raw_prediction(image, net_size, net_size)
+                return fn
+            register(f'model/{name}/{net_size}', slow=net_size != 384 or model_type == 10)(setup)
+        if model_type in BOOST_MODEL_TYPES:
+            def setup(model_type=model_type):
+                import torch
+                holder = make_holder(model_type, boost=True)
+                image = load_image(*IMAGE_SIZE)
+
+                def fn():
+                    with torch.no_grad():
+                        holder.get_raw_prediction(image, 0, 0)
+                return fn
+            register(f'model/{name}/boost', slow=True)(setup)
+
+
+_register_model_cases()
+
+
+def _register_quantized_cases():
+    from src.quantization import QUANTIZABLE_MODEL_TYPES
+    for model_type in QUANTIZABLE_MODEL_TYPES:
+        def setup(model_type=model_type):
+            import torch
+            from src.quantization import quantize_model
+            holder = make_holder(model_type)
+            image = load_image(*IMAGE_SIZE)
+            net_size = 384
+            with torch.no_grad():
+                expected, _ = holder.get_raw_prediction(image, net_size, net_size)
+            calibration = [Image.fromarray(synthetic_image(*IMAGE_SIZE, seed=seed)) for seed in range(1, 5)]
+
+            def calibration_forward(n):
+                for x in calibration[:n]:
+                    holder.get_raw_prediction(x, net_size, net_size)
+            holder.depth_model = quantize_model(holder.depth_model, model_type, tempfile.mkdtemp(),
+                                                calibration_forward)
+            with torch.no_grad():
+                actual, _ = holder.get_raw_prediction(image, net_size, net_size)
+
+            def fn():
+                with torch.no_grad():
+                    holder.get_raw_prediction(image, net_size, net_size)
+            # Accuracy against fp32, relative to the range of the fp32 prediction
+            value_range = max(float(expected.max() - expected.min()), 1e-6)
+            fn.metrics = {'max_error': float(np.abs(actual - expected).max()) / value_range,
+                          'mean_error': float(np.abs(actual - expected).mean()) / value_range}
+            return fn
+        register(f'model/{MODEL_NAMES[model_type]}/384/int8')(setup)
+
+
+_register_quantized_cases()
+
+
+def _register_merge_cases():
+    for precision in ['fp32', 'bf16']:
+        def setup(precision=precision):
+            import torch
+            from src.depthmap_generation import boost_autocast, resize_tensor
+            model = build_random_pix2pix()
+            outer = resize_tensor(torch.from_numpy(synthetic_depth(448, 448, seed=1)), 1024, 1024)
+            inner = resize_tensor(torch.from_numpy(synthetic_depth(896, 896, seed=1)), 1024, 1024)
+
+            def merge(precision):
+                model.set_input(outer, inner)
+                with boost_autocast(precision, model.device):
+                    model.test()
+                return model.get_current_visuals()['fake_B'].float().numpy()
+
+            def fn():
+                merge(precision)
+            # Accuracy against fp32, relative to the range of the fp32 output
+            expected = merge('fp32')
+            if precision != 'fp32':
+                model.netG.to(memory_format=torch.channels_last)  # Like boost_memory_format does
+            actual = merge(precision)
+            value_range = max(float(expected.max() - expected.min()), 1e-6)
+            fn.metrics = {'max_error': float(np.abs(actual - expected).max()) / value_range,
+                          'mean_error': float(np.abs(actual - expected).mean()) / value_range}
+            return fn
+        register(f'boost/merge/1024/{precision}')(setup)
+
+
+_register_merge_cases()
+
+
+def _register_upsampling_cases():
+    width, height = 2048, 1536
+    for mode in ['bicubic', 'guided']:
+        def setup(mode=mode):
+            import cv2
+            from src.guided_upsampling import guided_upsample
+            truth = synthetic_depth(width, height)
+            # The objects of the depthmap are visible in the image, like in a photo
+            image = np.clip(np.stack([truth * 200 + 20, truth * 150 + 40, 255 - truth * 200], axis=2) * 0.7 +
+                            synthetic_image(width, height) * 0.3, 0, 255).astype(np.uint8)
+            prediction = cv2.resize(truth, (384, 288), interpolation=cv2.INTER_AREA)  # At the net size
+
+            def fn():
+                if mode == 'guided':
+                    return guided_upsample(prediction, image)
+                return cv2.resize(prediction, (width, height), interpolation=cv2.INTER_CUBIC)
+            error = np.abs(fn() - truth)
+            edges = cv2.dilate(cv2.Canny((truth * 255).astype(np.uint8), 10, 30), np.ones((5, 5), np.uint8)) > 0
+            fn.metrics = {'mean_error': float(error.mean()), 'edge_error': float(error[edges].mean())}
+            return fn
+        register(f'upsampling/2048/{mode}')(setup)
+
+
+_register_upsampling_cases()
+
+VAE_TILING_TOLERANCE = 0.01  # Mean difference of tiled and untiled results, relative to the range of the untiled
+
+
+@register('marigold/vae/1536/tiled', slow=True)
+def marigold_vae_tiled():
+    """Tiled against untiled encoding and decoding with the real VAE of Marigold (GroupNorm statistics differ
+    between the tiles and the whole image). Fails if they disagree by more than VAE_TILING_TOLERANCE."""
+    import torch
+    model, _, _ = build_random_model(10)
+    width, height = 1536, 1024
+    rgb = torch.from_numpy(synthetic_image(width, height)).permute(2, 0, 1).unsqueeze(0).float() / 255.0
+
+    def encode_decode(threshold):
+        model.vae_tiling_threshold = threshold  # Stays set after the call
+        with torch.no_grad():
+            latent = model.encode_rgb(rgb)
+            return latent, model.decode_depth(latent)
+    latent, depth = encode_decode(max(width, height))  # Tiles are only used above the threshold
+    model.vae_tiling_threshold = model.vae_tile_size
+    with torch.no_grad():
+        tiled_latent = model.encode_rgb(rgb)
+        # Decoded from the untiled latent, so that the errors of the tiled encoder do not add up
+        tiled_depth = model.decode_depth(latent)
+
+    metrics = {}
+    for name, expected, actual in [('encode', latent, tiled_latent), ('decode', depth, tiled_depth)]:
+        error = (actual - expected).abs() / max(float(expected.max() - expected.min()), 1e-6)
+        metrics[f'{name}_max_error'] = float(error.max())
+        metrics[f'{name}_mean_error'] = float(error.mean())
+        assert metrics[f'{name}_mean_error'] <= VAE_TILING_TOLERANCE, \
+            f'Tiled {name} differs from untiled by {metrics[f"{name}_mean_error"]:.2e} on average'
+
+    def fn():
+        encode_decode(model.vae_tile_size)
+    fn.metrics = metrics
+    return fn
+
+
+def _register_stereo_cases():
+    for algo in STEREO_FILL_ALGOS:
+        def setup(algo=algo):
+            from src.stereoimage_generation import create_stereoimages
+            image = load_image(*IMAGE_SIZE)
+            depth = synthetic_depth_i16(*IMAGE_SIZE)
+            return lambda: create_stereoimages(image, depth, 2.5, 0.0, ['left-right'], 0.0, 1.0, algo)
+        register(f'stereo/{algo}')(setup)
+
+
+_register_stereo_cases()
+
+
+@register('normalmap/sobel')
+def normalmap_sobel():
+    from src.normalmap_generation import create_normalmap
+    depth = synthetic_depth_i16(*IMAGE_SIZE)
+    return lambda: create_normalmap(depth, None, 3, None, False)
+
+
+@register('normalmap/blur_gradient')
+def normalmap_blur_gradient():
+    from src.normalmap_generation import create_normalmap
+    depth = synthetic_depth_i16(*IMAGE_SIZE)
+    return lambda: create_normalmap(depth, 5, None, 5, False)
+
+
+def _mesh_setup(keep_edges, spherical):
+    from src.core import create_mesh
+    image = load_image(*IMAGE_SIZE)
+    depth = 1.0 + 4.0 * (1.0 - synthetic_depth(*IMAGE_SIZE))
+    # create_mesh shrinks the image in place, every call gets its own copy
+    return lambda: create_mesh(image.copy(), depth, keep_edges=keep_edges, spherical=spherical)
+
+
+register('mesh/simple_occluded')(lambda: _mesh_setup(keep_edges=False, spherical=False))
+register('mesh/simple_keep_edges')(lambda: _mesh_setup(keep_edges=True, spherical=False))
+register('mesh/simple_spherical')(lambda: _mesh_setup(keep_edges=False, spherical=True))
+
+
+@register('inpaint/sparse_bilateral_filtering', slow=True)
+def bilateral():
+    from inpaint.bilateral_filtering import sparse_bilateral_filtering
+    image = np.asarray(load_image(*IMAGE_SIZE))
+    disp = synthetic_depth(*IMAGE_SIZE) * 3.0
+    depth = 1. / np.maximum(disp, 0.05)
+    # Same settings as run_3dphoto
+    config = {'sparse_iter': 5, 'filter_size': [7, 7, 5, 5, 5], 'sigma_s': 4.0, 'sigma_r': 0.5,
+              'depth_threshold': 0.04}
+    return lambda: sparse_bilateral_filtering(depth.copy(), image.copy(), config, num_iter=config['sparse_iter'],
+                                              spdb=False)
+
+
+def _grid_mesh(width=512, height=384):
+    """Vertices, colors (uint8) and faces of a mesh like the ones the 3D photo inpainting produces"""
+    image = np.asarray(load_image(width, height))
+    depth = 1.0 + 4.0 * (1.0 - synthetic_depth(width, height))
+    y, x = np.mgrid[0:height, 0:width]
+    verts = np.stack([(x - width / 2) / width * depth, (y - height / 2) / height * depth, -depth], axis=2)
+    idx = np.arange(width * height).reshape(height, width)
+    a, b, c, d = idx[:-1, :-1].ravel(), idx[:-1, 1:].ravel(), idx[1:, :-1].ravel(), idx[1:, 1:].ravel()
+    faces = np.concatenate([np.stack([a, c, b], 1), np.stack([b, c, d], 1)])
+    return verts.reshape(-1, 3).astype(np.float32), image.reshape(-1, 3), faces, height, width
+
+
+def _write_inpainted_mesh(path, fmt):
+    """Writes a mesh in the format of inpaint.mesh.write_mesh, so that it can be read by read_mesh"""
+    import struct
+    import sys
+    verts, colors, faces, height, width = _grid_mesh()
+    header = [f'H {height}', f'W {width}', 'hFov 0.8', 'vFov 0.6', 'meanLoc 2.0']
+    if fmt == 'obj':
+        with open(path, 'w') as f:
+            f.write('# depthmap-script\n')
+            f.writelines([f'# {x}\n' for x in header + [f'vertices {len(verts)}', f'faces {len(faces)}']])
+            f.write('o depthmap\n')
+            for v, c in zip(verts, colors / 255.0):
+                f.write(f"v {v[0]:.8f} {v[1]:.8f} {v[2]:.8f} {c[0]:.4f} {c[1]:.4f} {c[2]:.4f}\n")
+            f.writelines([f"f {a + 1} {b + 1} {c + 1}\n" for a, b, c in faces])
+        return
+    with open(path, 'wb') as f:
+        f.write(f'ply\nformat binary_{sys.byteorder}_endian 1.0\n'.encode('ascii'))
+        f.write(''.join([f'comment {x}\n' for x in header]).encode('ascii'))
+        f.write(f'element vertex {len(verts)}\n'.encode('ascii'))
+        f.write(''.join([f'property {t} {n}\n' for t, n in [('float', 'x'), ('float', 'y'), ('float', 'z'),
+                                                            ('uchar', 'red'), ('uchar', 'green'),
+                                                            ('uchar', 'blue'), ('uchar', 'alpha')]]).encode('ascii'))
+        f.write(f'element face {len(faces)}\nproperty list uchar int vertex_index\nend_header\n'.encode('ascii'))
+        for v, c in zip(verts, colors):
+            f.write(struct.pack('fffBBBB', v[0], v[1], v[2], c[0], c[1], c[2], 255))
+        for a, b, c in faces:
+            f.write(bytearray([3]) + struct.pack('III', a, b, c))
+
+
+def _register_mesh_io_cases():
+    for fmt in ['obj', 'ply']:
+        def read_setup(fmt=fmt):
+            from inpaint.mesh import read_mesh
+            path = os.path.join(tempfile.mkdtemp(), f'mesh.{fmt}')
+            _write_inpainted_mesh(path, fmt)
+            return lambda: read_mesh(path)
+        register(f'mesh_io/read_inpainted_{fmt}')(read_setup)
+
+        def write_setup(fmt=fmt):
+            from src.core import create_mesh
+            mesh = create_mesh(load_image(*IMAGE_SIZE), 1.0 + 4.0 * (1.0 - synthetic_depth(*IMAGE_SIZE)))
+            path = os.path.join(tempfile.mkdtemp(), f'mesh.{fmt}')
+            return lambda: mesh.export(path)
+        register(f'mesh_io/write_simple_{fmt}')(write_setup)
+
+
+_register_mesh_io_cases()
@@ -0,0 +1,167 @@
+# Measurement primitives of the benchmark suite: case registry, timing, memory, synthetic inputs.
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {}
+
+
+class Case:
+    """A benchmark case. setup() is not measured and returns the function to be timed.
+    items is the number of images (or other units) processed by one call, used for throughput.
+    If the returned function has a `metrics` attribute (a dict, e.g. accuracy), it is added to the result."""
+    def __init__(self, name, setup, items=1, slow=False):
+        self.name = name
+        self.setup = setup
+        self.items = items
+        self.slow = slow
+
+
+def register(name, items=1, slow=False):
+    def decorator(setup):
+        assert name not in CASES, f'Duplicate benchmark case {name}'
+        CASES[name] = Case(name, setup, items, slow)
+        return setup
+    return decorator
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None if it can not be determined"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size counter if the OS allows it (Linux)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None if it can not be determined"""
+    try:
+        # Unlike ru_maxrss, this is not inherited from the parent process and can be reset
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def seed_everything(seed=0):
+    np.random.seed(seed)
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.manual_seed(seed)
+
+
+def run_case(case, warmup=1, repeat=5):
+    """Runs the case in this process. Memory is only meaningful if the process runs nothing else,
+    which is why the suite starts a fresh process for every case."""
+    seed_everything()
+    reset_peak_rss()
+    rss_before = current_rss()
+    fn = case.setup()
+    for _ in range(warmup):
+        fn()  # Caches, lazy initialization, JIT compilation
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    median = float(np.median(times))
+    result = {
+        'median_s': median,
+        'min_s': float(times.min()),
+        'mean_s': float(times.mean()),
+        'stdev_s': float(times.std()),
+        'repeat': repeat,
+        'items': case.items,
+        'throughput_per_s': case.items / median if median > 0 else None,
+        'peak_rss_bytes': peak_rss(),
+    }
+    if rss_before is not None and result['peak_rss_bytes'] is not None:
+        result['peak_rss_increase_bytes'] = result['peak_rss_bytes'] - rss_before
+    if hasattr(fn, 'metrics'):
+        result['metrics'] = fn.metrics
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, stderr=subprocess.DEVNULL,
+                                         encoding='utf8').strip()
+    except Exception:
+        commit = None
+    env = {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+           'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'commit': commit}
+    try:
+        import torch
+        env['torch'] = torch.__version__
+        env['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return env
+
+
+# Synthetic inputs. They are deterministic, so that the results are comparable between runs.
+
+def synthetic_image(width=1024, height=768, seed=0):
+    """RGB uint8 image with gradients, flat regions, hard edges and some noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([x / width, y / height, 0.5 + 0.5 * np.sin(x / 37.0) * np.cos(y / 23.0)], axis=2) * 200
+    for _ in range(12):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        r = rng.integers(min(width, height) // 20, min(width, height) // 5)
+        img[(x - cx) ** 2 + (y - cy) ** 2 < r * r] = rng.integers(0, 255, 3)
+    img += rng.normal(0, 4, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def synthetic_depth(width=1024, height=768, seed=0):
+    """float32 depthmap in [0; 1] (near = bright): a slanted plane with a few objects in front of it"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    depth = 0.2 + 0.3 * y / height
+    for _ in range(6):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        r = rng.integers(min(width, height) // 12, min(width, height) // 4)
+        inside = (x - cx) ** 2 + (y - cy) ** 2 < r * r
+        depth[inside] = np.maximum(depth[inside], rng.uniform(0.5, 1.0) - 0.0002 * np.abs(x - cx)[inside])
+    return depth.astype(np.float32)
+
+
+def synthetic_depth_i16(width=1024, height=768, seed=0):
+    """synthetic_depth as uint16, the format the post-processing functions get from the pipeline"""
+    return (synthetic_depth(width, height, seed) * (2 ** 16 - 1)).astype(np.uint16)
+
+
+def load_image(width=1024, height=768):
+    """Pillow RGB image: the fixture image from the DEPTHMAP_BENCH_IMAGE environment variable (resized),
+    or the synthetic image if it is not set."""
+    from PIL import Image
+    path = os.environ.get('DEPTHMAP_BENCH_IMAGE')
+    if path is None:
+        return Image.fromarray(synthetic_image(width, height))
+    return Image.open(path).convert('RGB').resize((width, height), Image.Resampling.LANCZOS)
@@ -0,0 +1,72 @@
+# Measures the cold start time of the entry points, using the interpreter's own import profiler.
+# Usage: python benchmarks/import_time.py [--top 15] [--json report.json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = {
+    'core (API)': 'src.core',
+    'batch (CLI)': 'src.batch_mode',
+    'standalone UI': 'src.common_ui',
+}
+
+
+def parse_importtime(stderr):
+    """Parses the output of python -X importtime, returns {module: cumulative microseconds}"""
+    result = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            result[parts[2].strip()] = int(parts[1])
+        except ValueError:
+            pass
+    return result
+
+
+def measure(module):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=REPO_ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        return {'module': module, 'error': proc.stderr.strip().splitlines()[-1]}
+    times = parse_importtime(proc.stderr)
+    return {'module': module, 'wall_s': round(wall, 3),
+            'import_s': round(times.get(module, 0) / 1e6, 3), 'modules': times}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=15, help='How many of the slowest top-level packages to show')
+    parser.add_argument('--json', default=None, help='Save the report to this file')
+    args = parser.parse_args()
+
+    report = {}
+    for name, module in ENTRY_POINTS.items():
+        r = measure(module)
+        if 'error' in r:
+            print(f'{name}: failed to import {module}: {r["error"]}')
+            report[name] = r
+            continue
+        # Only the top-level packages, nested modules are already included in their cumulative time
+        top_level = {k: v for k, v in r.pop('modules').items() if '.' not in k}
+        r['slowest'] = sorted(top_level.items(), key=lambda x: -x[1])[:args.top]
+        report[name] = r
+        print(f'{name}: {r["import_s"]:.3f}s to import {module} ({r["wall_s"]:.3f}s wall)')
+        for k, v in r['slowest']:
+            print(f'    {v / 1e6:8.3f}s  {k}')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# Benchmark suite. Runs on CPU, with synthetic inputs (or a fixture image) and randomly initialized models.
+# Usage:
+#   python benchmarks/run.py list
+#   python benchmarks/run.py run [--quick] [--filter REGEX] [--image fixture.png] [--out results.json]
+#   python benchmarks/run.py compare baseline.json results.json [--threshold 0.15]
+# Every case runs in a fresh process, so that peak memory is measured for that case alone.
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import harness  # noqa: E402
+
+
+def select_cases(pattern=None, quick=False):
+    from benchmarks import cases  # noqa: F401 - registers the cases
+    selected = []
+    for name, case in harness.CASES.items():
+        if pattern is not None and re.search(pattern, name) is None:
+            continue
+        if quick and case.slow:
+            continue
+        selected.append(case)
+    return selected
+
+
+def run_isolated(name, args):
+    """Runs one case in a child process, returns its result (or the error)"""
+    cmd = [sys.executable, os.path.abspath(__file__), '_case', name,
+           '--warmup', str(args.warmup), '--repeat', str(args.repeat)]
+    if args.threads is not None:
+        cmd += ['--threads', str(args.threads)]
+    env = dict(os.environ)
+    if args.image is not None:
+        env['DEPTHMAP_BENCH_IMAGE'] = os.path.abspath(args.image)
+    proc = subprocess.run(cmd, cwd=harness.REPO_ROOT, env=env, capture_output=True, text=True,
+                          timeout=args.timeout)
+    # The result is the last line of stdout, the code under test may print anything before it
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or len(lines) == 0:
+        error = proc.stderr.strip().splitlines()
+        return {'error': error[-1] if len(error) > 0 else f'exit code {proc.returncode}'}
+    return json.loads(lines[-1])
+
+
+def command_case(args):
+    """Child process side of run_isolated"""
+    if args.threads is not None:
+        import torch
+        torch.set_num_threads(args.threads)
+    case = select_cases(f'^{re.escape(args.name)}$')[0]
+    sys.argv = sys.argv[:1]  # Some of the code under test parses the command line (pix2pix options)
+    result = harness.run_case(case, warmup=args.warmup, repeat=args.repeat)
+    print(json.dumps(result))
+
+
+def command_run(args):
+    selected = select_cases(args.filter, args.quick)
+    report = {'environment': harness.environment(), 'image': args.image,
+              'settings': {'warmup': args.warmup, 'repeat': args.repeat, 'threads': args.threads},
+              'results': {}}
+    print(f'Running {len(selected)} benchmark cases')
+    for case in selected:
+        start = time.perf_counter()
+        try:
+            result = run_isolated(case.name, args)
+        except subprocess.TimeoutExpired:
+            result = {'error': f'timed out after {args.timeout}s'}
+        report['results'][case.name] = result
+        if 'error' in result:
+            print(f'{case.name:48} FAILED: {result["error"]}')
+        else:
+            metrics = ''.join([f'  {k}={v:.4g}' for k, v in result.get('metrics', {}).items()])
+            print(f'{case.name:48} {result["median_s"] * 1000:10.1f} ms  '
+                  f'{_format_bytes(result.get("peak_rss_bytes"))} peak  ({time.perf_counter() - start:.0f}s){metrics}')
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved to {args.out}')
+
+
+def compare(baseline, current, threshold=0.15, memory_threshold=0.1):
+    """Returns a list of (case, metric, baseline value, current value, relative change, verdict).
+    Time is compared by the fastest run, which is the least sensitive to the noise of other processes."""
+    rows = []
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'error' in base or 'error' in cur:
+            continue
+        for metric, limit in [('min_s', threshold), ('peak_rss_increase_bytes', memory_threshold)]:
+            if base.get(metric) is None or cur.get(metric) is None or base[metric] <= 0:
+                continue
+            change = cur[metric] / base[metric] - 1
+            verdict = 'REGRESSION' if change > limit else 'improved' if change < -limit else 'ok'
+            rows.append((name, metric, base[metric], cur[metric], change, verdict))
+    return rows
+
+
+def command_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get('environment', {}).get('machine') != current.get('environment', {}).get('machine'):
+        print('WARNING: the results were measured on different machines')
+    rows = compare(baseline, current, args.threshold, args.memory_threshold)
+    for name, metric, base, cur, change, verdict in rows:
+        if args.all or verdict != 'ok':
+            print(f'{name:48} {metric:24} {base:14.4g} -> {cur:14.4g} {change * 100:+7.1f}%  {verdict}')
+    missing = [x for x in baseline['results'] if x not in current['results']]
+    if len(missing) > 0:
+        print(f'Not in the current results: {", ".join(missing)}')
+    failed = [x for x, r in current['results'].items()
+              if 'error' in r and x in baseline['results'] and 'error' not in baseline['results'][x]]
+    if len(failed) > 0:
+        print(f'Failed now, worked in the baseline: {", ".join(failed)}')
+    regressions = [r for r in rows if r[5] == 'REGRESSION']
+    print(f'{len(regressions)} regression(s) in {len(rows)} comparisons')
+    sys.exit(1 if len(regressions) > 0 or len(failed) > 0 else 0)
+
+
+def _format_bytes(value):
+    return f'{value / 2 ** 20:8.0f} MiB' if value is not None else '       ? MiB'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help='List the benchmark cases')
+    list_parser.add_argument('--filter', default=None, help='Only the cases with names matching this regex')
+    list_parser.add_argument('--quick', action='store_true', help='Skip the slow cases')
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--filter', default=None, help='Only the cases with names matching this regex')
+    run_parser.add_argument('--quick', action='store_true', help='Skip the slow cases')
+    run_parser.add_argument('--image', default=None, help='Fixture image to use instead of the synthetic one')
+    run_parser.add_argument('--out', default=None, help='Save the results to this JSON file')
+    run_parser.add_argument('--warmup', type=int, default=1)
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--threads', type=int, default=None, help='torch threads, for reproducible results')
+    run_parser.add_argument('--timeout', type=int, default=3600, help='Per case, in seconds')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare results against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.15,
+                                help='Relative slowdown that is considered a regression')
+    compare_parser.add_argument('--memory_threshold', type=float, default=0.1,
+                                help='Relative peak memory increase that is considered a regression')
+    compare_parser.add_argument('--all', action='store_true', help='Also show the unchanged cases')
+
+    case_parser = subparsers.add_parser('_case')
+    case_parser.add_argument('name')
+    case_parser.add_argument('--warmup', type=int, default=1)
+    case_parser.add_argument('--repeat', type=int, default=5)
+    case_parser.add_argument('--threads', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'list':
+        for case in select_cases(args.filter, args.quick):
+            print(f'{case.name}{" (slow)" if case.slow else ""}')
+    elif args.command == 'run':
+        command_run(args)
+    elif args.command == 'compare':
+        command_compare(args)
+    elif args.command == '_case':
+        command_case(args)
+
+
+if __name__ == '__main__':
+    main()
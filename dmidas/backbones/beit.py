@@ -1,3 +1,4 @@
+import functools
 import timm
 import torch
 import types
@@ -5,8 +6,7 @@ import types
 import numpy as np
 import torch.nn.functional as F
 
-from .utils import forward_adapted_unflatten, make_backbone_default
-from timm.models.beit import gen_relative_position_index
+from .utils import chunked_attention, DerivedTensorCache, forward_adapted_unflatten, make_backbone_default
 from torch.utils.checkpoint import checkpoint
 from typing import Optional
 
@@ -26,10 +26,16 @@ def patch_embed_forward(self, x):
     return x
 
 
-def _get_rel_pos_bias(self, window_size):
+def _get_rel_pos_bias_table(self, window_size):
     """
-    Modification of timm.models.beit.py: Attention._get_rel_pos_bias to support arbitrary window sizes.
+    Relative position bias table, interpolated to the window size. Shape: (num_relative_distance, heads)
+    The result is cached, all the images of a batch or a video usually have the same size.
     """
+    return self.rel_pos_bias_tables.get(self.relative_position_bias_table, tuple(window_size),
+                                        lambda: _interpolate_rel_pos_bias_table(self, window_size))
+
+
+def _interpolate_rel_pos_bias_table(self, window_size):
     old_height = 2 * self.window_size[0] - 1
     old_width = 2 * self.window_size[1] - 1
 
@@ -47,50 +53,84 @@ def _get_rel_pos_bias(self, window_size):
     new_sub_table = F.interpolate(old_sub_table, size=(int(new_height),int(new_width)), mode="bilinear")
     new_sub_table = new_sub_table.permute(0, 2, 3, 1).reshape(new_num_relative_distance - 3, -1)
 
-    new_relative_position_bias_table = torch.cat(
-        [new_sub_table, old_relative_position_bias_table[old_num_relative_distance - 3:]])
+    return torch.cat([new_sub_table, old_relative_position_bias_table[old_num_relative_distance - 3:]])
 
-    key = str(window_size[1]) + "," + str(window_size[0])
-    if key not in self.relative_position_indices.keys():
-        self.relative_position_indices[key] = gen_relative_position_index(window_size)
 
-    relative_position_bias = new_relative_position_bias_table[
-        self.relative_position_indices[key].view(-1)].view(
-        window_size[0] * window_size[1] + 1,
-        window_size[0] * window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-    relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-    return relative_position_bias.unsqueeze(0)
+def _rel_pos_index_rows(window_size, start, end, device=None):
+    """
+    Rows [start; end) of timm's gen_relative_position_index(window_size), computed without creating the whole
+    (Wh*Ww+1) x (Wh*Ww+1) matrix. Row and column 0 are the cls token.
+    """
+    wh, ww = window_size
+    num_relative_distance = (2 * wh - 1) * (2 * ww - 1) + 3
+    rows = torch.arange(start, end, device=device)[:, None] - 1
+    tokens = torch.arange(wh * ww, device=device)[None, :]
+    index = torch.empty((end - start, wh * ww + 1), dtype=torch.long, device=device)
+    index[:, 1:] = (rows // ww - tokens // ww + wh - 1) * (2 * ww - 1) + (rows % ww - tokens % ww + ww - 1)
+    index[:, 0] = num_relative_distance - 2
+    if start == 0:
+        index[0, 1:] = num_relative_distance - 3
+        index[0, 0] = num_relative_distance - 1
+    return index
+
+
+@functools.lru_cache(maxsize=4)
+def _full_rel_pos_index(window_size, device):
+    """
+    Whole gen_relative_position_index(window_size) on the device. Shared by all the layers, it only depends on the
+    window size.
+    """
+    return _rel_pos_index_rows(window_size, 0, window_size[0] * window_size[1] + 1, device)
 
 
 def attention_forward(self, x, resolution, shared_rel_pos_bias: Optional[torch.Tensor] = None):
     """
     Modification of timm.models.beit.py: Attention.forward to support arbitrary window sizes.
+    The attention matrix and the relative position bias are computed in chunks of query rows, so that the memory
+    needed for them grows linearly with the number of tokens (see chunked_attention).
     """
     B, N, C = x.shape
 
     qkv_bias = torch.cat((self.q_bias, self.k_bias, self.v_bias)) if self.q_bias is not None else None
-    qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
+    if isinstance(self.qkv.weight, torch.Tensor):
+        qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
+    else:  # Dynamically quantized Linear (weight is a method there), it has no bias of its own
+        qkv = self.qkv(x) if qkv_bias is None else self.qkv(x) + qkv_bias
     qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
     q, k, v = qkv.unbind(0)  # make torchscript happy (cannot use tensor as tuple)
 
-    q = q * self.scale
-    attn = (q @ k.transpose(-2, -1))
-
-    if self.relative_position_bias_table is not None:
-        window_size = tuple(np.array(resolution) // 16)
-        attn = attn + self._get_rel_pos_bias(window_size)
-    if shared_rel_pos_bias is not None:
-        attn = attn + shared_rel_pos_bias
-
-    attn = attn.softmax(dim=-1)
-    attn = self.attn_drop(attn)
-
-    x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+    window_size = tuple(int(s) // 16 for s in resolution)
+    table = self._get_rel_pos_bias_table(window_size) if self.relative_position_bias_table is not None else None
+
+    def bias_rows(start, end):
+        bias = None
+        if table is not None:
+            if start == 0 and end == N:  # Single chunk, the whole index is small enough to be kept
+                index = _full_rel_pos_index(window_size, table.device)
+            else:
+                index = _rel_pos_index_rows(window_size, start, end, table.device)
+            bias = table[index].permute(2, 0, 1).unsqueeze(0)  # 1, nH, rows, N
+        if shared_rel_pos_bias is not None:
+            shared = shared_rel_pos_bias[..., start:end, :]
+            bias = shared if bias is None else bias + shared
+        return bias.to(q.dtype) if bias is not None else None
+
+    # The default scale of scaled_dot_product_attention is head_dim ** -0.5, same as self.scale
+    x = chunked_attention(q, k, v, bias_rows, self.attn_drop.p if self.training else 0.0)
+    x = x.transpose(1, 2).reshape(B, N, -1)
     x = self.proj(x)
     x = self.proj_drop(x)
     return x
 
 
+def attention_warmup_cache(self, resolution):
+    """
+    Precomputes the relative position bias table for the input resolution (height, width), see warmup_caches
+    """
+    if self.relative_position_bias_table is not None:
+        self._get_rel_pos_bias_table(tuple(int(s) // 16 for s in resolution))
+
+
 def block_forward(self, x, resolution, shared_rel_pos_bias: Optional[torch.Tensor] = None):
     """
     Modification of timm.models.beit.py: Block.forward to support arbitrary window sizes.
@@ -147,9 +187,10 @@ def _make_beit_backbone(
 
     for block in backbone.model.blocks:
         attn = block.attn
-        attn._get_rel_pos_bias = types.MethodType(_get_rel_pos_bias, attn)
+        attn._get_rel_pos_bias_table = types.MethodType(_get_rel_pos_bias_table, attn)
+        attn.warmup_cache = types.MethodType(attention_warmup_cache, attn)
         attn.forward = types.MethodType(attention_forward, attn)
-        attn.relative_position_indices = {}
+        attn.rel_pos_bias_tables = DerivedTensorCache()
 
         block.forward = types.MethodType(block_forward, block)
 
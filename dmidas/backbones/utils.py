@@ -1,6 +1,74 @@
+from collections import OrderedDict
+
 import torch
 
 import torch.nn as nn
+import torch.nn.functional as F
+
+# Upper bound of the attention scores (and the bias) computed at once by chunked_attention
+ATTENTION_CHUNK_BYTES = 256 * 2 ** 20
+
+
+def chunked_attention(q, k, v, bias_rows=None, dropout_p=0.0):
+    """
+    Scaled dot-product attention that does not materialize the whole (B, heads, N, N) attention matrix.
+    Queries are processed in chunks, so that the memory needed for the scores is bounded by ATTENTION_CHUNK_BYTES.
+    bias_rows(start, end) returns the additive attention bias for the query rows [start; end), broadcastable to
+    (B, heads, end - start, N), or None. The bias is requested per chunk, so it does not have to exist in full either.
+    """
+    B, H, N, _ = q.shape
+    chunk = max(1, ATTENTION_CHUNK_BYTES // (B * H * k.shape[2] * q.element_size()))
+    if chunk >= N:
+        bias = bias_rows(0, N) if bias_rows is not None else None
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout_p)
+    out = q.new_empty(B, H, N, v.shape[-1])
+    for start in range(0, N, chunk):
+        end = min(N, start + chunk)
+        bias = bias_rows(start, end) if bias_rows is not None else None
+        out[:, :, start:end] = F.scaled_dot_product_attention(q[:, :, start:end], k, v, attn_mask=bias,
+                                                               dropout_p=dropout_p)
+    return out
+
+
+class DerivedTensorCache:
+    """
+    Caches tensors derived from a parameter (e.g. resized position embeddings), keyed by size. The cache is cleared
+    when the parameter is modified in place (load_state_dict) or moved/cast (.to(), .half()).
+    Only the maxsize most recently used sizes are kept, so that inputs of many different sizes (e.g. net size matched
+    to the input) do not accumulate tensors on the device. Nothing is cached while gradients are computed for the
+    parameter.
+    """
+    def __init__(self, maxsize=3):
+        self.maxsize = maxsize
+        self.token = None
+        self.values = OrderedDict()
+
+    def get(self, source, key, compute):
+        if torch.is_grad_enabled() and source.requires_grad:
+            return compute()
+        token = (source.data_ptr(), source._version, source.dtype, source.device)
+        if token != self.token:
+            self.values.clear()
+            self.token = token
+        if key in self.values:
+            self.values.move_to_end(key)
+        else:
+            self.values[key] = compute()
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return self.values[key]
+
+
+def warmup_caches(model, resolutions):
+    """
+    Precomputes the resolution-dependent tensors (interpolated position embeddings, relative position bias tables)
+    of the transformer backbones in the model for the given network input resolutions, as (height, width) pairs.
+    """
+    with torch.no_grad():
+        for module in model.modules():
+            if hasattr(module, "warmup_cache"):
+                for resolution in resolutions:
+                    module.warmup_cache(resolution)
 
 
 class Slice(nn.Module):
@@ -5,8 +5,8 @@ import types
 import math
 import torch.nn.functional as F
 
-from .utils import (activations, forward_adapted_unflatten, get_activation, get_readout_oper,
-                    make_backbone_default, Transpose)
+from .utils import (activations, chunked_attention, DerivedTensorCache, forward_adapted_unflatten, get_activation,
+                    get_readout_oper, make_backbone_default, Transpose)
 
 
 def forward_vit(pretrained, x):
@@ -14,6 +14,14 @@ def forward_vit(pretrained, x):
 
 
 def _resize_pos_embed(self, posemb, gs_h, gs_w):
+    # Cached, all the images of a batch or a video usually have the same size
+    if posemb is self.pos_embed:
+        return self.resized_pos_embeds.get(posemb, (gs_h, gs_w),
+                                           lambda: _interpolate_pos_embed(self, posemb, gs_h, gs_w))
+    return _interpolate_pos_embed(self, posemb, gs_h, gs_w)
+
+
+def _interpolate_pos_embed(self, posemb, gs_h, gs_w):
     posemb_tok, posemb_grid = (
         posemb[:, : self.start_index],
         posemb[0, self.start_index:],
@@ -30,6 +38,32 @@ def _resize_pos_embed(self, posemb, gs_h, gs_w):
     return posemb
 
 
+def attention_forward(self, x):
+    """
+    Modification of timm.models.vision_transformer.py: Attention.forward that computes the attention in chunks of
+    query rows, so that the memory needed for it grows linearly with the number of tokens (see chunked_attention).
+    """
+    B, N, C = x.shape
+    qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.unbind(0)
+    if hasattr(self, "q_norm"):
+        q, k = self.q_norm(q), self.k_norm(k)
+
+    # The default scale of scaled_dot_product_attention is head_dim ** -0.5, same as self.scale
+    x = chunked_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0)
+    x = x.transpose(1, 2).reshape(B, N, C)
+    x = self.proj(x)
+    x = self.proj_drop(x)
+    return x
+
+
+def vit_warmup_cache(self, resolution):
+    """
+    Precomputes the position embedding for the input resolution (height, width), see warmup_caches
+    """
+    self._resize_pos_embed(self.pos_embed, resolution[0] // self.patch_size[1], resolution[1] // self.patch_size[0])
+
+
 def forward_flex(self, x):
     b, c, h, w = x.shape
 
@@ -91,6 +125,11 @@ def _make_vit_b16_backbone(
     pretrained.model._resize_pos_embed = types.MethodType(
         _resize_pos_embed, pretrained.model
     )
+    pretrained.model.resized_pos_embeds = DerivedTensorCache()
+    pretrained.model.warmup_cache = types.MethodType(vit_warmup_cache, pretrained.model)
+
+    for block in pretrained.model.blocks:
+        block.attn.forward = types.MethodType(attention_forward, block.attn)
 
     return pretrained
 
@@ -201,6 +240,11 @@ def _make_vit_b_rn50_backbone(
     pretrained.model._resize_pos_embed = types.MethodType(
         _resize_pos_embed, pretrained.model
     )
+    pretrained.model.resized_pos_embeds = DerivedTensorCache()
+    pretrained.model.warmup_cache = types.MethodType(vit_warmup_cache, pretrained.model)
+
+    for block in pretrained.model.blocks:
+        block.attn.forward = types.MethodType(attention_forward, block.attn)
 
     return pretrained
 
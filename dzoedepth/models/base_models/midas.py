@@ -97,6 +97,11 @@ class Resize(object):
         self.__multiple_of = ensure_multiple_of
         self.__resize_method = resize_method
 
+    def set_size(self, width, height):
+        """Changes the desired output size"""
+        self.__width = width
+        self.__height = height
+
     def constrain_to_multiple_of(self, x, min_val=0, max_val=None):
         y = (np.round(x / self.__multiple_of) * self.__multiple_of).astype(int)
 
@@ -275,6 +280,11 @@ class MidasCore(nn.Module):
             return rel_depth, out
         return out
 
+    def set_net_size(self, width, height):
+        """Changes the size the input images are resized to (the aspect ratio is kept if keep_aspect_ratio is set)"""
+        if isinstance(self.prep.resizer, Resize):
+            self.prep.resizer.set_size(width, height)
+
     def get_rel_pos_params(self):
         for name, p in self.core.pretrained.named_parameters():
             if "relative_position" in name:
@@ -321,6 +331,7 @@ class MidasCore(nn.Module):
     def remove_hooks(self):
         for h in self.handles:
             h.remove()
+        self.handles = []
         return self
 
     def __del__(self):
@@ -338,10 +349,8 @@ class MidasCore(nn.Module):
             kwargs = MidasCore.parse_img_size(kwargs)
         img_size = kwargs.pop("img_size", [384, 384])
         print("img_size", img_size)
-        # TODO: use locally-bundled midas
-        # The repo should be changed back to isl-org/MiDaS once this MR lands
-        midas = torch.hub.load("semjon00/MiDaS", midas_model_type,
-                               pretrained=use_pretrained_midas, force_reload=force_reload)
+        # Uses the locally-bundled midas instead of torch.hub.load, force_reload is kept for compatibility
+        midas = build_local_midas(midas_model_type, pretrained=use_pretrained_midas)
         kwargs.update({'keep_aspect_ratio': force_keep_ar})
         midas_core = MidasCore(midas, trainable=train_midas, fetch_features=fetch_features,
                                freeze_bn=freeze_bn, img_size=img_size, **kwargs)
@@ -368,6 +377,44 @@ class MidasCore(nn.Module):
         return config
 
 
+def build_local_midas(midas_model_type, pretrained=False):
+    """Constructs a MiDaS model from the bundled dmidas, same as the corresponding entry point of the MiDaS hubconf.
+
+    Args:
+        midas_model_type (str): one of MIDAS_SETTINGS keys
+        pretrained (bool, optional): Load the MiDaS weights. Not needed if the weights of the whole ZoeDepth model are
+            loaded afterwards. The weights are downloaded once and cached by torch. Defaults to False.
+
+    Returns:
+        torch.nn.Module: Midas model.
+    """
+    backbone, weights_url = MIDAS_LOCAL_MODELS[midas_model_type]
+    if backbone == "efficientnet_lite3":
+        from dmidas.midas_net_custom import MidasNet_small
+        midas = MidasNet_small(None, features=64, backbone=backbone, exportable=True, non_negative=True,
+                               blocks={'expand': True})
+    else:
+        from dmidas.dpt_depth import DPTDepthModel
+        midas = DPTDepthModel(path=None, backbone=backbone, non_negative=True)
+    if pretrained:
+        state_dict = torch.hub.load_state_dict_from_url(weights_url, map_location='cpu', progress=True)
+        midas.load_state_dict(state_dict)
+    return midas
+
+
+# Model name to (dmidas backbone, weights url), as in the MiDaS hubconf
+MIDAS_LOCAL_MODELS = {
+    "DPT_BEiT_L_512": ("beitl16_512", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_beit_large_512.pt"),
+    "DPT_BEiT_L_384": ("beitl16_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_beit_large_384.pt"),
+    "DPT_BEiT_B_384": ("beitb16_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_beit_base_384.pt"),
+    "DPT_SwinV2_L_384": ("swin2l24_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_swin2_large_384.pt"),
+    "DPT_SwinV2_B_384": ("swin2b24_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_swin2_base_384.pt"),
+    "DPT_SwinV2_T_256": ("swin2t16_256", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_swin2_tiny_256.pt"),
+    "DPT_Large": ("vitl16_384", "https://github.com/isl-org/MiDaS/releases/download/v3/dpt_large_384.pt"),
+    "DPT_Hybrid": ("vitb_rn50_384", "https://github.com/isl-org/MiDaS/releases/download/v3/dpt_hybrid_384.pt"),
+    "MiDaS_small": ("efficientnet_lite3", "https://github.com/isl-org/MiDaS/releases/download/v2_1/midas_v21_small_256.pt"),
+}
+
 nchannels2models = {
     tuple([256]*5): ["DPT_BEiT_L_384", "DPT_BEiT_L_512", "DPT_BEiT_B_384", "DPT_SwinV2_L_384", "DPT_SwinV2_B_384", "DPT_SwinV2_T_256", "DPT_Large", "DPT_Hybrid"],
     (512, 256, 128, 64, 64): ["MiDaS_small"]
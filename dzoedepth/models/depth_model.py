@@ -96,34 +96,40 @@ class DepthModel(nn.Module):
                 out = out[:, :, :, pad_w:-pad_w]
         return out
     
-    def infer_with_flip_aug(self, x, pad_input: bool=True, **kwargs) -> torch.Tensor:
+    def infer_with_flip_aug(self, x, pad_input: bool=True, batch_flip: bool=True, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model with horizontal flip augmentation
         Horizontal flip augmentation improves the accuracy of the model by averaging the output of the model with and without horizontal flip.
         Args:
             x (torch.Tensor): input tensor of shape (b, c, h, w)
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
+            batch_flip (bool, optional): run the original and the flipped input as one batch (one forward pass of twice the batch size) instead of two forward passes. Needs more memory. Defaults to True.
         Returns:
             torch.Tensor: output tensor of shape (b, 1, h, w)
         """
         # infer with horizontal flip and average
-        out = self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
-        out_flip = self._infer_with_pad_aug(torch.flip(x, dims=[3]), pad_input=pad_input, **kwargs)
+        if batch_flip:
+            out_both = self._infer_with_pad_aug(torch.cat([x, torch.flip(x, dims=[3])]), pad_input=pad_input, **kwargs)
+            out, out_flip = out_both[:x.shape[0]], out_both[x.shape[0]:]
+        else:
+            out = self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
+            out_flip = self._infer_with_pad_aug(torch.flip(x, dims=[3]), pad_input=pad_input, **kwargs)
         out = (out + torch.flip(out_flip, dims=[3])) / 2
         return out
     
-    def infer(self, x, pad_input: bool=True, with_flip_aug: bool=True, **kwargs) -> torch.Tensor:
+    def infer(self, x, pad_input: bool=True, with_flip_aug: bool=True, batch_flip: bool=True, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model
         Args:
             x (torch.Tensor): input tensor of shape (b, c, h, w)
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
             with_flip_aug (bool, optional): whether to use horizontal flip augmentation. Defaults to True.
+            batch_flip (bool, optional): see infer_with_flip_aug. Defaults to True.
         Returns:
             torch.Tensor: output tensor of shape (b, 1, h, w)
         """
         if with_flip_aug:
-            return self.infer_with_flip_aug(x, pad_input=pad_input, **kwargs)
+            return self.infer_with_flip_aug(x, pad_input=pad_input, batch_flip=batch_flip, **kwargs)
         else:
             return self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
     
@@ -1,6 +1,7 @@
 # This launches DepthMap without the AUTOMATIC1111/stable-diffusion-webui
 
 import argparse
+import json
 import os
 import pathlib
 
@@ -25,16 +26,73 @@ def maybe_chdir():
         pass
 
 
+def parse_options(options):
+    """Generation options for the batch mode: either a path to a JSON file or a JSON string"""
+    if options is None:
+        return {}
+    if os.path.isfile(options):
+        with open(options, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(options)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--share", help="Create public link", action='store_true')
     parser.add_argument("--listen", help="Create public link", action='store_true')
     parser.add_argument("--no_chdir", help="Do not try to use the root of stable-diffusion-webui", action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+    batch_parser = subparsers.add_parser('batch', help="Process a directory tree without launching the UI")
+    batch_parser.add_argument("input", help="Input directory, processed recursively")
+    batch_parser.add_argument("output", help="Output directory, mirrors the input directory tree")
+    batch_parser.add_argument("--options", help="Generation options: JSON file or JSON string "
+                                                "(keys are lowercase option names, see GenerationOptions)")
+    batch_parser.add_argument("--chunk_size", help="How many images are loaded at once", type=int, default=16)
+    batch_parser.add_argument("--force", help="Process files even if the manifest says they are done",
+                              action='store_true')
+    batch_parser.add_argument("--prefetch", help="How many images are decoded ahead of the model", type=int,
+                              default=16)
+    batch_parser.add_argument("--workers", help="Threads for decoding inputs and for encoding outputs (each)",
+                              type=int, default=2)
+    batch_parser.add_argument("--profile", help="Save a JSON report with per-stage timings and memory usage "
+                                                "to this file", default=None)
+    batch_parser.add_argument("--compress_level", help="PNG compression level of the outputs, 0-9 (lower is faster)",
+                              type=int, default=None, choices=range(10))
+    batch_parser.add_argument("--distributed", help="Cooperate with other workers processing the same directories "
+                                                    "(e.g. on other hosts, through a shared filesystem)",
+                              action='store_true')
+    batch_parser.add_argument("--worker_id", help="Name of this worker in the leases (distributed mode), "
+                                                  "unique by default", default=None)
+    batch_parser.add_argument("--lease_expiry", help="Seconds after which the files claimed by an unresponsive "
+                                                     "worker are reclaimed (distributed mode)", type=int, default=120)
+    batch_parser.add_argument("--heartbeat", help="Seconds between the renewals of the leases (distributed mode)",
+                              type=int, default=20)
     args = parser.parse_args()
+    if args.command == 'batch':
+        # Relative to the directory the user launched us from, not to the webui root
+        args.input, args.output = os.path.abspath(args.input), os.path.abspath(args.output)
+        if args.profile is not None:
+            args.profile = os.path.abspath(args.profile)
 
-    print(f"{src.misc.SCRIPT_FULL_NAME} running in standalone mode!")
+    print(f"{src.misc.get_script_full_name()} running in standalone mode!")
     if not args.no_chdir:
         maybe_chdir()
-    server_name = "0.0.0.0" if args.listen else None
-    import src.common_ui
-    src.common_ui.on_ui_tabs().launch(share=args.share, server_name=server_name)
+    if args.command == 'batch':
+        import src.batch_mode
+        from src.profiling import profiler
+        if args.profile is not None:
+            profiler.enable_cpu_memory_tracing()
+        try:
+            src.batch_mode.run_batch(args.input, args.output, parse_options(args.options),
+                                     chunk_size=args.chunk_size, force=args.force, prefetch=args.prefetch,
+                                     workers=args.workers, compress_level=args.compress_level,
+                                     distributed=args.distributed, worker_id=args.worker_id,
+                                     lease_expiry=args.lease_expiry, heartbeat=args.heartbeat)
+        finally:
+            if args.profile is not None:
+                profiler.write_report(args.profile)
+                print(f"Profiling report saved to {args.profile}")
+    else:
+        server_name = "0.0.0.0" if args.listen else None
+        import src.common_ui
+        src.common_ui.on_ui_tabs().launch(share=args.share, server_name=server_name)
@@ -1,10 +1,10 @@
 # Author: Bingxin Ke
 # Last modified: 2023-12-15
 
-from typing import List, Dict, Union
+import math
+from typing import List, Dict, Tuple, Union
 
 import torch
-from torch.utils.data import DataLoader, TensorDataset
 import numpy as np
 from tqdm.auto import tqdm
 from PIL import Image
@@ -21,6 +21,7 @@ from transformers import CLIPTextModel, CLIPTokenizer
 from .util.image_util import chw2hwc, colorize_depth_maps, resize_max_res
 from .util.batchsize import find_batch_size
 from .util.ensemble import ensemble_depths
+from .util.tiling import tiled_forward
 
 
 class MarigoldDepthOutput(BaseOutput):
@@ -34,11 +35,15 @@ class MarigoldDepthOutput(BaseOutput):
             Colorized depth map, with the shape of [3, H, W] and values in [0, 1]
         uncertainty (None` or `np.ndarray):
             Uncalibrated uncertainty(MAD, median absolute deviation) coming from ensembling.
+        depth_latent (`None` or `torch.Tensor`):
+            Denoised depth latent, averaged over the ensemble members, with the shape of [1, 4, h, w].
+            Can be used to warm-start the prediction for the next frame of a video.
     """
 
     depth_np: np.ndarray
     depth_colored: Image.Image
     uncertainty: Union[None, np.ndarray]
+    depth_latent: Union[None, torch.Tensor]
 
 
 class MarigoldPipeline(DiffusionPipeline):
@@ -64,6 +69,13 @@ class MarigoldPipeline(DiffusionPipeline):
 
     rgb_latent_scale_factor = 0.18215
     depth_latent_scale_factor = 0.18215
+    # Above this resolution (longer side, in pixels) the VAE encodes and decodes in overlapping tiles,
+    # so that its memory does not grow with the resolution. Off by default: the GroupNorm statistics of the
+    # tiles differ from those of the whole image, see the benchmark case marigold/vae/1536/tiled.
+    # The "tiled" out of memory recovery step turns it on.
+    vae_tiling_threshold = math.inf
+    vae_tile_size = 512
+    vae_tile_overlap = 64
 
     def __init__(
         self,
@@ -97,6 +109,9 @@ class MarigoldPipeline(DiffusionPipeline):
         color_map: str = "Spectral",
         show_progress_bar: bool = True,
         ensemble_kwargs: Dict = None,
+        init_depth_latent: torch.Tensor = None,
+        init_strength: float = 1.0,
+        ensemble_tolerance: float = 0.0,
     ) -> MarigoldDepthOutput:
         """
         Function invoked when calling the pipeline.
@@ -129,6 +144,20 @@ class MarigoldPipeline(DiffusionPipeline):
                 Colormap used to colorize the depth map.
                 Defaults to "Spectral".
             ensemble_kwargs ()
+            init_depth_latent (torch.Tensor, optional):
+                Depth latent to start denoising from (e.g. `depth_latent` of the previous video frame),
+                instead of pure noise. Ignored if its shape does not match.
+                Defaults to None.
+            init_strength (float, optional):
+                How much noise is added to `init_depth_latent`, in (0, 1]. Only the last
+                `init_strength` fraction of the denoising steps is run. 1.0 means starting from pure noise.
+                Defaults to 1.0.
+            ensemble_tolerance (float, optional):
+                Adaptive ensembling. If positive, predictions are generated in batches and the generation stops
+                once adding a batch changes the ensembled depth (in [0, 1] units, mean absolute difference)
+                by less than this value, or the ensemble uncertainty drops below it.
+                0 means always computing all `ensemble_size` predictions.
+                Defaults to 0.0.
         Returns:
             `MarigoldDepthOutput`
         """
@@ -162,41 +191,66 @@ class MarigoldPipeline(DiffusionPipeline):
         assert rgb_norm.min() >= 0.0 and rgb_norm.max() <= 1.0
 
         # ----------------- Predicting depth -----------------
-        # Batch repeated input image
-        duplicated_rgb = torch.stack([rgb_norm] * ensemble_size)
-        single_rgb_dataset = TensorDataset(duplicated_rgb)
+        # The image is the same for all ensemble members, it is encoded once
+        rgb_latent = self.encode_rgb(rgb_norm.unsqueeze(0))  # [1, 4, h, w]
         if batch_size > 0:
             _bs = batch_size
         else:
             _bs = find_batch_size(
                 ensemble_size=ensemble_size, input_res=max(rgb_norm.shape[1:])
             )
-
-        single_rgb_loader = DataLoader(
-            single_rgb_dataset, batch_size=_bs, shuffle=False
-        )
+        if ensemble_tolerance > 0 and ensemble_size > 2:
+            # Smaller batches give more chances to stop early
+            _bs = min(_bs, max(2, math.ceil(ensemble_size / 4)))
+        batch_sizes = [
+            min(_bs, ensemble_size - i) for i in range(0, ensemble_size, _bs)
+        ]
 
         # Predict depth maps (batched)
         depth_pred_ls = []
+        depth_latent_ls = []
+        depth_pred = None  # Latest ensembled estimate, when ensembling adaptively
+        converged = False
         if show_progress_bar:
             iterable = tqdm(
-                single_rgb_loader, desc=" " * 2 + "Inference batches", leave=False
+                batch_sizes, desc=" " * 2 + "Inference batches", leave=False
             )
         else:
-            iterable = single_rgb_loader
-        for batch in iterable:
-            (batched_img,) = batch
-            depth_pred_raw = self.single_infer(
-                rgb_in=batched_img,
+            iterable = batch_sizes
+        for n in iterable:
+            depth_pred_raw, depth_latent = self.single_infer(
+                rgb_latent=rgb_latent,
+                batch_size=n,
                 num_inference_steps=denoising_steps,
                 show_pbar=show_progress_bar,
+                init_latent=init_depth_latent,
+                init_strength=init_strength,
             )
             depth_pred_ls.append(depth_pred_raw.detach().clone())
+            depth_latent_ls.append(depth_latent.detach())
+
+            n_pred = sum([x.shape[0] for x in depth_pred_ls])
+            if ensemble_tolerance > 0 and 2 <= n_pred < ensemble_size:
+                prev_depth_pred = depth_pred
+                depth_pred, pred_uncert = ensemble_depths(
+                    torch.concat(depth_pred_ls, axis=0).squeeze(1),
+                    **(ensemble_kwargs or {}),
+                )
+                converged = pred_uncert.mean().item() < ensemble_tolerance or (
+                    prev_depth_pred is not None
+                    and torch.mean(torch.abs(depth_pred - prev_depth_pred)).item()
+                    < ensemble_tolerance
+                )
+                if converged:
+                    break
         depth_preds = torch.concat(depth_pred_ls, axis=0).squeeze()
+        depth_latent = torch.concat(depth_latent_ls, axis=0).mean(dim=0, keepdim=True)
         torch.cuda.empty_cache()  # clear vram cache for ensembling
 
         # ----------------- Test-time ensembling -----------------
-        if ensemble_size > 1:
+        if converged:
+            pass  # Adaptive ensembling has stopped early, the estimate is already computed
+        elif ensemble_size > 1:
             depth_pred, pred_uncert = ensemble_depths(
                 depth_preds, **(ensemble_kwargs or {})
             )
@@ -233,6 +287,7 @@ class MarigoldPipeline(DiffusionPipeline):
             depth_np=depth_pred,
             depth_colored=depth_colored_img,
             uncertainty=pred_uncert,
+            depth_latent=depth_latent,
         )
 
     def __encode_empty_text(self):
@@ -252,33 +307,59 @@ class MarigoldPipeline(DiffusionPipeline):
 
     @torch.no_grad()
     def single_infer(
-        self, rgb_in: torch.Tensor, num_inference_steps: int, show_pbar: bool
-    ) -> torch.Tensor:
+        self,
+        rgb_latent: torch.Tensor,
+        batch_size: int,
+        num_inference_steps: int,
+        show_pbar: bool,
+        init_latent: torch.Tensor = None,
+        init_strength: float = 1.0,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Perform an individual depth prediction without ensembling.
+        Perform individual depth predictions without ensembling.
 
         Args:
-            rgb_in (torch.Tensor):
-                Input RGB image.
+            rgb_latent (torch.Tensor):
+                Latent of the input RGB image (see `encode_rgb`), [1, 4, h, w]. It is shared by the batch.
+            batch_size (int):
+                Number of predictions, each starts from its own noise.
             num_inference_steps (int):
-                Number of diffusion denoisign steps (DDIM) during inference.
+                Number of diffusion denoising steps (DDIM) during inference.
             show_pbar (bool):
                 Display a progress bar of diffusion denoising.
+            init_latent (torch.Tensor, optional):
+                Depth latent to be partially re-noised and used instead of pure noise.
+            init_strength (float, optional):
+                Fraction of the denoising schedule to run, starting from `init_latent`.
 
         Returns:
-            torch.Tensor: Predicted depth map.
+            Tuple[torch.Tensor, torch.Tensor]: Predicted depth maps and the denoised depth latents.
         """
-        device = rgb_in.device
+        device = rgb_latent.device
 
         # Set timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
         timesteps = self.scheduler.timesteps  # [T]
 
-        # Encode image
-        rgb_latent = self.encode_rgb(rgb_in)
+        # Broadcast the image latent to the batch, without a copy
+        rgb_latent = rgb_latent.expand(batch_size, -1, -1, -1)
 
         # Initial depth map (noise)
         depth_latent = torch.randn(rgb_latent.shape, device=device, dtype=rgb_latent.dtype)  # [B, 4, h, w]
+        if (
+            init_latent is not None
+            and init_strength < 1.0
+            and init_latent.shape[1:] == rgb_latent.shape[1:]
+        ):
+            # Warm start (like img2img): re-noise the given latent and skip the first denoising steps
+            n_steps = min(len(timesteps), max(1, round(len(timesteps) * init_strength)))
+            timesteps = timesteps[len(timesteps) - n_steps :]
+            init_latent = init_latent.to(device=device, dtype=rgb_latent.dtype).expand(
+                rgb_latent.shape
+            )
+            depth_latent = self.scheduler.add_noise(
+                init_latent, depth_latent, timesteps[:1].repeat(rgb_latent.shape[0])
+            )
 
         # Batched empty text embedding
         if self.empty_text_embed is None:
@@ -317,7 +398,7 @@ class MarigoldPipeline(DiffusionPipeline):
         # shift to [0, 1]
         depth = depth * 2.0 - 1.0
 
-        return depth
+        return depth, depth_latent
 
     def encode_rgb(self, rgb_in: torch.Tensor) -> torch.Tensor:
         """
@@ -330,10 +411,19 @@ class MarigoldPipeline(DiffusionPipeline):
         Returns:
             torch.Tensor: Image latent
         """
+        def encode(rgb):
+            h = self.vae.encoder(rgb)
+            moments = self.vae.quant_conv(h)
+            mean, logvar = torch.chunk(moments, 2, dim=1)
+            return mean
+
         # encode
-        h = self.vae.encoder(rgb_in)
-        moments = self.vae.quant_conv(h)
-        mean, logvar = torch.chunk(moments, 2, dim=1)
+        if max(rgb_in.shape[-2:]) > self.vae_tiling_threshold:
+            mean = tiled_forward(
+                encode, rgb_in, self.vae_tile_size, self.vae_tile_overlap, 1 / 8, align=8
+            )
+        else:
+            mean = encode(rgb_in)
         # scale latent
         rgb_latent = mean * self.rgb_latent_scale_factor
         return rgb_latent
@@ -349,11 +439,23 @@ class MarigoldPipeline(DiffusionPipeline):
         Returns:
             torch.Tensor: Decoded depth map.
         """
+        def decode(latent):
+            z = self.vae.post_quant_conv(latent)
+            stacked = self.vae.decoder(z)
+            # mean of output channels
+            return stacked.mean(dim=1, keepdim=True)
+
         # scale latent
         depth_latent = depth_latent / self.depth_latent_scale_factor
         # decode
-        z = self.vae.post_quant_conv(depth_latent)
-        stacked = self.vae.decoder(z)
-        # mean of output channels
-        depth_mean = stacked.mean(dim=1, keepdim=True)
+        if max(depth_latent.shape[-2:]) * 8 > self.vae_tiling_threshold:
+            depth_mean = tiled_forward(
+                decode,
+                depth_latent,
+                self.vae_tile_size // 8,
+                self.vae_tile_overlap // 8,
+                8,
+            )
+        else:
+            depth_mean = decode(depth_latent)
         return depth_mean
@@ -2,11 +2,8 @@
 # Author: Bingxin Ke
 # Last modified: 2023-12-15
 
-import numpy as np
 import torch
 
-from scipy.optimize import minimize
-
 
 def inter_distances(tensors: torch.Tensor):
     """
@@ -32,68 +29,70 @@ def ensemble_depths(
     """
     To ensemble multiple affine-invariant depth images (up to scale and shift),
         by aligning estimating the scale and shift
-    """
-    device = input_images.device
-    dtype = np.float32
 
+    The scale and shift are optimized with L-BFGS on the device of the inputs, with analytic gradients,
+    so no host round trip is needed per objective evaluation.
+    """
     original_input = input_images.clone()
     n_img = input_images.shape[0]
     ori_shape = input_images.shape
+    # Optimize in full precision even if the predictions are half
+    input_images = input_images.detach().float()
 
     if max_res is not None:
-        scale_factor = torch.min(max_res / torch.tensor(ori_shape[-2:]))
+        scale_factor = torch.min(max_res / torch.tensor(ori_shape[-2:])).item()
         if scale_factor < 1:
-            downscaler = torch.nn.Upsample(scale_factor=scale_factor, mode="nearest")
-            input_images = downscaler(torch.from_numpy(input_images)).numpy()
+            input_images = torch.nn.functional.interpolate(
+                input_images.unsqueeze(1), scale_factor=scale_factor, mode="nearest"
+            ).squeeze(1)
 
     # init guess
-    _min = np.min(input_images.reshape((n_img, -1)).cpu().numpy(), axis=1)
-    _max = np.max(input_images.reshape((n_img, -1)).cpu().numpy(), axis=1)
-    s_init = 1.0 / (_max - _min).reshape((-1, 1, 1))
-    t_init = (-1 * s_init.flatten() * _min.flatten()).reshape((-1, 1, 1))
-    x = np.concatenate([s_init, t_init]).reshape(-1)
+    flat = input_images.reshape((n_img, -1))
+    _min = torch.min(flat, dim=1).values
+    _max = torch.max(flat, dim=1).values
+    s = (1.0 / (_max - _min)).requires_grad_(True)
+    t = (-1 * s.detach() * _min).requires_grad_(True)
 
-    input_images = input_images.to(device)
+    def reduce(transformed_arrays):
+        if "mean" == reduction:
+            return torch.mean(transformed_arrays, dim=0)
+        elif "median" == reduction:
+            return torch.median(transformed_arrays, dim=0).values
+        else:
+            raise ValueError(f"Unknown reduction method: {reduction}")
 
     # objective function
-    def closure(x):
-        x = x.astype(dtype)
-        l = len(x)
-        s = x[: int(l / 2)]
-        t = x[int(l / 2) :]
-        s = torch.from_numpy(s).to(device)
-        t = torch.from_numpy(t).to(device)
-
+    def objective():
         transformed_arrays = input_images * s.view((-1, 1, 1)) + t.view((-1, 1, 1))
         dists = inter_distances(transformed_arrays)
         sqrt_dist = torch.sqrt(torch.mean(dists**2))
 
-        if "mean" == reduction:
-            pred = torch.mean(transformed_arrays, dim=0)
-        elif "median" == reduction:
-            pred = torch.median(transformed_arrays, dim=0).values
-        else:
-            raise ValueError
-
+        pred = reduce(transformed_arrays)
         near_err = torch.sqrt((0 - torch.min(pred)) ** 2)
         far_err = torch.sqrt((1 - torch.max(pred)) ** 2)
 
-        err = sqrt_dist + (near_err + far_err) * regularizer_strength
-        err = err.detach().cpu().numpy()
-        return err
+        return sqrt_dist + (near_err + far_err) * regularizer_strength
 
-    res = minimize(
-        closure, x, method="BFGS", tol=tol, options={"maxiter": max_iter, "disp": False}
+    optimizer = torch.optim.LBFGS(
+        [s, t],
+        max_iter=max_iter,
+        tolerance_grad=tol,
+        tolerance_change=tol * 1e-3,
+        line_search_fn="strong_wolfe",
     )
-    x = res.x
-    x = x.astype(dtype)
-    l = len(x)
-    s = x[: int(l / 2)]
-    t = x[int(l / 2) :]
+
+    def closure():
+        optimizer.zero_grad()
+        err = objective()
+        err.backward()
+        return err
+
+    with torch.enable_grad():
+        optimizer.step(closure)
 
     # Prediction
-    s = torch.from_numpy(s).to(device)
-    t = torch.from_numpy(t).to(device)
+    s = s.detach().to(original_input.dtype)
+    t = t.detach().to(original_input.dtype)
     transformed_arrays = original_input * s.view(-1, 1, 1) + t.view(-1, 1, 1)
     if "mean" == reduction:
         aligned_images = torch.mean(transformed_arrays, dim=0)
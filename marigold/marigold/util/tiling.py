@@ -0,0 +1,73 @@
+# Tiled evaluation of the VAE, to bound its memory at high resolutions
+
+import math
+
+import torch
+
+
+def tile_starts(size: int, tile_size: int, overlap: int, align: int = 1):
+    """
+    Start positions of overlapping tiles covering `size` pixels. The last tile ends at `size`,
+    it may be up to `align - 1` pixels longer than `tile_size` so that every start is a multiple of `align`.
+    """
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    last = (size - tile_size) // align * align
+    return [start for start in starts if start < last] + [last]
+
+
+def blend_mask(height: int, width: int, overlap: int, device, dtype=torch.float32):
+    """
+    Weights of a tile for blending: rising linearly over `overlap` pixels from every edge, 1 inside.
+    The weights are never zero, so the pixels that are covered by one tile only keep their value.
+    """
+    def ramp(n):
+        if overlap <= 0:
+            return torch.ones(n, device=device, dtype=dtype)
+        r = ((torch.arange(n, device=device, dtype=dtype) + 0.5) / overlap).clamp(max=1)
+        return torch.minimum(r, r.flip(0))
+
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+
+def tiled_forward(fn, x: torch.Tensor, tile_size: int, overlap: int, scale: float, align: int = 1):
+    """
+    Applies `fn` to overlapping tiles of `x` and blends the results.
+
+    Args:
+        fn: Function of a [B, C, h, w] tensor, returning a [B, C', h * scale, w * scale] tensor
+            (rounded up, like the VAE encoder does).
+        x (torch.Tensor): Input, [B, C, H, W].
+        tile_size (int): Side of the tiles, in pixels of `x`.
+        overlap (int): Overlap of neighbouring tiles, in pixels of `x`.
+        scale (float): Spatial scale of `fn`, e.g. 1/8 for the encoder of the VAE, 8 for the decoder.
+        align (int): The tiles start at multiples of this, should be 1 / scale for downscaling functions.
+
+    Returns:
+        torch.Tensor: Output, [B, C', ceil(H * scale), ceil(W * scale)], in the dtype of `fn`'s output.
+    """
+    height, width = x.shape[-2:]
+    out = weights = None
+    out_overlap = round(overlap * scale)
+    ys = tile_starts(height, tile_size, overlap, align)
+    xs = tile_starts(width, tile_size, overlap, align)
+    for y0 in ys:
+        y1 = height if y0 == ys[-1] else y0 + tile_size
+        for x0 in xs:
+            x1 = width if x0 == xs[-1] else x0 + tile_size
+            y = fn(x[..., y0:y1, x0:x1])
+            if out is None:
+                # Accumulated in float32 even if fn is half precision
+                out = torch.zeros(
+                    (*y.shape[:2], math.ceil(height * scale), math.ceil(width * scale)),
+                    device=y.device,
+                    dtype=torch.float32,
+                )
+                weights = torch.zeros(out.shape[-2:], device=y.device, dtype=torch.float32)
+            oy, ox = round(y0 * scale), round(x0 * scale)
+            th, tw = y.shape[-2:]
+            mask = blend_mask(th, tw, out_overlap, y.device)
+            out[..., oy : oy + th, ox : ox + tw] += y.float() * mask
+            weights[oy : oy + th, ox : ox + tw] += mask
+    return (out / weights).to(y.dtype)
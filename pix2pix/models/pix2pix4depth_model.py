@@ -94,8 +94,9 @@ class Pix2Pix4DepthModel(BaseModel):
         self.real_A = torch.cat((self.outer, self.inner), 1)
 
     def set_input(self, outer, inner):
-        inner = torch.from_numpy(inner).unsqueeze(0).unsqueeze(0)
-        outer = torch.from_numpy(outer).unsqueeze(0).unsqueeze(0)
+        # numpy arrays or tensors, the tensors already on self.device are not copied
+        inner = torch.as_tensor(inner, device=self.device).unsqueeze(0).unsqueeze(0)
+        outer = torch.as_tensor(outer, device=self.device).unsqueeze(0).unsqueeze(0)
 
         inner = (inner - torch.min(inner))/(torch.max(inner)-torch.min(inner))
         outer = (outer - torch.min(outer))/(torch.max(outer)-torch.min(outer))
@@ -103,7 +104,7 @@ class Pix2Pix4DepthModel(BaseModel):
         inner = self.normalize(inner)
         outer = self.normalize(outer)
 
-        self.real_A = torch.cat((outer, inner), 1).to(self.device)
+        self.real_A = torch.cat((outer, inner), 1)
 
 
     def normalize(self, input):
@@ -89,6 +89,14 @@ def on_ui_settings():
     add_option('boost_rmax', 1600, "Maximum wholesize for boost (Rmax)")
     add_option('marigold_ensembles', 5, "How many ensembles to use for Marigold")
     add_option('marigold_steps', 10, "How many denoising steps to use for Marigold")
+    add_option('marigold_ensemble_tolerance', 0.0,
+               "Stop computing Marigold ensembles early once they agree within this tolerance (0 = disable)")
+    add_option('marigold_video_keyframe_interval', 8,
+               "Video mode: Marigold denoises every N-th frame from scratch (1 = every frame), "
+               "other frames are warm-started from the previous frame")
+    add_option('marigold_video_strength', 0.35,
+               "Video mode: fraction of Marigold denoising steps used for warm-started frames")
+    add_option('marigold_video_ensembles', 1, "Video mode: how many ensembles to use for warm-started frames")
 
     add_option('save_ply', False, "Save additional PLY file with 3D inpainted mesh.")
     add_option('show_3d', True, "Enable showing 3D Meshes in output tab. (Experimental)")
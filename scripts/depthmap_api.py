@@ -6,6 +6,7 @@ import os
 import numpy as np
 from fastapi import FastAPI, Body
 from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse
 from PIL import Image
 
 import gradio as gr
@@ -17,6 +18,7 @@ from src.core import core_generation_funnel, run_makevideo
 from src.misc import SCRIPT_VERSION
 from src import backbone
 from src.common_constants import GenerationOptions as go
+from src.profiling import profiler
 
 
 def encode_to_base64(image):
@@ -48,6 +50,11 @@ def depth_api(_: gr.Blocks, app: FastAPI):
     async def get_options():
         return {"options": sorted([x.name.lower() for x in go])}
 
+    @app.get("/depth/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        """Per-stage timings and memory high-water marks, in Prometheus text format"""
+        return PlainTextResponse(profiler.to_prometheus(), media_type="text/plain; version=0.0.4")
+
     # TODO: some potential inputs not supported (like custom depthmaps)
     @app.post("/depth/generate")
     async def process(
@@ -70,7 +77,8 @@ def depth_api(_: gr.Blocks, app: FastAPI):
         for count, type, result in gen_obj:
             if not isinstance(result, Image.Image):
                 continue
-            results_based += [encode_to_base64(result)]
+            with profiler.stage('encode'):
+                results_based += [encode_to_base64(result)]
 
         return {"images": results_based, "info": "Success"}
 
@@ -0,0 +1,132 @@
+# Decoding inputs and encoding outputs off the inference thread.
+# PNG encoding of 16-bit depthmaps, stereo images and normalmaps can take as long as the inference itself,
+# so it is done on separate thread pools while the model works on the next image.
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+def load_image(path):
+    """Opens and fully decodes an image, so that decoding does not happen later on the inference thread"""
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+class PrefetchingLoader:
+    """List-like view over a list of paths, items are produced by loader(path) on a thread pool.
+    At most `prefetch` items ahead of the last accessed one are decoded (or being decoded) at any time.
+    Items are expected to be accessed in order: already passed items are dropped and are loaded again (on the
+    calling thread) if accessed later. Like in a list, items can be replaced."""
+    def __init__(self, paths, loader=load_image, prefetch=4, workers=2):
+        self.paths = list(paths)
+        self.loader = loader
+        self.prefetch = max(1, prefetch)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='depthmap-prefetch')
+        self.futures = {}
+        self.current = None  # (index, item) of the last accessed item
+        self.next_to_submit = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _submit_ahead(self, index):
+        self.next_to_submit = max(self.next_to_submit, index)
+        while self.next_to_submit < min(len(self.paths), index + 1 + self.prefetch):
+            i = self.next_to_submit
+            self.futures[i] = self.executor.submit(self.loader, self.paths[i])
+            self.next_to_submit += 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.paths)
+        if not 0 <= index < len(self.paths):
+            raise IndexError('Index out of range')
+        if self.current is not None and self.current[0] == index:
+            return self.current[1]
+        self._submit_ahead(index)
+        for i in [i for i in self.futures if i < index]:
+            self.futures.pop(i).cancel()
+        future = self.futures.pop(index, None)
+        item = future.result() if future is not None else self.loader(self.paths[index])
+        self.current = (index, item)
+        return item
+
+    def __setitem__(self, index, value):
+        self[index]  # Make it current, so that the replacement is kept
+        self.current = (self.current[0], value)
+
+    def __iter__(self):
+        for i in range(len(self.paths)):
+            yield self[i]
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.current = None
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncWriter:
+    """Runs save jobs on a thread pool. At most max_pending jobs can be queued, submit blocks while the queue is full.
+    Every job has a tag, finished jobs are reported in submission order."""
+    def __init__(self, workers=2, max_pending=8):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='depthmap-writer')
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.pending = deque()
+
+    def submit(self, tag, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append((tag, future))
+
+    def oldest_pending_tag(self):
+        """Tag of the oldest job that was not reported yet, None if there is none"""
+        return self.pending[0][0] if len(self.pending) > 0 else None
+
+    def poll(self):
+        """Yields (tag, result) of the finished jobs in submission order, stops at the first unfinished one.
+        If a job failed, its exception is raised here."""
+        while len(self.pending) > 0 and self.pending[0][1].done():
+            tag, future = self.pending.popleft()
+            yield tag, future.result()
+
+    def drain(self):
+        """Waits for all the jobs, yields (tag, result) in submission order"""
+        while len(self.pending) > 0:
+            tag, future = self.pending.popleft()
+            yield tag, future.result()
+
+    def close(self):
+        try:
+            for _ in self.drain():
+                pass
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # Do not hide the original exception, but still let the started jobs finish
+            for _, future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
+        else:
+            self.close()
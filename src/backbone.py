@@ -36,16 +36,22 @@ try:
     def gather_ops():
         """Parameters for depthmap generation"""
         ops = {}
-        for s in ['boost_rmax', 'precision', 'no_half', 'marigold_ensembles', 'marigold_steps']:
+        for s in ['boost_rmax', 'precision', 'no_half', 'marigold_ensembles', 'marigold_steps',
+                  'marigold_video_keyframe_interval', 'marigold_video_strength', 'marigold_video_ensembles',
+                  'marigold_ensemble_tolerance']:
             c = get_opt('depthmap_script_' + s, None)
             if c is None:
                 c = get_cmd_opt(s, None)
             if c is not None:
                 ops[s] = c
         # sanitize for integers.
-        for s in ['marigold_ensembles', 'marigold_steps']:
+        for s in ['marigold_ensembles', 'marigold_steps', 'marigold_video_keyframe_interval',
+                  'marigold_video_ensembles']:
             if s in ops:
                 ops[s] = int(ops[s])
+        for s in ['marigold_video_strength', 'marigold_ensemble_tolerance']:
+            if s in ops:
+                ops[s] = float(ops[s])
         return ops
 
 
@@ -105,11 +111,15 @@ except:
     launched_at = int(datetime.now().timestamp())
     backbone_current_seq_number = 0
 
+    import threading
+    backbone_seq_number_lock = threading.Lock()  # Images are saved from the writer threads
+
     # Make sure to preserve the function signature when calling!
     def get_next_sequence_number(outpath, basename):
         global backbone_current_seq_number
-        backbone_current_seq_number += 1
-        return int(f"{launched_at}{backbone_current_seq_number:04}")
+        with backbone_seq_number_lock:
+            backbone_current_seq_number += 1
+            return int(f"{launched_at}{backbone_current_seq_number:04}")
 
     def wrap_gradio_gpu_call(f): return f  # Displaying various stats is not supported
 
@@ -128,7 +138,11 @@ except:
                 'precision': 'autocast',
                 'no_half': False,
                 'marigold_ensembles': 5,
-                'marigold_steps': 12}
+                'marigold_steps': 12,
+                'marigold_ensemble_tolerance': 0.0,
+                'marigold_video_keyframe_interval': 8,
+                'marigold_video_strength': 0.35,
+                'marigold_video_ensembles': 1}
 
     def get_outpath(): return str(pathlib.Path('.', 'outputs'))
 
@@ -0,0 +1,135 @@
+# Batch size autotuning for the batched inference paths (currently the ensemble members of Marigold).
+# The largest batch that fits is found by probing: the batch size is doubled until the model runs out of memory
+# (or until a larger batch no longer improves the throughput), then the boundary is bisected. A safety margin is
+# subtracted from the largest batch that fitted. The results are cached in a JSON file, keyed by the model, the
+# resolution bucket, the dtype and the device (including the GPU model and its memory).
+import gc
+import json
+import math
+import os
+import time
+
+import torch
+
+AUTOTUNE_VERSION = 1
+RESOLUTION_BUCKET = 128  # Resolutions are rounded up to multiples of this
+SAFETY_MARGIN = 0.15  # Fraction of the largest batch that fitted that is not used
+PLATEAU = 0.05  # Doubling the batch has to improve the throughput at least by this fraction
+
+
+def is_out_of_memory(e):
+    """True if the exception is an out of memory error of torch (CUDA or the CPU allocator)"""
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(e)
+    return isinstance(e, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def free_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def device_name(device):
+    """Identifies the hardware, batch sizes tuned on one GPU model do not apply to another"""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        properties = torch.cuda.get_device_properties(device)
+        return f'cuda {properties.name} {properties.total_memory // 2 ** 20}MiB'
+    return device.type
+
+
+def resolution_bucket(height, width):
+    """Orientation does not matter, the sides are rounded up to RESOLUTION_BUCKET"""
+    sides = sorted([math.ceil(height / RESOLUTION_BUCKET) * RESOLUTION_BUCKET,
+                    math.ceil(width / RESOLUTION_BUCKET) * RESOLUTION_BUCKET])
+    return f'{sides[0]}x{sides[1]}'
+
+
+class BatchSizeAutotuner:
+    def __init__(self, cache_path='./models/batch_sizes.json'):
+        self.cache_path = cache_path
+        self.cache = None  # Loaded on first use
+
+    @staticmethod
+    def key(model_type, height, width, dtype, device):
+        return f'{model_type} {resolution_bucket(height, width)} {str(dtype).replace("torch.", "")} ' \
+               f'{device_name(device)}'
+
+    def batch_size(self, key, probe, limit):
+        """Tuned batch size for key, at most limit. probe(n) should run a batch of n on representative data,
+        it is only called if key was not tuned yet (or was tuned with a smaller limit)."""
+        if limit <= 1:
+            return 1
+        entry = self._load().get(key)
+        if entry is None or (entry['limited'] and entry['tested'] < limit):
+            print(f'Tuning the batch size for {key} ..')
+            entry = tune_batch_size(probe, limit)
+            self.cache[key] = entry
+            self._save()
+            print(f'Batch size for {key}: {entry["batch_size"]}')
+        return max(1, min(entry['batch_size'], limit))
+
+    def _load(self):
+        if self.cache is None:
+            self.cache = {}
+            if os.path.exists(self.cache_path):
+                try:
+                    with open(self.cache_path) as f:
+                        data = json.load(f)
+                    if data.get('version') == AUTOTUNE_VERSION:
+                        self.cache = data['batch_sizes']
+                except Exception as e:
+                    print(f'Could not read {self.cache_path}, batch sizes will be tuned again. Exception: {str(e)}')
+        return self.cache
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with open(f'{self.cache_path}.tmp', 'w') as f:
+            json.dump({'version': AUTOTUNE_VERSION, 'batch_sizes': self.cache}, f, indent=2, sort_keys=True)
+        os.replace(f'{self.cache_path}.tmp', self.cache_path)
+
+
+def _measure(probe, n, device_sync):
+    """Seconds per item of a batch of n, None if it does not fit in memory"""
+    try:
+        start = time.perf_counter()
+        probe(n)
+        device_sync()
+        return (time.perf_counter() - start) / n
+    except Exception as e:
+        if not is_out_of_memory(e):
+            raise
+        return None
+    finally:
+        free_memory()
+
+
+def tune_batch_size(probe, limit, safety_margin=SAFETY_MARGIN, plateau=PLATEAU):
+    """Returns the cache entry: the batch size to use, the largest batch size tested, and whether the search was
+    stopped by the limit (rather than by memory or the throughput plateau)"""
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+    if _measure(probe, 1, sync) is None:  # Warm-up, not timed
+        return {'batch_size': 1, 'tested': 1, 'limited': False}
+    fits, best_time = 1, _measure(probe, 1, sync)
+    while fits < limit:
+        n = min(fits * 2, limit)
+        seconds = _measure(probe, n, sync)
+        if seconds is None:
+            break
+        if seconds * (1 + plateau) > best_time:
+            # Larger batches only cost memory
+            return {'batch_size': fits, 'tested': n, 'limited': False}
+        fits, best_time = n, seconds
+    else:
+        return {'batch_size': fits, 'tested': fits, 'limited': True}
+    # Out of memory at n: bisect between the largest batch that fitted and n
+    low, high = fits, n
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _measure(probe, middle, sync) is None:
+            high = middle
+        else:
+            low = middle
+    return {'batch_size': max(1, int(low * (1 - safety_margin))), 'tested': high, 'limited': False}
@@ -0,0 +1,364 @@
+import hashlib
+import io
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+from PIL import Image
+
+from src import backbone
+from src.async_io import PrefetchingLoader, AsyncWriter
+from src.profiling import profiler
+from src.core import core_generation_funnel, CoreGenerationFunnelInp, release_models
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff']
+MANIFEST_NAME = 'depthmap_manifest.jsonl'
+LEASES_DIR = '.depthmap_leases'  # In the output directory, used by the distributed mode
+RECORDS_DIR = '.depthmap_records'
+
+
+def iter_input_files(input_dir, exclude_dir=None):
+    """Lazily walks the input tree, yields paths of the images in a stable order"""
+    exclude_dir = os.path.abspath(exclude_dir) if exclude_dir is not None else None
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted([d for d in dirs if not d.startswith('.') and
+                          os.path.abspath(os.path.join(root, d)) != exclude_dir])
+        for fn in sorted(files):
+            if not fn.startswith('.') and Path(fn).suffix.lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, fn)
+
+
+def get_options_hash(inp, ops):
+    values = {'inp': CoreGenerationFunnelInp(inp).values, 'ops': ops}
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """Append-only record of the finished files. Every line is a JSON object:
+    {"input": relative path, "input_hash": ..., "options_hash": ..., "outputs": [...], "time": ...}
+    and the metadata of the generation, if there is any (e.g. "oom_recovery": the rung that recovered the image).
+    Inputs that failed have an "error" and are processed again by the next run.
+    If the same input occurs more than once, the last record wins."""
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.done[record['input']] = record
+                    except (ValueError, KeyError):
+                        pass  # Partially written line of an interrupted run
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def is_done(self, rel_path, input_hash, options_hash):
+        record = self.done.get(rel_path)
+        return record is not None and 'error' not in record and record['input_hash'] == input_hash and \
+            record['options_hash'] == options_hash and all([os.path.exists(x) for x in record['outputs']])
+
+    def add(self, rel_path, input_hash, options_hash, outputs, metadata=None):
+        record = {'input': rel_path, 'input_hash': input_hash, 'options_hash': options_hash,
+                  'outputs': outputs, 'time': time.time(), **(metadata or {})}
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.done[rel_path] = record
+
+    def close(self):
+        self.file.close()
+
+
+class LeasedManifest:
+    """Manifest shared by any number of workers (processes, possibly on different hosts) through the filesystem.
+    A worker claims an input by creating its lease file exclusively. Leases are kept alive by a heartbeat thread
+    that touches them, a lease that was not touched for `expiry` seconds belongs to a dead worker and is reclaimed.
+    Finished inputs get a record file (same contents as a line of Manifest, but the outputs are relative to the output
+    directory), written atomically before the lease is released. Races (e.g. a worker that stalled longer than `expiry`) can only cause an input to be processed twice,
+    outputs are written atomically and are the same every time."""
+    def __init__(self, output_dir, worker_id=None, expiry=120, heartbeat=20):
+        assert heartbeat < expiry, 'Leases have to be touched more often than they expire'
+        self.output_dir = output_dir
+        self.leases_dir = os.path.join(output_dir, LEASES_DIR)
+        self.records_dir = os.path.join(output_dir, RECORDS_DIR)
+        os.makedirs(self.leases_dir, exist_ok=True)
+        os.makedirs(self.records_dir, exist_ok=True)
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.expiry = expiry
+        self.heartbeat = heartbeat
+        self.held = {}  # rel_path: lease path
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._heartbeat_loop, name='depthmap-lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _key(rel_path):
+        return hashlib.sha256(rel_path.encode('utf-8')).hexdigest()[:32]
+
+    def _record_path(self, rel_path):
+        return os.path.join(self.records_dir, f'{self._key(rel_path)}.json')
+
+    def is_done(self, rel_path, input_hash, options_hash):
+        try:
+            with open(self._record_path(rel_path), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return record.get('input') == rel_path and 'error' not in record and \
+            record.get('input_hash') == input_hash and record.get('options_hash') == options_hash and \
+            all([os.path.exists(os.path.join(self.output_dir, x)) for x in record['outputs']])
+
+    def claim(self, rel_path):
+        """True if this worker now holds the lease of the input, False if another worker does"""
+        path = os.path.join(self.leases_dir, f'{self._key(rel_path)}.lease')
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._reclaim_stale(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'worker': self.worker_id, 'input': rel_path, 'time': time.time()}, f)
+            with self.lock:
+                self.held[rel_path] = path
+            return True
+        return False
+
+    def _reclaim_stale(self, path):
+        """Removes the lease if it expired, returns True if the lease is gone"""
+        try:
+            if time.time() - os.stat(path).st_mtime < self.expiry:
+                return False
+            # Renaming is atomic, only one of the workers that found the lease stale succeeds
+            stale = f'{path}.{self.worker_id}.stale'
+            os.rename(path, stale)
+            os.remove(stale)
+            print(f'Reclaimed the expired lease {os.path.basename(path)}')
+        except FileNotFoundError:
+            pass  # Released or reclaimed by another worker in the meantime
+        return True
+
+    def _owns(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('worker') == self.worker_id
+        except (OSError, ValueError):
+            return False
+
+    def _heartbeat_loop(self):
+        while not self.stopped.wait(self.heartbeat):
+            with self.lock:
+                held = list(self.held.items())
+            for rel_path, path in held:
+                if self._owns(path):
+                    try:
+                        os.utime(path)
+                        continue
+                    except FileNotFoundError:
+                        pass
+                print(f'WARNING: lost the lease of {rel_path}, it may be processed by another worker too')
+                with self.lock:
+                    self.held.pop(rel_path, None)
+
+    def release(self, rel_path):
+        with self.lock:
+            path = self.held.pop(rel_path, None)
+        if path is not None and self._owns(path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def add(self, rel_path, input_hash, options_hash, outputs, metadata=None):
+        # Relative to the output directory, the hosts may mount the shared filesystem at different paths
+        outputs = [os.path.relpath(x, self.output_dir).replace(os.sep, '/') for x in outputs]
+        record = {'input': rel_path, 'input_hash': input_hash, 'options_hash': options_hash,
+                  'outputs': outputs, 'time': time.time(), 'worker': self.worker_id, **(metadata or {})}
+        path = self._record_path(rel_path)
+        with open(f'{path}.{self.worker_id}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        os.replace(f'{path}.{self.worker_id}.tmp', path)
+        self.release(rel_path)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            held = list(self.held)
+        for rel_path in held:
+            self.release(rel_path)
+
+
+def save_result(result, out_dir, stem, type, compress_level=None, labels=None):
+    """Saves a result with a deterministic filename, returns the filename.
+    Depthmaps are saved as {stem}.png, so they can be reused as custom depthmaps by the Batch from Directory mode"""
+    os.makedirs(out_dir, exist_ok=True)
+    suffix = '' if type == 'depth' else f'-{type}'
+    fn = os.path.join(out_dir, f'{stem}{suffix}.png')
+    kwargs = {} if compress_level is None else {'compress_level': compress_level}
+    # Written under a temporary name, so that an interrupted write (or a concurrent worker) never leaves a broken file
+    tmp_fn = f'{fn}.{uuid.uuid4().hex[:8]}.tmp'
+    with profiler.stage('encode', concurrent=True, **(labels or {})):
+        result.save(tmp_fn, format='png', **kwargs)
+    os.replace(tmp_fn, fn)
+    return fn
+
+
+def run_batch(input_dir, output_dir, inp, ops=None, chunk_size=16, force=False,
+              prefetch=16, workers=2, compress_level=None, distributed=False, worker_id=None, lease_expiry=120,
+              heartbeat=20):
+    """Headless batch processing of a directory tree. Output directory mirrors the input tree.
+    Files are processed in chunks of chunk_size, so only a bounded number of images is held in memory.
+    Up to prefetch files are read and decoded ahead on a thread pool, outputs are encoded and written on another
+    one (workers threads each), so that the model does not wait for the codecs or the disk.
+    Finished files are recorded in the manifest once all their outputs are written,
+    an interrupted run resumes where it stopped.
+    With distributed, any number of workers may process the same directories (on a shared filesystem) at once:
+    the files are claimed through leases (see LeasedManifest), a worker returns once every file is done."""
+    assert os.path.abspath(input_dir) != os.path.abspath(output_dir), 'Input and output directories must differ'
+    assert not (distributed and force), 'Workers of the distributed mode would redo each other\'s files, ' \
+                                        f'delete {RECORDS_DIR} in the output directory instead of forcing'
+    if ops is None:
+        ops = backbone.gather_ops()
+    os.makedirs(output_dir, exist_ok=True)
+    options_hash = get_options_hash(inp, ops)
+    if distributed:
+        manifest = LeasedManifest(output_dir, worker_id, lease_expiry, heartbeat)
+        print(f'Distributed batch, worker {manifest.worker_id}')
+    else:
+        manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    processed = skipped = failed = 0
+    busy = set()  # Paths claimed by other workers in the current pass
+
+    def prepare(path):
+        """Runs on the prefetch pool. Returns (path, rel_path, input_hash, image or None if already done, error)"""
+        rel_path = os.path.relpath(path, input_dir).replace(os.sep, '/')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            input_hash = hashlib.sha256(data).hexdigest()
+            if not force and manifest.is_done(rel_path, input_hash, options_hash):
+                return path, rel_path, input_hash, None, None
+            if distributed:
+                if not manifest.claim(rel_path):
+                    busy.add(path)
+                    return path, rel_path, input_hash, None, None
+                if manifest.is_done(rel_path, input_hash, options_hash):  # Finished just before the claim
+                    manifest.release(rel_path)
+                    return path, rel_path, input_hash, None, None
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            return path, rel_path, input_hash, image, None
+        except Exception as e:
+            return path, rel_path, None, None, e
+    # (global index, rel_path, input_hash) of the inputs that are fully processed, but may still have outputs queued
+    finished_inputs = deque()
+    outputs = {}
+    metadata = {}
+
+    def commit_written(writer):
+        for i, fn in writer.poll():
+            outputs[i] += [fn]
+        oldest = writer.oldest_pending_tag()
+        while len(finished_inputs) > 0 and (oldest is None or finished_inputs[0][0] < oldest):
+            i, rel_path, input_hash = finished_inputs.popleft()
+            # An input that was retried alone may have written some of its outputs twice
+            manifest.add(rel_path, input_hash, options_hash, list(dict.fromkeys(outputs.pop(i))),
+                         metadata.pop(i, None))
+
+    def process_chunk(chunk, writer):
+        """Runs the funnel over the chunk. If it fails, the inputs that finished are kept, the input that was being
+        processed is retried alone to find out whether it is the culprit, and the rest of the chunk is resumed.
+        An input that fails alone is recorded as failed in the manifest."""
+        nonlocal processed, failed
+        done, alone = 0, False
+        while done < len(chunk):
+            part = chunk[done:done + 1] if alone else chunk[done:]
+            last_i = 0
+            try:
+                for input_i, type, result in core_generation_funnel(output_dir, [x[3] for x in part], None,
+                                                                    [x[1] for x in part], inp, ops, offload=False):
+                    # Results come in order, so all the outputs of the previous inputs are submitted
+                    while last_i < input_i:
+                        finished_inputs.append((part[last_i][0], part[last_i][2], part[last_i][4]))
+                        last_i += 1
+                    global_i = part[input_i][0]
+                    if isinstance(result, Image.Image):
+                        rel_dir = os.path.dirname(part[input_i][2])
+                        stem = Path(part[input_i][2]).stem
+                        writer.submit(global_i, save_result, result, os.path.join(output_dir, rel_dir), stem, type,
+                                      compress_level, profiler.get_labels())
+                    elif isinstance(result, str):
+                        outputs[global_i] += [result]  # Meshes are saved by the funnel itself
+                    elif isinstance(result, dict):
+                        metadata.setdefault(global_i, {}).update(result)
+                    commit_written(writer)
+            except Exception as e:
+                done += last_i
+                processed += last_i
+                if len(part) > 1:
+                    # part[last_i] may have failed, or it may have finished and a later input failed before
+                    # producing anything
+                    alone = True
+                    continue
+                print(f'Failed to process {part[0][1]}, ignoring. Exception: {str(e)}')
+                metadata.setdefault(part[0][0], {})['error'] = str(e)
+                finished_inputs.append((part[0][0], part[0][2], part[0][4]))
+                failed += 1
+                done += 1
+                alone = False
+                continue
+            while last_i < len(part):
+                finished_inputs.append((part[last_i][0], part[last_i][2], part[last_i][4]))
+                last_i += 1
+            done += len(part)
+            processed += len(part)
+            alone = False
+        commit_written(writer)
+
+    paths = list(iter_input_files(input_dir, exclude_dir=output_dir))
+    try:
+        while True:
+            with PrefetchingLoader(paths, prepare, prefetch=prefetch, workers=workers) as loader, \
+                    AsyncWriter(workers=workers, max_pending=max(1, chunk_size)) as writer:
+                chunk = []
+                for global_i, (path, rel_path, input_hash, image, error) in enumerate(loader):
+                    if error is not None:
+                        print(f'Failed to load {path}, ignoring. Exception: {str(error)}')
+                        failed += 1
+                        if distributed:
+                            manifest.release(rel_path)
+                        continue
+                    if image is None:
+                        if path not in busy:
+                            skipped += 1
+                        continue
+                    outputs[global_i] = []
+                    chunk += [(global_i, path, rel_path, image, input_hash)]
+                    if len(chunk) >= chunk_size:
+                        process_chunk(chunk, writer)
+                        chunk = []
+                        print(f'Batch: {processed} processed, {skipped} skipped, {failed} failed')
+                if len(chunk) > 0:
+                    process_chunk(chunk, writer)
+                for i, fn in writer.drain():
+                    outputs[i] += [fn]
+                commit_written(writer)
+            if len(busy) == 0:
+                break
+            # Wait for the other workers: their files get done, or their leases expire and are reclaimed
+            paths = [x for x in paths if x in busy]
+            busy.clear()
+            print(f'Batch: {len(paths)} file(s) claimed by other workers, waiting ..')
+            time.sleep(heartbeat)
+    finally:
+        manifest.close()
+        release_models()
+    print(f'Batch done: {processed} processed, {skipped} skipped (already done), {failed} failed')
+    return processed, skipped, failed
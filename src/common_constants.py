@@ -16,17 +16,28 @@ class GenerationOptions(enum.Enum):
         self.df = default_value
 
     COMPUTE_DEVICE = "GPU"
+    INFERENCE_BACKEND = "torch"  # "onnxruntime" is used for the supported models on CPU
+    CPU_QUANTIZATION = "none"  # "int8" is used for the supported models on CPU
     MODEL_TYPE = "res101"  # Will become enum element
     BOOST = True
+    BOOST_PRECISION = "fp32"  # Of the networks in BOOST: "fp32", "fp16" or "bf16" (autocast)
+    BOOST_PRECISION_VALIDATE = False  # Also compute the fp32 result and report the difference
     NET_SIZE_MATCH = False
     NET_WIDTH = 448
     NET_HEIGHT = 448
+    DEPTH_UPSAMPLING = "bicubic"  # From the net size to the input size: "bicubic" or "guided" (edge-aware)
+    ZOEDEPTH_TTA = "flip+pad"  # Test-time augmentation of ZoeDepth models: "none", "flip" or "flip+pad"
+    # Tried in this order when an image runs out of memory, every step keeps the previous ones. [] fails the batch.
+    # Only the steps that do not change the result are on by default: "tiled", "net_size", "boost_off", "cpu" are opt-in
+    OOM_RECOVERY = ["free_caches", "half_batch"]
 
     DO_OUTPUT_DEPTH = True
     OUTPUT_DEPTH_INVERT = False
     OUTPUT_DEPTH_COMBINE = False
     OUTPUT_DEPTH_COMBINE_AXIS = "Horizontal"  # Format (str) is subject to change
     DO_OUTPUT_DEPTH_PREDICTION = False  # Hidden, do not use, subject to change
+    VIDEO_TEMPORAL_WARM_START = False  # Hidden, do not use, subject to change
+    VIDEO_TEMPORAL_RESETS = []  # Hidden, do not use, subject to change. Inputs that are not warm-started
 
     CLIPDEPTH = False
     CLIPDEPTH_MODE = "Range"
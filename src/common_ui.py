@@ -3,10 +3,12 @@ from pathlib import Path
 import gradio as gr
 from PIL import Image
 
-from src import backbone, video_mode
+from src import backbone, video_mode, video_interpolation
 from src.core import core_generation_funnel, unload_models, run_makevideo
 from src.depthmap_generation import ModelHolder
 from src.gradio_args_transport import GradioComponentBundle
+from src.async_io import PrefetchingLoader, AsyncWriter
+from src.profiling import profiler
 from src.misc import *
 from src.common_constants import GenerationOptions as go
 
@@ -31,6 +33,9 @@ def main_ui_panel(is_depth_tab):
         with gr.Row() as cur_option_root:
             inp -= 'depthmap_gen_row_0', cur_option_root
             inp += go.COMPUTE_DEVICE, gr.Radio(label="Compute on", choices=['GPU', 'CPU'], value='GPU')
+            inp += go.INFERENCE_BACKEND, gr.Radio(label="CPU inference backend", choices=['torch', 'onnxruntime'],
+                                                  value='torch')
+            inp += go.CPU_QUANTIZATION, gr.Radio(label="CPU quantization", choices=['none', 'int8'], value='none')
             # TODO: Should return value instead of index. Maybe Enum should be used?
             inp += go.MODEL_TYPE, gr.Dropdown(label="Model",
                                              choices=['res101', 'dpt_beit_large_512 (midas 3.1)',
@@ -45,9 +50,20 @@ def main_ui_panel(is_depth_tab):
             with gr.Row():
                 inp += go.BOOST, gr.Checkbox(label="BOOST (multi-resolution merging)")
                 inp += go.NET_SIZE_MATCH, gr.Checkbox(label="Match net size to input size", visible=False)
+                inp += go.ZOEDEPTH_TTA, gr.Dropdown(label="ZoeDepth test-time augmentation",
+                                                    choices=['none', 'flip', 'flip+pad'])
+            with gr.Row() as options_depend_on_boost:
+                inp += go.BOOST_PRECISION, gr.Radio(label="BOOST precision", choices=['fp32', 'fp16', 'bf16'])
+                inp += go.BOOST_PRECISION_VALIDATE, gr.Checkbox(label="Compare with fp32 (twice slower)")
             with gr.Row(visible=False) as options_depend_on_match_size:
                 inp += go.NET_WIDTH, gr.Slider(minimum=64, maximum=2048, step=64, label='Net width')
                 inp += go.NET_HEIGHT, gr.Slider(minimum=64, maximum=2048, step=64, label='Net height')
+                inp += go.DEPTH_UPSAMPLING, gr.Radio(label="Upsampling to the input size",
+                                                     choices=['bicubic', 'guided'])
+            with gr.Row():
+                inp += go.OOM_RECOVERY, gr.CheckboxGroup(
+                    ["free_caches", "half_batch", "tiled", "net_size", "boost_off", "cpu"],
+                    label="Out of memory recovery (tried in this order, instead of failing the batch)")
 
         with gr.Box() as cur_option_root:
             inp -= 'depthmap_gen_row_2', cur_option_root
@@ -156,7 +172,7 @@ def main_ui_panel(is_depth_tab):
                         choices=['u2net', 'u2netp', 'u2net_human_seg', 'silueta', "isnet-general-use", "isnet-anime"])
 
         with gr.Box():
-            gr.HTML(f"{SCRIPT_FULL_NAME}<br/>")
+            gr.HTML(f"{get_script_full_name()}<br/>")
             gr.HTML("Information, comment and share @ <a "
                     "href='https://github.com/thygate/stable-diffusion-webui-depthmap-script'>"
                     "https://github.com/thygate/stable-diffusion-webui-depthmap-script</a>")
@@ -178,6 +194,7 @@ def main_ui_panel(is_depth_tab):
             outputs=[inp[go.NET_SIZE_MATCH], options_depend_on_match_size]
         )
         inp.add_rule(options_depend_on_match_size, 'visible-if-not', go.NET_SIZE_MATCH)
+        inp.add_rule(options_depend_on_boost, 'visible-if', go.BOOST)
 
         inp.add_rule(options_depend_on_output_depth_1, 'visible-if', go.DO_OUTPUT_DEPTH)
         inp.add_rule(go.OUTPUT_DEPTH_INVERT, 'visible-if', go.DO_OUTPUT_DEPTH)
@@ -237,7 +254,18 @@ def depthmap_mode_video(inp):
     inp += gr.Checkbox(elem_id="depthmap_vm_custom_checkbox",
                        label="Use custom/pregenerated DepthMap video", value=False)
     inp += gr.Dropdown(elem_id="depthmap_vm_smoothening_mode", label="Smoothening",
-                       type="value", choices=['none', 'experimental'], value='experimental')
+                       type="value", choices=['none', 'experimental', 'experimental (causal)'],
+                       value='experimental')
+    inp += gr.Checkbox(elem_id="depthmap_vm_detect_cuts", label="Detect scene cuts", value=True)
+    with gr.Row():
+        inp += gr.Slider(elem_id='depthmap_vm_keyframe_interval', label="Run the model on every N-th frame",
+                         minimum=1, value=1, maximum=12, step=1)
+        inp += gr.Slider(elem_id='depthmap_vm_keyframe_threshold',
+                         label="Also run the model when the frame changes by more than (0 = disable)",
+                         minimum=0.0, value=0.0, maximum=0.25, step=0.005, visible=False)
+        inp += gr.Dropdown(elem_id='depthmap_vm_interpolation', label="Interpolation between keyframes",
+                           type="value", choices=video_interpolation.INTERPOLATION_MODES,
+                           value=video_interpolation.INTERPOLATION_MODES[0], visible=False)
     inp += gr.File(elem_id='depthmap_vm_custom', file_count="single",
                    interactive=True, type="file", visible=False)
     with gr.Row():
@@ -247,6 +275,14 @@ def depthmap_mode_video(inp):
 
     inp.add_rule('depthmap_vm_custom', 'visible-if', 'depthmap_vm_custom_checkbox')
     inp.add_rule('depthmap_vm_smoothening_mode', 'visible-if-not', 'depthmap_vm_custom_checkbox')
+    inp.add_rule('depthmap_vm_detect_cuts', 'visible-if-not', 'depthmap_vm_custom_checkbox')
+    inp.add_rule('depthmap_vm_keyframe_interval', 'visible-if-not', 'depthmap_vm_custom_checkbox')
+    inp['depthmap_vm_keyframe_interval'].change(
+        fn=lambda n: (inp['depthmap_vm_keyframe_threshold'].update(visible=n > 1),
+                      inp['depthmap_vm_interpolation'].update(visible=n > 1)),
+        inputs=[inp['depthmap_vm_keyframe_interval']],
+        outputs=[inp['depthmap_vm_keyframe_threshold'], inp['depthmap_vm_interpolation']]
+    )
     inp.add_rule('depthmap_vm_compress_bitrate', 'visible-if', 'depthmap_vm_compress_checkbox')
 
     return inp
@@ -433,6 +469,20 @@ def format_exception(e: Exception):
     return msg
 
 
+def save_output_image(result, outpath, basename, suffix, labels=None):
+    try:
+        with profiler.stage('encode', concurrent=True, **(labels or {})):
+            backbone.save_image(result, path=outpath, basename=basename, seed=None,
+                                prompt=None, extension=backbone.get_opt('samples_format', 'png'),
+                                short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras",
+                                suffix=suffix)
+    except Exception as e:
+        if not ('image has wrong mode' in str(e) or 'I;16' in str(e)):
+            raise e
+        print('Catched exception: image has wrong mode!')
+        traceback.print_exc()
+
+
 def run_generate(*inputs):
     inputs = GradioComponentBundle.enkey_to_dict(inputs)
     depthmap_mode = inputs['depthmap_mode']
@@ -456,7 +506,9 @@ def run_generate(*inputs):
                 if inputs['depthmap_vm_compress_checkbox'] else None
             ret = video_mode.gen_video(
                 inputs['depthmap_vm_input'], backbone.get_outpath(), inputs, custom_depthmap, colorvids_bitrate,
-                inputs['depthmap_vm_smoothening_mode'])
+                inputs['depthmap_vm_smoothening_mode'], inputs['depthmap_vm_detect_cuts'],
+                inputs['depthmap_vm_keyframe_interval'], inputs['depthmap_vm_keyframe_threshold'],
+                inputs['depthmap_vm_interpolation'])
             return [], None, None, ret
         except Exception as e:
             ret = format_exception(e)
@@ -495,9 +547,12 @@ def run_generate(*inputs):
         if depthmap_batch_input_dir == depthmap_batch_output_dir:
             return [], None, None, "Please pick different directories for batch processing."
         image_list = backbone.listfiles(depthmap_batch_input_dir)
+        loadable_paths = []
         for path in image_list:
             try:
-                inputimages.append(Image.open(path))
+                with Image.open(path):
+                    pass  # Only the header is read here, images are decoded ahead of the model by the loader
+                loadable_paths.append(path)
                 inputnames.append(path)
 
                 custom_depthmap = None
@@ -517,6 +572,7 @@ def run_generate(*inputs):
                 inputdepthmaps.append(custom_depthmap)
             except Exception as e:
                 print(f'Failed to load {path}, ignoring. Exception: {str(e)}')
+        inputimages = PrefetchingLoader(loadable_paths)
         inputdepthmaps_n = len([1 for x in inputdepthmaps if x is not None])
         print(f'{len(inputimages)} images will be processed, {inputdepthmaps_n} existing depthmaps will be reused')
 
@@ -527,6 +583,9 @@ def run_generate(*inputs):
     results_total = 0
     inpainted_mesh_fi = mesh_simple_fi = None
     msg = ""  # Empty string is never returned
+    # Encoding and writing happens on a writer thread, while the model works on the next image.
+    # A single one: the WebUI picks the file names by looking at the existing files, concurrent saves could collide
+    writer = AsyncWriter(workers=1)
     while True:
         try:
             input_i, type, result = next(gen_obj)
@@ -545,6 +604,8 @@ def run_generate(*inputs):
         if type == 'inpainted_mesh':
             inpainted_mesh_fi = result
             continue
+        if type == 'metadata':  # Only recorded by the headless batch mode
+            continue
         if not isinstance(result, Image.Image):
             print(f'This is not supposed to happen! Somehow output type {type} is not supported! Input_i: {input_i}.')
             continue
@@ -557,15 +618,18 @@ def run_generate(*inputs):
                     if outpath != backbone.get_opt('outdir_extras_samples', None):
                         basename = Path(inputnames[input_i]).stem
                 suffix = "" if type == "depth" else f"{type}"
-                backbone.save_image(result, path=outpath, basename=basename, seed=None,
-                           prompt=None, extension=backbone.get_opt('samples_format', 'png'), short_filename=True,
-                           no_prompt=True, grid=False, pnginfo_section_name="extras",
-                           suffix=suffix)
+                writer.submit(input_i, save_output_image, result, outpath, basename, suffix, profiler.get_labels())
+                for _ in writer.poll():
+                    pass
             except Exception as e:
-                if not ('image has wrong mode' in str(e) or 'I;16' in str(e)):
-                    raise e
-                print('Catched exception: image has wrong mode!')
-                traceback.print_exc()
+                msg = format_exception(e)
+                break
+    try:
+        writer.close()
+    except Exception as e:
+        msg = format_exception(e)
+    if isinstance(inputimages, PrefetchingLoader):
+        inputimages.close()
 
     # Deciding what mesh to display (and if)
     display_mesh_fi = None
@@ -18,16 +18,12 @@ import math
 from src.misc import *
 from src.common_constants import GenerationOptions as go
 from src.common_constants import *
-from src.stereoimage_generation import create_stereoimages
 from src.normalmap_generation import create_normalmap
 from src.depthmap_generation import ModelHolder
+from src.quantization import CALIBRATION_IMAGES
 from src import backbone
-
-# 3d-photo-inpainting imports
-from inpaint.mesh import write_mesh, read_mesh, output_3d_photo
-from inpaint.networks import Inpaint_Color_Net, Inpaint_Depth_Net, Inpaint_Edge_Net
-from inpaint.utils import path_planning
-from inpaint.bilateral_filtering import sparse_bilateral_filtering
+from src.profiling import profiler, resolution_bucket
+from src.oom_recovery import OomRecoveryLadder, OOM_RECOVERY_RUNGS
 
 global video_mesh_data, video_mesh_fn
 video_mesh_data = None
@@ -75,21 +71,37 @@ class CoreGenerationFunnelInp:
         return self[item]
 
 
-def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp, ops=None):
+def release_models():
+    """Frees the VRAM once the generation is over"""
+    if backbone.get_opt('depthmap_script_keepmodels', True):
+        model_holder.offload()  # Swap to CPU memory
+    else:
+        model_holder.unload_models()
+    gc.collect()
+    backbone.torch_gc()
+
+
+def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp, ops=None, offload=True):
+    """Without offload, the models stay where they are after the generation, for callers that run the funnel
+    repeatedly (they should call release_models when they are done)"""
     if len(inputimages) == 0 or inputimages[0] is None:
         return
     if inputdepthmaps is None or len(inputdepthmaps) == 0:
         inputdepthmaps: list[Image] = [None for _ in range(len(inputimages))]
-    inputdepthmaps_complete = all([x is not None for x in inputdepthmaps])
+    # Lazy sequences (like depthmap video readers) never contain None and should not be decoded twice
+    inputdepthmaps_complete = not isinstance(inputdepthmaps, list) or all([x is not None for x in inputdepthmaps])
 
     inp = CoreGenerationFunnelInp(inp)
 
     if ops is None:
         ops = backbone.gather_ops()
     model_holder.update_settings(**ops)
+    model_holder.update_settings(zoedepth_tta=inp[go.ZOEDEPTH_TTA], boost_precision=inp[go.BOOST_PRECISION],
+                                 boost_precision_validate=inp[go.BOOST_PRECISION_VALIDATE],
+                                 depth_upsampling=inp[go.DEPTH_UPSAMPLING])
 
     # TODO: ideally, run_depthmap should not save meshes - that makes the function not pure
-    print(SCRIPT_FULL_NAME)
+    print(get_script_full_name())
 
     backbone.unload_sd_model()
 
@@ -118,17 +130,37 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
     inpaint_imgs = []
     inpaint_depths = []
 
+    def load_models(load_device=None, boost=None):
+        """None stands for the value of the generation options"""
+        model_holder.ensure_models(inp[go.MODEL_TYPE], device if load_device is None else load_device,
+                                   inp[go.BOOST] if boost is None else boost, inp[go.CPU_QUANTIZATION],
+                                   lambda: [inputimages[i] for i in
+                                            range(min(CALIBRATION_IMAGES, len(inputimages)))])
+        model_holder.set_inference_backend(inp[go.INFERENCE_BACKEND])
+    oom_recovery = OomRecoveryLadder(model_holder, inp[go.OOM_RECOVERY], load_models)
+
     try:
         if not inputdepthmaps_complete:
             print("Loading model(s) ..")
-            model_holder.ensure_models(inp[go.MODEL_TYPE], device, inp[go.BOOST])
+            load_models()
+            if not inp[go.NET_SIZE_MATCH]:
+                # Batches and videos usually consist of images of the same size
+                model_holder.warmup_caches([(inputimages[0].width, inputimages[0].height)],
+                                           inp[go.NET_WIDTH], inp[go.NET_HEIGHT])
         print("Computing output(s) ..")
+        model_holder.reset_temporal_state()
+        temporal_resets = set(inp[go.VIDEO_TEMPORAL_RESETS])
         # iterate over input images
         for count in trange(0, len(inputimages)):
-            # Convert single channel input (PIL) images to rgb
-            if inputimages[count].mode == 'I':
-                inputimages[count].point(lambda p: p * 0.0039063096, mode='RGB')
-                inputimages[count] = inputimages[count].convert('RGB')
+            if count in temporal_resets:  # A scene cut, or the previous input is not the previous frame
+                model_holder.reset_temporal_state()
+            with profiler.stage('decode', model_type=inp[go.MODEL_TYPE]):
+                # Convert single channel input (PIL) images to rgb
+                if inputimages[count].mode == 'I':
+                    inputimages[count].point(lambda p: p * 0.0039063096, mode='RGB')
+                    inputimages[count] = inputimages[count].convert('RGB')
+            profiler.set_labels(model_type=inp[go.MODEL_TYPE],
+                                resolution=resolution_bucket(inputimages[count].width, inputimages[count].height))
 
             raw_prediction = None
             """Raw prediction, as returned by a model. None if input depthmap is used."""
@@ -163,7 +195,10 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
                         out /= 256.0
                 else:
                     # Should be in interval [0; 1], values outside of this range will be clipped.
+                    # Integer arrays (e.g. frames of a 16-bit depthmap video) are scaled according to their type.
                     out = np.asarray(dp, dtype="float")
+                    if isinstance(dp, np.ndarray) and np.issubdtype(dp.dtype, np.integer):
+                        out /= 2.0 ** (8 * dp.dtype.itemsize)
                     assert inputimages[count].height == out.shape[0], "Custom depthmap height mismatch"
                     assert inputimages[count].width == out.shape[1], "Custom depthmap width mismatch"
             else:
@@ -175,8 +210,12 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
                 else:
                     net_width = inp[go.NET_WIDTH]
                     net_height = inp[go.NET_HEIGHT]
-                raw_prediction, raw_prediction_invert = \
-                    model_holder.get_raw_prediction(inputimages[count], net_width, net_height)
+                raw_prediction, raw_prediction_invert, recovery = \
+                    oom_recovery.get_raw_prediction(inputimages[count], net_width, net_height,
+                                                    inp[go.VIDEO_TEMPORAL_WARM_START])
+                if recovery is not None:
+                    profiler.count(f'oom_recovery_{recovery}')
+                    yield count, 'metadata', {'oom_recovery': recovery}
 
                 # output
                 if abs(raw_prediction.max() - raw_prediction.min()) > np.finfo("float").eps:
@@ -186,14 +225,16 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
                         out *= -1
                     if inp[go.DO_OUTPUT_DEPTH_PREDICTION]:
                         yield count, 'depth_prediction', np.copy(out)
-                    if inp[go.CLIPDEPTH]:
-                        if inp[go.CLIPDEPTH_MODE] == 'Range':
-                            out = (out - out.min()) / (out.max() - out.min())  # normalize to [0; 1]
-                            out = np.clip(out, inp[go.CLIPDEPTH_FAR], inp[go.CLIPDEPTH_NEAR])
-                        elif inp[go.CLIPDEPTH_MODE] == 'Outliers':
-                            fb, nb = np.percentile(out, [inp[go.CLIPDEPTH_FAR] * 100.0, inp[go.CLIPDEPTH_NEAR] * 100.0])
-                            out = np.clip(out, fb, nb)
-                    out = (out - out.min()) / (out.max() - out.min())  # normalize to [0; 1]
+                    with profiler.stage('normalize'):
+                        if inp[go.CLIPDEPTH]:
+                            if inp[go.CLIPDEPTH_MODE] == 'Range':
+                                out = (out - out.min()) / (out.max() - out.min())  # normalize to [0; 1]
+                                out = np.clip(out, inp[go.CLIPDEPTH_FAR], inp[go.CLIPDEPTH_NEAR])
+                            elif inp[go.CLIPDEPTH_MODE] == 'Outliers':
+                                fb, nb = np.percentile(out, [inp[go.CLIPDEPTH_FAR] * 100.0,
+                                                             inp[go.CLIPDEPTH_NEAR] * 100.0])
+                                out = np.clip(out, fb, nb)
+                        out = (out - out.min()) / (out.max() - out.min())  # normalize to [0; 1]
                 else:
                     # Regretfully, the depthmap is broken and will be replaced with a black image
                     out = np.zeros(raw_prediction.shape)
@@ -243,22 +284,25 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
 
             if inp[go.GEN_STEREO]:
                 # print("Generating stereoscopic image(s)..")
-                stereoimages = create_stereoimages(
-                    inputimages[count], img_output,
-                    inp[go.STEREO_DIVERGENCE], inp[go.STEREO_SEPARATION],
-                    inp[go.STEREO_MODES],
-                    inp[go.STEREO_BALANCE], inp[go.STEREO_OFFSET_EXPONENT], inp[go.STEREO_FILL_ALGO])
+                from src.stereoimage_generation import create_stereoimages  # Imports numba, which is slow
+                with profiler.stage('stereo'):
+                    stereoimages = create_stereoimages(
+                        inputimages[count], img_output,
+                        inp[go.STEREO_DIVERGENCE], inp[go.STEREO_SEPARATION],
+                        inp[go.STEREO_MODES],
+                        inp[go.STEREO_BALANCE], inp[go.STEREO_OFFSET_EXPONENT], inp[go.STEREO_FILL_ALGO])
                 for c in range(0, len(stereoimages)):
                     yield count, inp[go.STEREO_MODES][c], stereoimages[c]
 
             if inp[go.GEN_NORMALMAP]:
-                normalmap = create_normalmap(
-                    img_output,
-                    inp[go.NORMALMAP_PRE_BLUR_KERNEL] if inp[go.NORMALMAP_PRE_BLUR] else None,
-                    inp[go.NORMALMAP_SOBEL_KERNEL] if inp[go.NORMALMAP_SOBEL] else None,
-                    inp[go.NORMALMAP_POST_BLUR_KERNEL] if inp[go.NORMALMAP_POST_BLUR] else None,
-                    inp[go.NORMALMAP_INVERT]
-                )
+                with profiler.stage('normalmap'):
+                    normalmap = create_normalmap(
+                        img_output,
+                        inp[go.NORMALMAP_PRE_BLUR_KERNEL] if inp[go.NORMALMAP_PRE_BLUR] else None,
+                        inp[go.NORMALMAP_SOBEL_KERNEL] if inp[go.NORMALMAP_SOBEL] else None,
+                        inp[go.NORMALMAP_POST_BLUR_KERNEL] if inp[go.NORMALMAP_POST_BLUR] else None,
+                        inp[go.NORMALMAP_INVERT]
+                    )
                 yield count, 'normalmap', normalmap
 
             if inp[go.GEN_HEATMAP]:
@@ -292,15 +336,17 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
                     # offset
                     depthi = depthi + 1.0
 
-                mesh = create_mesh(inputimages[count], depthi, keep_edges=not inp[go.SIMPLE_MESH_OCCLUDE],
-                                   spherical=(inp[go.SIMPLE_MESH_SPHERICAL]))
-                mesh.export(meshsimple_fi)
+                with profiler.stage('mesh'):
+                    mesh = create_mesh(inputimages[count], depthi, keep_edges=not inp[go.SIMPLE_MESH_OCCLUDE],
+                                       spherical=(inp[go.SIMPLE_MESH_SPHERICAL]))
+                    mesh.export(meshsimple_fi)
                 yield count, 'simple_mesh', meshsimple_fi
 
         print("Computing output(s) done.")
     except Exception as e:
         import traceback
         if 'out of memory' in str(e).lower():
+            profiler.count('out_of_memory')
             print(str(e))
             suggestion = "out of GPU memory, could not generate depthmap! " \
                          "Here are some suggestions to work around this issue:\n"
@@ -315,25 +361,26 @@ def core_generation_funnel(outpath, inputimages, inputdepthmaps, inputnames, inp
                     " * Use a different model (generally, more memory-consuming models produce better depthmaps)\n"
             if not inp[go.BOOST]:
                 suggestion += " * Reduce net size (this could reduce quality)\n"
+            if len(inp[go.OOM_RECOVERY]) < len(OOM_RECOVERY_RUNGS):
+                suggestion += " * Enable more out of memory recovery steps (failing images are retried with lower " \
+                              "settings)\n"
             print('Fail.\n')
             raise Exception(suggestion)
         else:
             print('Fail.\n')
             raise e
     finally:
-        if backbone.get_opt('depthmap_script_keepmodels', True):
-            model_holder.offload()  # Swap to CPU memory
-        else:
-            model_holder.unload_models()
-        gc.collect()
-        backbone.torch_gc()
+        oom_recovery.restore(reload_models=False)
+        if offload:
+            release_models()
 
     # TODO: This should not be here
     if inp[go.GEN_INPAINTED_MESH]:
         try:
-            mesh_fi = run_3dphoto(device, inpaint_imgs, inpaint_depths, inputnames, outpath,
-                                  inp[go.GEN_INPAINTED_MESH_DEMOS],
-                                  1, "mp4")
+            with profiler.stage('inpainted_mesh', model_type=inp[go.MODEL_TYPE], resolution=''):
+                mesh_fi = run_3dphoto(device, inpaint_imgs, inpaint_depths, inputnames, outpath,
+                                      inp[go.GEN_INPAINTED_MESH_DEMOS],
+                                      1, "mp4")
             yield 0, 'inpainted_mesh', mesh_fi
         except Exception as e:
             print(f'{str(e)}, some issue with generating inpainted mesh')
@@ -356,6 +403,10 @@ def get_uniquefn(outpath, basename, ext, suffix=''):
 
 
 def run_3dphoto(device, img_rgb, img_depth, inputnames, outpath, gen_inpainted_mesh_demos, vid_ssaa, vid_format):
+    # 3d-photo-inpainting imports
+    from inpaint.mesh import write_mesh
+    from inpaint.networks import Inpaint_Color_Net, Inpaint_Depth_Net, Inpaint_Edge_Net
+    from inpaint.bilateral_filtering import sparse_bilateral_filtering
     mesh_fi = ''
     try:
         print("Running 3D Photo Inpainting .. ")
@@ -496,6 +547,8 @@ def run_3dphoto(device, img_rgb, img_depth, inputnames, outpath, gen_inpainted_m
 def run_3dphoto_videos(mesh_fi, basename, outpath, num_frames, fps, crop_border, traj_types, x_shift_range,
                        y_shift_range, z_shift_range, video_postfix, vid_dolly, vid_format, vid_ssaa):
     import vispy
+    from inpaint.mesh import read_mesh, output_3d_photo
+    from inpaint.utils import path_planning
     try:
         if platform.system() == 'Windows':
             vispy.use(app='PyQt5')
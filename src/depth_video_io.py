@@ -0,0 +1,138 @@
+# Reading and writing 16-bit depthmap videos without wrapping every frame into a Pillow object.
+# Depthmap videos are stored as lossless gray16le FFV1 with every frame being a keyframe, so that any frame
+# can be decoded without decoding the preceding ones. Frame count and geometry are saved into an index sidecar.
+import json
+import os
+
+import numpy as np
+
+
+def get_index_path(path):
+    return f"{path}.json"
+
+
+class DepthVideoWriter:
+    """Accepts uint16 arrays, or float arrays in the [0; 1] interval, straight from the pipeline.
+    Usage: with DepthVideoWriter(path, fps) as writer: writer.write(frame)"""
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.size = None
+        self.frame_count = 0
+        self.writer = None
+
+    def _open(self, size):
+        import imageio_ffmpeg
+        self.size = size
+        self.writer = imageio_ffmpeg.write_frames(
+            self.path, size, 'gray16le', 'gray16le', self.fps, codec='ffv1', macro_block_size=1,
+            output_params=['-g', '1'])  # Intra-only, this is what makes seeking cheap and exact
+        self.writer.send(None)
+
+    def write(self, frame):
+        frame = np.asarray(frame)
+        if frame.dtype != np.uint16:
+            # Same conversion as core.convert_to_i16
+            frame = np.clip(frame * 2 ** 16 + 0.0001, 0, 2 ** 16 - 0.1).astype(np.uint16)
+        size = (frame.shape[1], frame.shape[0])
+        if self.writer is None:
+            self._open(size)
+        assert size == self.size, 'All the frames of a depthmap video must have the same size'
+        self.writer.send(np.ascontiguousarray(frame))
+        self.frame_count += 1
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        with open(get_index_path(self.path), 'w') as f:
+            json.dump({'frame_count': self.frame_count, 'fps': self.fps, 'size': list(self.size),
+                       'pix_fmt': 'gray16le', 'intra_only': True}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DepthVideoReader:
+    """Lazy, random-access sequence of uint16 depthmap frames (NumPy arrays).
+    Sequential access decodes every frame once, random access seeks instead of decoding from the start.
+    Raises ValueError if the file is not a 16-bit grayscale video."""
+    def __init__(self, path):
+        import imageio_ffmpeg
+        self.path = path
+        index_path = get_index_path(path)
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            self.fps = index['fps']
+            self.size = tuple(index['size'])
+            self.frame_count = index['frame_count']
+            self.intra_only = index.get('intra_only', False)
+        else:
+            # Not written by us (or the sidecar is lost), probe the file instead
+            gen = imageio_ffmpeg.read_frames(path, pix_fmt='gray16le', bits_per_pixel=16)
+            try:
+                meta = next(gen)
+            finally:
+                gen.close()
+            if meta['pix_fmt'] != 'gray16le':
+                raise ValueError(f"Not a 16-bit depthmap video: {path}")
+            self.fps = meta['fps']
+            self.size = tuple(meta['size'])
+            self.frame_count = imageio_ffmpeg.count_frames_and_secs(path)[0]
+            self.intra_only = False
+        self._gen = None
+        self._next_index = None
+
+    def __len__(self):
+        return self.frame_count
+
+    def _start(self, index):
+        import imageio_ffmpeg
+        self._close_gen()
+        input_params = None
+        if index > 0:
+            # ffmpeg snaps the timestamp to the nearest frame. If the video is not intra-only,
+            # ffmpeg will decode from the previous keyframe instead - slower, but still correct.
+            input_params = ['-ss', f'{index / self.fps:.6f}']
+        self._gen = imageio_ffmpeg.read_frames(self.path, pix_fmt='gray16le', bits_per_pixel=16,
+                                               input_params=input_params)
+        next(self._gen)  # Metadata
+        self._next_index = index
+
+    def _close_gen(self):
+        if self._gen is not None:
+            self._gen.close()
+            self._gen = None
+            self._next_index = None
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.frame_count
+        if not 0 <= index < self.frame_count:
+            raise IndexError('Frame index out of range')
+        if self._gen is None or self._next_index != index:
+            self._start(index)
+        try:
+            raw = next(self._gen)
+        except StopIteration:
+            self._close_gen()
+            raise IndexError(f'Could not decode frame {index}')
+        self._next_index += 1
+        frame = np.frombuffer(raw, dtype='uint16')
+        frame.shape = (self.size[1], self.size[0])
+        return frame
+
+    def __iter__(self):
+        for i in range(self.frame_count):
+            yield self[i]
+
+    def close(self):
+        self._close_gen()
+
+    def __del__(self):
+        self.close()
@@ -1,34 +1,28 @@
+import contextlib
+import functools
 import gc
+import json
 import os.path
-from operator import getitem
 
 import cv2
 import numpy as np
-import skimage.measure
 from PIL import Image
 import torch
-from torchvision.transforms import Compose, transforms
 
 # midas imports
-from dmidas.dpt_depth import DPTDepthModel
-from dmidas.midas_net import MidasNet
-from dmidas.midas_net_custom import MidasNet_small
+# Model families (dmidas backbones, dzoedepth, LeReS, pix2pix, Marigold) are imported by load_models on first use,
+# importing all of them takes seconds. The same goes for torchvision, its transforms are imported where they are used.
+# Only the light-weight transforms are imported here.
 from dmidas.transforms import Resize, NormalizeImage, PrepareForNet
-# zoedepth
-from dzoedepth.models.builder import build_model
-from dzoedepth.utils.config import get_config
-# AdelaiDepth/LeReS imports
-from lib.multi_depth_model_woauxi import RelDepthModel
-from lib.net_tools import strip_prefix_if_present
-from pix2pix.models.pix2pix4depth_model import Pix2Pix4DepthModel
-# Marigold
-from marigold.marigold import MarigoldPipeline
-# pix2pix/merge net imports
-from pix2pix.options.test_options import TestOptions
 
 # Our code
 from src.misc import *
 from src import backbone
+from src.profiling import profiler
+from src.onnx_backend import OnnxBackend, ONNX_MODEL_TYPES, is_available as onnx_is_available
+from src.quantization import QUANTIZABLE_MODEL_TYPES, quantize_model
+from src.batch_autotune import BatchSizeAutotuner
+from src.guided_upsampling import guided_upsample
 
 global depthmap_device
 
@@ -43,6 +37,28 @@ class ModelHolder:
         # Extra stuff
         self.resize_mode = None
         self.normalization = None
+        self.temporal_state = None  # Data from the previous video frame, used for warm-starting
+        self.onnx_backend = None  # Created on first use, keeps the ONNX Runtime sessions of the loaded model
+        self.use_onnx = False
+        self.quantization = 'none'  # Of the loaded model
+        self.batch_autotuner = BatchSizeAutotuner()
+        self.max_batch_size = 0  # Upper limit of the tuned batch size, 0 is none. Lowered by the out of memory recovery
+        self.last_batch_size = 1  # Of the last Marigold prediction
+
+        # Settings, overwritten by update_settings
+        self.zoedepth_tta = 'flip+pad'
+        self.boost_precision = 'fp32'
+        self.boost_precision_validate = False
+        self.depth_upsampling = 'bicubic'
+        self.marigold_ensemble_tolerance = 0.0
+        self.marigold_video_keyframe_interval = 8
+        self.marigold_video_strength = 0.35
+        self.marigold_video_ensembles = 1
+
+
+    def reset_temporal_state(self):
+        """Must be called before processing a new sequence of frames"""
+        self.temporal_state = None
 
 
     def update_settings(self, **kvargs):
@@ -51,17 +67,76 @@ class ModelHolder:
             setattr(self, k, v)
 
 
-    def ensure_models(self, model_type, device: torch.device, boost: bool):
+    def ensure_models(self, model_type, device: torch.device, boost: bool, quantization='none',
+                      calibration_images=None):
+        """quantization is 'none' or 'int8', int8 is only used on CPU. calibration_images is a function
+        returning a few images, it is called if the model needs calibration for quantization."""
         # TODO: could make it more granular
         if model_type == -1 or model_type is None:
             self.unload_models()
             return
+        if device != torch.device('cpu') or model_type not in QUANTIZABLE_MODEL_TYPES:
+            quantization = 'none'
         # Certain optimisations are irreversible and not device-agnostic, thus changing device requires reloading
-        if model_type != self.depth_model_type or boost != (self.pix2pix_model is not None) or device != self.device:
+        if model_type != self.depth_model_type or boost != (self.pix2pix_model is not None) or device != self.device \
+                or quantization != self.quantization:
             self.unload_models()
             self.load_models(model_type, device, boost)
+            if quantization == 'int8':
+                self.quantize(calibration_images)
         self.reload()
 
+    def quantize(self, calibration_images=None):
+        global depthmap_device
+        depthmap_device = self.device
+
+        def calibration_forward(n):
+            w, h = self.get_default_net_size(self.depth_model_type)
+            for image in calibration_images()[:n]:
+                img = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_BGR2RGB) / 255.0
+                if self.depth_model_type == 0:
+                    estimateleres(img, self.depth_model, w, h)
+                else:
+                    estimatemidas(img, self.depth_model, w, h, self.resize_mode, self.normalization, True, False)
+
+        print("Quantizing the model to int8 ..")
+        model = quantize_model(self.depth_model, self.depth_model_type,
+                               calibration_forward=calibration_forward if calibration_images is not None else None)
+        if model is not None:
+            self.depth_model = model
+            self.quantization = 'int8'
+        backbone.torch_gc()
+
+    def set_inference_backend(self, backend):
+        """backend is 'torch' or 'onnxruntime'. ONNX Runtime is only used for MiDaS/DPT and LeReS models on CPU
+        without BOOST and quantization, torch is used otherwise."""
+        self.use_onnx = backend == 'onnxruntime' and self.device == torch.device('cpu') \
+            and self.depth_model_type in ONNX_MODEL_TYPES and self.pix2pix_model is None and self.quantization == 'none'
+        if backend == 'onnxruntime' and not self.use_onnx:
+            print('ONNX Runtime is only supported for not quantized MiDaS/DPT and res101 models on CPU without BOOST, '
+                  'using torch')
+        if self.use_onnx and not onnx_is_available():
+            print('WARNING: onnxruntime is not installed, using torch')
+            self.use_onnx = False
+        if self.use_onnx and self.onnx_backend is None:
+            model = self.depth_model.depth_model if self.depth_model_type == 0 else self.depth_model
+            self.onnx_backend = OnnxBackend(model, self.depth_model_type)
+
+    def warmup_caches(self, image_sizes, net_width, net_height):
+        """Precomputes the resolution-dependent tensors of the transformer backbones (interpolated position
+        embeddings, relative position bias tables) for input images of the given (width, height) sizes.
+        They would otherwise be computed (and cached) while processing the first image of every size."""
+        if self.depth_model_type not in [1, 2, 3, 4] or self.pix2pix_model is not None:
+            return
+        from dmidas.backbones.utils import warmup_caches
+        resize = Resize(net_width, net_height, resize_target=None, keep_aspect_ratio=True, ensure_multiple_of=32,
+                        resize_method=self.resize_mode)
+        resolutions = set()
+        for width, height in image_sizes:
+            width, height = resize.get_size(width, height)
+            resolutions.add((int(height), int(width)))
+        warmup_caches(self.depth_model, resolutions)
+
     def load_models(self, model_type, device: torch.device, boost: bool):
         """Ensure that the depth model is loaded"""
 
@@ -86,6 +161,9 @@ class ModelHolder:
 
         model = None
         if model_type == 0:  # "res101"
+            # AdelaiDepth/LeReS imports
+            from lib.multi_depth_model_woauxi import RelDepthModel
+            from lib.net_tools import strip_prefix_if_present
             model_path = f"{model_dir}/res101.pth"
             print(model_path)
             ensure_file_downloaded(
@@ -103,6 +181,9 @@ class ModelHolder:
             del checkpoint
             backbone.torch_gc()
 
+        if model_type in [1, 2, 3, 4]:
+            from dmidas.dpt_depth import DPTDepthModel
+
         if model_type == 1:  # "dpt_beit_large_512" midas 3.1
             model_path = f"{model_dir}/dpt_beit_large_512.pt"
             print(model_path)
@@ -160,6 +241,7 @@ class ModelHolder:
             print(model_path)
             ensure_file_downloaded(model_path,
                                    "https://github.com/AlexeyAB/MiDaS/releases/download/midas_dpt/midas_v21-f6b98070.pt")
+            from dmidas.midas_net import MidasNet
             model = MidasNet(model_path, non_negative=True)
             resize_mode = "upper_bound"
             normalization = NormalizeImage(
@@ -171,6 +253,7 @@ class ModelHolder:
             print(model_path)
             ensure_file_downloaded(model_path,
                                    "https://github.com/AlexeyAB/MiDaS/releases/download/midas_dpt/midas_v21_small-70d6b9c8.pt")
+            from dmidas.midas_net_custom import MidasNet_small
             model = MidasNet_small(model_path, features=64, backbone="efficientnet_lite3", exportable=True,
                                    non_negative=True, blocks={'expand': True})
             resize_mode = "upper_bound"
@@ -180,22 +263,20 @@ class ModelHolder:
 
         # When loading, zoedepth models will report the default net size.
         # It will be overridden by the generation settings.
-        elif model_type == 7:  # zoedepth_n
+        if model_type == 7:  # zoedepth_n
             print("zoedepth_n\n")
-            conf = get_config("zoedepth", "infer")
-            model = build_model(conf)
+            model = load_zoedepth("./models/zoedepth", "zoedepth_n", "zoedepth")
 
         elif model_type == 8:  # zoedepth_k
             print("zoedepth_k\n")
-            conf = get_config("zoedepth", "infer", config_version="kitti")
-            model = build_model(conf)
+            model = load_zoedepth("./models/zoedepth", "zoedepth_k", "zoedepth", config_version="kitti")
 
         elif model_type == 9:  # zoedepth_nk
             print("zoedepth_nk\n")
-            conf = get_config("zoedepth_nk", "infer")
-            model = build_model(conf)
+            model = load_zoedepth("./models/zoedepth", "zoedepth_nk", "zoedepth_nk")
 
         elif model_type == 10:  # Marigold v1
+            from marigold.marigold import MarigoldPipeline
             model_path = "Bingxin/Marigold"
             print(model_path)
             dtype = torch.float32 if self.no_half else torch.float16
@@ -248,6 +329,9 @@ class ModelHolder:
                 ["https://huggingface.co/lllyasviel/Annotators/resolve/9a7d84251d487d11/latest_net_G.pth",
                  "https://sfu.ca/~yagiz/CVPR21/latest_net_G.pth"],
                 '50ec735d74ed6499562d898f41b49343e521808b8dae589aa3c2f5c9ac9f7462')
+            # pix2pix/merge net imports
+            from pix2pix.models.pix2pix4depth_model import Pix2Pix4DepthModel
+            from pix2pix.options.test_options import TestOptions
             opt = TestOptions().parse()
             if device == torch.device('cpu'):
                 opt.gpu_ids = []
@@ -303,42 +387,108 @@ class ModelHolder:
             self.depth_model = None
             del self.pix2pix_model
             self.pix2pix_model = None
+            self.onnx_backend = None
+            self.use_onnx = False
+            self.quantization = 'none'
             gc.collect()
             backbone.torch_gc()
 
         self.depth_model_type = None
         self.device = None
 
-    def get_raw_prediction(self, input, net_width, net_height):
+    def marigold_batch_size(self, img, processing_res, ensembles):
+        """Number of ensemble members denoised together, tuned for the resolution and the device.
+        Only CUDA devices are tuned, elsewhere the members are denoised one by one (like the pipeline does)."""
+        if self.device.type != 'cuda':
+            return 1
+        height, width = img.shape[:2]
+        if processing_res > 0:
+            scale = processing_res / max(height, width)
+            height, width = int(height * scale), int(width * scale)
+        key = BatchSizeAutotuner.key(10, height, width, self.depth_model.dtype, self.device)
+        rgb_latent = []  # The latent of the image is shared by the probes, it is not batched
+
+        def probe(n):
+            # One denoising step and the decoding of n members, which have the peak memory of the whole run.
+            # The content of the image does not matter, the ensembling and the post-processing are skipped.
+            with torch.no_grad():
+                if len(rgb_latent) == 0:
+                    rgb = torch.rand(1, 3, height, width, dtype=self.depth_model.dtype, device=self.device)
+                    rgb_latent.append(self.depth_model.encode_rgb(rgb))
+                self.depth_model.single_infer(rgb_latent[0], n, 1, show_pbar=False)
+        return self.batch_autotuner.batch_size(key, probe, ensembles)
+
+    def get_raw_prediction(self, input, net_width, net_height, temporal=False):
         """Get prediction from the model currently loaded by the ModelHolder object.
-        If boost is enabled, net_width and net_height will be ignored."""
+        If boost is enabled, net_width and net_height will be ignored.
+        If temporal is True, the input is assumed to be the next frame of a video, this allows some models
+        to reuse the results of the previous frame."""
         global depthmap_device
         depthmap_device = self.device
         # input image
-        img = cv2.cvtColor(np.asarray(input), cv2.COLOR_BGR2RGB) / 255.0
+        with profiler.stage('preprocess'):
+            img = cv2.cvtColor(np.asarray(input), cv2.COLOR_BGR2RGB) / 255.0
+        # With the guided upsampling, the estimators return the prediction at the net size
+        guided = self.pix2pix_model is None and self.depth_upsampling == 'guided'
         # compute depthmap
         if self.pix2pix_model is None:
-            if self.depth_model_type == 0:
-                raw_prediction = estimateleres(img, self.depth_model, net_width, net_height)
-            elif self.depth_model_type in [7, 8, 9]:
-                raw_prediction = estimatezoedepth(input, self.depth_model, net_width, net_height)
-            elif self.depth_model_type in [1, 2, 3, 4, 5, 6]:
-                raw_prediction = estimatemidas(img, self.depth_model, net_width, net_height,
-                                               self.resize_mode, self.normalization, self.no_half,
-                                               self.precision == "autocast")
-            elif self.depth_model_type == 10:
-                raw_prediction = estimatemarigold(img, self.depth_model, net_width, net_height,
-                                                  self.marigold_ensembles, self.marigold_steps)
-            elif self.depth_model_type == 11:
-                raw_prediction = estimatedepthanything(img, self.depth_model, net_width, net_height)
+            onnx_backend = self.onnx_backend if self.use_onnx else None
+            with profiler.stage('forward'):
+                if self.depth_model_type == 0:
+                    raw_prediction = estimateleres(img, self.depth_model, net_width, net_height, onnx_backend,
+                                                   native_size=guided)
+                elif self.depth_model_type in [7, 8, 9]:
+                    raw_prediction = estimatezoedepth(img[:, :, ::-1], self.depth_model, net_width, net_height,
+                                                      self.zoedepth_tta, native_size=guided)
+                elif self.depth_model_type in [1, 2, 3, 4, 5, 6]:
+                    raw_prediction = estimatemidas(img, self.depth_model, net_width, net_height,
+                                                   self.resize_mode, self.normalization, self.no_half,
+                                                   self.precision == "autocast", onnx_backend, guided)
+                elif self.depth_model_type == 10:
+                    if temporal and self.temporal_state is None:
+                        self.temporal_state = {}
+                    batch_size = self.marigold_batch_size(img, net_width, self.marigold_ensembles)
+                    if self.max_batch_size > 0:  # Lowered by the out of memory recovery
+                        batch_size = min(batch_size, self.max_batch_size)
+                    self.last_batch_size = batch_size
+                    raw_prediction = estimatemarigold(img, self.depth_model, net_width, net_height,
+                                                      self.marigold_ensembles, self.marigold_steps,
+                                                      self.marigold_ensemble_tolerance,
+                                                      self.temporal_state if temporal else None,
+                                                      self.marigold_video_keyframe_interval,
+                                                      self.marigold_video_strength,
+                                                      self.marigold_video_ensembles, batch_size,
+                                                      guided)
+                elif self.depth_model_type == 11:
+                    raw_prediction = estimatedepthanything(img, self.depth_model, net_width, net_height,
+                                                           native_size=guided)
         else:
-            raw_prediction = estimateboost(img, self.depth_model, self.depth_model_type, self.pix2pix_model,
-                                           self.boost_rmax)
+            # int8 models do not run under autocast
+            precision = self.boost_precision if self.quantization == 'none' else 'fp32'
+            with profiler.stage('boost'), \
+                    boost_memory_format(precision, self.depth_model, self.depth_model_type, self.pix2pix_model):
+                raw_prediction = estimateboost(img, self.depth_model, self.depth_model_type, self.pix2pix_model,
+                                               self.boost_rmax, precision)
+            if precision != 'fp32' and self.boost_precision_validate:
+                reference = estimateboost(img, self.depth_model, self.depth_model_type, self.pix2pix_model,
+                                          self.boost_rmax, 'fp32')
+                error = np.abs(raw_prediction - reference) / max(float(reference.max() - reference.min()), 1e-6)
+                print(f'BOOST {precision} differs from fp32 by {error.max():.2e} at most, {error.mean():.2e} on average '
+                      f'(relative to the depth range)')
+        if guided:
+            height, width = img.shape[:2]
+            with profiler.stage('upsample'):
+                if raw_prediction.shape[0] < height or raw_prediction.shape[1] < width:
+                    raw_prediction = guided_upsample(raw_prediction, img[:, :, ::-1])
+                elif raw_prediction.shape != (height, width):  # The net size is larger than the input
+                    raw_prediction = cv2.resize(raw_prediction, (width, height), interpolation=cv2.INTER_AREA)
         raw_prediction_invert = self.depth_model_type in [0, 7, 8, 9, 10]
         return raw_prediction, raw_prediction_invert
 
 
-def estimateleres(img, model, w, h):
+def estimateleres(img, model, w, h, onnx_backend=None, as_tensor=False, native_size=False):
+    """as_tensor returns a float32 tensor on the device of the model instead of a NumPy array.
+    native_size returns the prediction at the net size instead of the size of img."""
     # leres transform input
     rgb_c = img[:, :, ::-1].copy()
     A_resize = cv2.resize(rgb_c, (w, h))
@@ -348,10 +498,16 @@ def estimateleres(img, model, w, h):
     with torch.no_grad():
         if depthmap_device == torch.device("cuda"):
             img_torch = img_torch.cuda()
-        prediction = model.depth_model(img_torch)
+        prediction = onnx_backend.run(img_torch) if onnx_backend is not None else None
+        if prediction is None:
+            prediction = model.depth_model(img_torch)
 
-    prediction = prediction.squeeze().cpu().numpy()
-    prediction = cv2.resize(prediction, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_CUBIC)
+    prediction = prediction.squeeze().float()
+    if as_tensor:
+        return prediction if native_size else resize_tensor(prediction, img.shape[0], img.shape[1])
+    prediction = prediction.cpu().numpy()
+    if not native_size:
+        prediction = cv2.resize(prediction, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_CUBIC)
 
     return prediction
 
@@ -366,6 +522,7 @@ def scale_torch(img):
     if len(img.shape) == 2:
         img = img[np.newaxis, :, :]
     if img.shape[2] == 3:
+        from torchvision import transforms
         transform = transforms.Compose(
             [transforms.ToTensor(), transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
         img = transform(img.astype(np.float32))
@@ -375,20 +532,76 @@ def scale_torch(img):
     return img
 
 
-def estimatezoedepth(img, model, w, h):
-    # x = transforms.ToTensor()(img).unsqueeze(0)
-    # x = x.type(torch.float32)
-    # x.to(depthmap_device)
-    # prediction = model.infer(x)
-    model.core.prep.resizer._Resize__width = w
-    model.core.prep.resizer._Resize__height = h
-    prediction = model.infer_pil(img)
-
-    return prediction
+ZOEDEPTH_ARTIFACT_VERSION = 1
+
+
+def load_zoedepth(model_dir, name, model_name, **config_kwargs):
+    """Builds a ZoeDepth model from the bundled dzoedepth and dmidas code, without torch.hub.
+    The first load downloads the checkpoint and saves an assembled artifact: the resolved config together with
+    the state dict, keys already mapped to the model. Later loads only read this single local file."""
+    from dzoedepth.models.builder import build_model
+    from dzoedepth.utils.config import get_config
+    from dzoedepth.utils.easydict import EasyDict
+
+    os.makedirs(model_dir, exist_ok=True)
+    artifact_path = f"{model_dir}/{name}.pt"
+    if os.path.exists(artifact_path):
+        try:
+            artifact = torch.load(artifact_path, map_location='cpu')
+            if artifact['version'] == ZOEDEPTH_ARTIFACT_VERSION:
+                model = build_model(EasyDict(artifact['config']))
+                model.load_state_dict(artifact['state_dict'], strict=True)
+                return model
+        except Exception as e:
+            print(f"Could not load {artifact_path}, rebuilding it. Exception: {str(e)}")
+
+    conf = get_config(model_name, "infer", **config_kwargs)
+    url = conf.pretrained_resource.split('url::')[1]
+    checkpoint_path = os.path.join(torch.hub.get_dir(), 'checkpoints', os.path.basename(url))
+    downloaded = not os.path.exists(checkpoint_path)  # Reuse the checkpoint if an older version downloaded it
+    if downloaded:
+        checkpoint_path = f"{artifact_path}.download"
+        ensure_file_downloaded(checkpoint_path, url)
+    conf.pretrained_resource = f"local::{checkpoint_path}"
+    model = build_model(conf)
+
+    conf.pretrained_resource = None  # The weights are in the artifact
+    config = json.loads(json.dumps(conf))  # Plain containers only, so that the artifact loads with weights_only
+    torch.save({'version': ZOEDEPTH_ARTIFACT_VERSION, 'config': config, 'state_dict': model.state_dict()},
+               f"{artifact_path}.tmp")
+    os.replace(f"{artifact_path}.tmp", artifact_path)
+    if downloaded:
+        os.remove(checkpoint_path)
+    return model
+
+
+ZOEDEPTH_TTA_LEVELS = ['none', 'flip', 'flip+pad']
+
+
+def estimatezoedepth(img, model, w, h, tta='flip+pad', as_tensor=False, native_size=False):
+    """img is a HxWx3 RGB array with values in [0; 1].
+    tta is the test-time augmentation: 'flip' averages the prediction with the prediction of the mirrored image
+    (both are computed in one batch), 'pad' pads the input to avoid artifacts near the borders.
+    as_tensor returns a float32 tensor on the device of the model instead of a NumPy array.
+    native_size returns the prediction at the net size instead of the size of img."""
+    model.core.set_net_size(w, h)
+    resizer = model.core.prep.resizer
+    if native_size and hasattr(resizer, 'get_size'):
+        # The model resizes its input to the net size and the prediction back to the size of its input
+        width, height = resizer.get_size(img.shape[1], img.shape[0])
+        img = cv2.resize(np.ascontiguousarray(img), (int(width), int(height)), interpolation=cv2.INTER_AREA)
+    x = torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32)).permute(2, 0, 1).unsqueeze(0)
+    with torch.no_grad():
+        prediction = model.infer(x.to(depthmap_device), pad_input='pad' in tta, with_flip_aug='flip' in tta)
+    prediction = prediction.squeeze().float()
+    return prediction if as_tensor else prediction.cpu().numpy()
 
 
-def estimatemidas(img, model, w, h, resize_mode, normalization, no_half, precision_is_autocast):
+def estimatemidas(img, model, w, h, resize_mode, normalization, no_half, precision_is_autocast, onnx_backend=None,
+                  native_size=False):
+    """native_size returns the prediction at the net size instead of the size of img"""
     import contextlib
+    from torchvision.transforms import Compose
     # init transform
     transform = Compose(
         [
@@ -418,7 +631,11 @@ def estimatemidas(img, model, w, h, resize_mode, normalization, no_half, precisi
             sample = sample.to(memory_format=torch.channels_last)
             if not no_half:
                 sample = sample.half()
-        prediction = model.forward(sample)
+        prediction = onnx_backend.run(sample) if onnx_backend is not None else None
+        if prediction is None:
+            prediction = model.forward(sample)
+        if native_size:
+            return prediction.squeeze().float().cpu().numpy()
         prediction = (
             torch.nn.functional.interpolate(
                 prediction.unsqueeze(1),
@@ -436,20 +653,41 @@ def estimatemidas(img, model, w, h, resize_mode, normalization, no_half, precisi
 
 # TODO: correct values for BOOST
 # TODO: "h" is not used
-def estimatemarigold(image, model, w, h, marigold_ensembles=5, marigold_steps=12):
+def estimatemarigold(image, model, w, h, marigold_ensembles=5, marigold_steps=12, ensemble_tolerance=0.0,
+                     temporal_state=None, keyframe_interval=8, warm_start_strength=0.35, warm_start_ensembles=1,
+                     batch_size=0, native_size=False):
+    """If temporal_state (a dict) is supplied, frames are assumed to be consecutive frames of a video.
+    Every keyframe_interval-th frame is denoised from pure noise, other frames start from the re-noised latent
+    of the previous frame, use only warm_start_strength of the denoising steps and fewer ensembles.
+    batch_size is the number of ensemble members denoised together, 0 lets the pipeline decide.
+    native_size returns the prediction at the processing resolution instead of the size of image."""
     # This hideous thing should be re-implemented once there is support from the upstream.
     # TODO: re-implement this hideous thing by using features from the upstream
     img = cv2.cvtColor((image * 255.0001).astype('uint8'), cv2.COLOR_BGR2RGB)
     img = Image.fromarray(img)
+    warm_start = {}
+    if temporal_state is not None:
+        frame = temporal_state.get('frame', 0)
+        if temporal_state.get('latent') is not None and keyframe_interval > 1 and frame % keyframe_interval != 0:
+            warm_start = {'init_depth_latent': temporal_state['latent'], 'init_strength': warm_start_strength}
+            marigold_ensembles = max(1, min(marigold_ensembles, warm_start_ensembles))
     with torch.no_grad():
         pipe_out = model(img, processing_res=w, show_progress_bar=False,
-                         ensemble_size=marigold_ensembles, denoising_steps=marigold_steps,
-                         match_input_res=False)
+                         ensemble_size=marigold_ensembles, denoising_steps=marigold_steps, batch_size=batch_size,
+                         match_input_res=False, ensemble_tolerance=ensemble_tolerance, **warm_start)
+        if temporal_state is not None:
+            temporal_state['latent'] = pipe_out.depth_latent
+            temporal_state['frame'] = temporal_state.get('frame', 0) + 1
+        if native_size:
+            return pipe_out.depth_np
         return cv2.resize(pipe_out.depth_np, (image.shape[:2][::-1]), interpolation=cv2.INTER_CUBIC)
 
 
-def estimatedepthanything(image, model, w, h):
+def estimatedepthanything(image, model, w, h, as_tensor=False, native_size=False):
+    """as_tensor returns a float32 tensor on the device of the model instead of a NumPy array.
+    native_size returns the prediction at the net size instead of the size of image."""
     from depth_anything.util.transform import Resize, NormalizeImage, PrepareForNet
+    from torchvision.transforms import Compose
     transform = Compose(
         [
             Resize(
@@ -471,113 +709,15 @@ def estimatedepthanything(image, model, w, h):
 
     with torch.no_grad():
         depth = model(timage)
-    import torch.nn.functional as F
-    depth = F.interpolate(
-        depth[None], (image.shape[0], image.shape[1]), mode="bilinear", align_corners=False
-    )[0, 0]
-
-    return depth.cpu().numpy()
-
-
-class ImageandPatchs:
-    def __init__(self, root_dir, name, patchsinfo, rgb_image, scale=1):
-        self.root_dir = root_dir
-        self.patchsinfo = patchsinfo
-        self.name = name
-        self.patchs = patchsinfo
-        self.scale = scale
-
-        self.rgb_image = cv2.resize(rgb_image, (round(rgb_image.shape[1] * scale), round(rgb_image.shape[0] * scale)),
-                                    interpolation=cv2.INTER_CUBIC)
-
-        self.do_have_estimate = False
-        self.estimation_updated_image = None
-        self.estimation_base_image = None
-
-    def __len__(self):
-        return len(self.patchs)
-
-    def set_base_estimate(self, est):
-        self.estimation_base_image = est
-        if self.estimation_updated_image is not None:
-            self.do_have_estimate = True
-
-    def set_updated_estimate(self, est):
-        self.estimation_updated_image = est
-        if self.estimation_base_image is not None:
-            self.do_have_estimate = True
-
-    def __getitem__(self, index):
-        patch_id = int(self.patchs[index][0])
-        rect = np.array(self.patchs[index][1]['rect'])
-        msize = self.patchs[index][1]['size']
-
-        ## applying scale to rect:
-        rect = np.round(rect * self.scale)
-        rect = rect.astype('int')
-        msize = round(msize * self.scale)
-
-        patch_rgb = impatch(self.rgb_image, rect)
-        if self.do_have_estimate:
-            patch_whole_estimate_base = impatch(self.estimation_base_image, rect)
-            patch_whole_estimate_updated = impatch(self.estimation_updated_image, rect)
-            return {'patch_rgb': patch_rgb, 'patch_whole_estimate_base': patch_whole_estimate_base,
-                    'patch_whole_estimate_updated': patch_whole_estimate_updated, 'rect': rect,
-                    'size': msize, 'id': patch_id}
-        else:
-            return {'patch_rgb': patch_rgb, 'rect': rect, 'size': msize, 'id': patch_id}
-
-    def print_options(self, opt):
-        """Print and save options
-
-        It will print both current options and default values(if different).
-        It will save options into a text file / [checkpoints_dir] / opt.txt
-        """
-        message = ''
-        message += '----------------- Options ---------------\n'
-        for k, v in sorted(vars(opt).items()):
-            comment = ''
-            default = self.parser.get_default(k)
-            if v != default:
-                comment = '\t[default: %s]' % str(default)
-            message += '{:>25}: {:<30}{}\n'.format(str(k), str(v), comment)
-        message += '----------------- End -------------------'
-        print(message)
-
-        # save to the disk
-        """
-        expr_dir = os.path.join(opt.checkpoints_dir, opt.name)
-        util.mkdirs(expr_dir)
-        file_name = os.path.join(expr_dir, '{}_opt.txt'.format(opt.phase))
-        with open(file_name, 'wt') as opt_file:
-            opt_file.write(message)
-            opt_file.write('\n')
-        """
-
-    def parse(self):
-        """Parse our options, create checkpoints directory suffix, and set up gpu device."""
-        opt = self.gather_options()
-        opt.isTrain = self.isTrain  # train or test
-
-        # process opt.suffix
-        if opt.suffix:
-            suffix = ('_' + opt.suffix.format(**vars(opt))) if opt.suffix != '' else ''
-            opt.name = opt.name + suffix
-
-        # self.print_options(opt)
-
-        # set gpu ids
-        str_ids = opt.gpu_ids.split(',')
-        opt.gpu_ids = []
-        for str_id in str_ids:
-            id = int(str_id)
-            if id >= 0:
-                opt.gpu_ids.append(id)
-        # if len(opt.gpu_ids) > 0:
-        #    torch.cuda.set_device(opt.gpu_ids[0])
+    if native_size:
+        depth = depth[0]
+    else:
+        import torch.nn.functional as F
+        depth = F.interpolate(
+            depth[None], (image.shape[0], image.shape[1]), mode="bilinear", align_corners=False
+        )[0, 0]
 
-        self.opt = opt
-        return self.opt
+    return depth.float() if as_tensor else depth.float().cpu().numpy()
 
 
 def impatch(image, rect):
@@ -600,6 +740,8 @@ class ImageandPatchs:
 
         self.rgb_image = cv2.resize(rgb_image, (round(rgb_image.shape[1] * scale), round(rgb_image.shape[0] * scale)),
                                     interpolation=cv2.INTER_CUBIC)
+        # applying scale to the rects of all patches
+        self.rects = np.round(patchsinfo['rect'] * scale).astype('int')
 
         self.do_have_estimate = False
         self.estimation_updated_image = None
@@ -619,14 +761,9 @@ class ImageandPatchs:
             self.do_have_estimate = True
 
     def __getitem__(self, index):
-        patch_id = int(self.patchs[index][0])
-        rect = np.array(self.patchs[index][1]['rect'])
-        msize = self.patchs[index][1]['size']
-
-        ## applying scale to rect:
-        rect = np.round(rect * self.scale)
-        rect = rect.astype('int')
-        msize = round(msize * self.scale)
+        patch_id = int(self.patchs[index]['id'])
+        rect = self.rects[index]
+        msize = round(int(self.patchs[index]['size']) * self.scale)
 
         patch_rgb = impatch(self.rgb_image, rect)
         if self.do_have_estimate:
@@ -691,7 +828,43 @@ class ImageandPatchs:
         return self.opt
 
 
-def estimateboost(img, model, model_type, pix2pixmodel, whole_size_threshold):
+BOOST_PRECISIONS = ['fp32', 'fp16', 'bf16']
+
+
+def boost_autocast(precision, device):
+    """Autocast context for the depth and merge networks of BOOST. CPUs use bf16 for 'fp16', fp16 is slow there.
+    Everything else (resizing, fitting, blending) stays in fp32 outside of this context."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    dtype = torch.float16
+    if device.type != 'cuda' or (precision == 'bf16' and torch.cuda.is_bf16_supported()):
+        dtype = torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype)
+
+
+def is_channels_last(network):
+    """True if all the convolution weights of the network are in the channels last memory format"""
+    weights = [x for x in network.parameters() if x.dim() == 4]
+    return len(weights) > 0 and all(x.is_contiguous(memory_format=torch.channels_last) for x in weights)
+
+
+@contextlib.contextmanager
+def boost_memory_format(precision, model, model_type, pix2pixmodel):
+    """Reduced precision convolutions are the fastest with the channels last memory format. The networks are
+    converted for the duration of the context only, the ModelHolder keeps them for other precisions and modes.
+    Networks that are already channels last (load_models converts the depth models on CUDA) are left as they are."""
+    networks = [pix2pixmodel.netG] + ([model] if model_type in [0, 1, 2, 3, 4, 5, 6] else [])
+    networks = [x for x in networks if precision != 'fp32' and not is_channels_last(x)]
+    for network in networks:
+        network.to(memory_format=torch.channels_last)
+    try:
+        yield
+    finally:
+        for network in networks:
+            network.to(memory_format=torch.contiguous_format)
+
+
+def estimateboost(img, model, model_type, pix2pixmodel, whole_size_threshold, precision='fp32'):
     pix2pixsize = 1024  # TODO: pix2pixsize and whole_size_threshold to setting?
 
     if model_type == 0:  # leres
@@ -708,10 +881,13 @@ def estimateboost(img, model, model_type, pix2pixmodel, whole_size_threshold):
     gc.collect()
     backbone.torch_gc()
 
+    # The patches are merged on the device of the merge network, the result is only downloaded once at the end
+    device = pix2pixmodel.device
+
     # Generate mask used to smoothly blend the local pathc estimations to the base estimate.
     # It is arbitrarily large to avoid artifacts during rescaling for each crop.
-    mask_org = generatemask((3000, 3000))
-    mask = mask_org.copy()
+    mask_org = torch.tensor(generatemask((3000, 3000)), device=device)
+    mask = mask_org
 
     # Value x of R_x defined in the section 5 of the main paper.
     r_threshold_value = 0.2
@@ -730,7 +906,7 @@ def estimateboost(img, model, model_type, pix2pixmodel, whole_size_threshold):
 
     # Generate the base estimate using the double estimation.
     whole_estimate = doubleestimate(img, net_receptive_field_size, whole_image_optimal_size, pix2pixsize, model,
-                                    model_type, pix2pixmodel)
+                                    model_type, pix2pixmodel, as_tensor=True, precision=precision)
 
     # Compute the multiplier described in section 6 of the main paper to make sure our initial patch can select
     # small high-density regions of the image.
@@ -784,83 +960,94 @@ def estimateboost(img, model, model_type, pix2pixmodel, whole_size_threshold):
     mergein_scale = input_resolution[0] / img.shape[0]
 
     imageandpatchs = ImageandPatchs('', '', patchset, img, mergein_scale)
-    whole_estimate_resized = cv2.resize(whole_estimate, (round(img.shape[1] * mergein_scale),
-                                                         round(img.shape[0] * mergein_scale)),
-                                        interpolation=cv2.INTER_CUBIC)
-    imageandpatchs.set_base_estimate(whole_estimate_resized.copy())
-    imageandpatchs.set_updated_estimate(whole_estimate_resized.copy())
+    whole_estimate_resized = resize_tensor(whole_estimate, round(img.shape[0] * mergein_scale),
+                                           round(img.shape[1] * mergein_scale))
+    imageandpatchs.set_base_estimate(whole_estimate_resized)
+    imageandpatchs.set_updated_estimate(whole_estimate_resized.clone())
 
-    print('Resulting depthmap resolution will be :', whole_estimate_resized.shape[:2])
+    print('Resulting depthmap resolution will be :', tuple(whole_estimate_resized.shape))
     print('patches to process: ' + str(len(imageandpatchs)))
 
-    # Enumerate through all patches, generate their estimations and refining the base estimate.
-    for patch_ind in range(len(imageandpatchs)):
-
-        # Get patch information
-        patch = imageandpatchs[patch_ind]  # patch object
-        patch_rgb = patch['patch_rgb']  # rgb patch
-        patch_whole_estimate_base = patch['patch_whole_estimate_base']  # corresponding patch from base
-        rect = patch['rect']  # patch size and location
-        patch_id = patch['id']  # patch ID
-        org_size = patch_whole_estimate_base.shape  # the original size from the unscaled input
-        print('\t processing patch', patch_ind, '/', len(imageandpatchs) - 1, '|', rect)
-
-        # We apply double estimation for patches. The high resolution value is fixed to twice the receptive
-        # field size of the network for patches to accelerate the process.
-        patch_estimation = doubleestimate(patch_rgb, net_receptive_field_size, patch_netsize, pix2pixsize, model,
-                                          model_type, pix2pixmodel)
-        patch_estimation = cv2.resize(patch_estimation, (pix2pixsize, pix2pixsize), interpolation=cv2.INTER_CUBIC)
-        patch_whole_estimate_base = cv2.resize(patch_whole_estimate_base, (pix2pixsize, pix2pixsize),
-                                               interpolation=cv2.INTER_CUBIC)
-
-        # Merging the patch estimation into the base estimate using our merge network:
-        # We feed the patch estimation and the same region from the updated base estimate to the merge network
-        # to generate the target estimate for the corresponding region.
-        pix2pixmodel.set_input(patch_whole_estimate_base, patch_estimation)
-
-        # Run merging network
-        pix2pixmodel.test()
-        visuals = pix2pixmodel.get_current_visuals()
-
-        prediction_mapped = visuals['fake_B']
-        prediction_mapped = (prediction_mapped + 1) / 2
-        prediction_mapped = prediction_mapped.squeeze().cpu().numpy()
-
-        mapped = prediction_mapped
-
-        # We use a simple linear polynomial to make sure the result of the merge network would match the values of
-        # base estimate
-        p_coef = np.polyfit(mapped.reshape(-1), patch_whole_estimate_base.reshape(-1), deg=1)
-        merged = np.polyval(p_coef, mapped.reshape(-1)).reshape(mapped.shape)
-
-        merged = cv2.resize(merged, (org_size[1], org_size[0]), interpolation=cv2.INTER_CUBIC)
+    with profiler.stage('boost_patches'):
+        # Enumerate through all patches, generate their estimations and refining the base estimate.
+        for patch_ind in range(len(imageandpatchs)):
+
+            # Get patch information
+            patch = imageandpatchs[patch_ind]  # patch object
+            patch_rgb = patch['patch_rgb']  # rgb patch
+            patch_whole_estimate_base = patch['patch_whole_estimate_base']  # corresponding patch from base
+            rect = patch['rect']  # patch size and location
+            patch_id = patch['id']  # patch ID
+            org_size = patch_whole_estimate_base.shape  # the original size from the unscaled input
+            print('\t processing patch', patch_ind, '/', len(imageandpatchs) - 1, '|', rect)
+
+            # We apply double estimation for patches. The high resolution value is fixed to twice the receptive
+            # field size of the network for patches to accelerate the process.
+            patch_estimation = doubleestimate(patch_rgb, net_receptive_field_size, patch_netsize, pix2pixsize, model,
+                                              model_type, pix2pixmodel, as_tensor=True, precision=precision)
+            patch_whole_estimate_base = resize_tensor(patch_whole_estimate_base, pix2pixsize, pix2pixsize)
+
+            # Merging the patch estimation into the base estimate using our merge network:
+            # We feed the patch estimation and the same region from the updated base estimate to the merge network
+            # to generate the target estimate for the corresponding region.
+            pix2pixmodel.set_input(patch_whole_estimate_base, patch_estimation)
+
+            # Run merging network
+            with boost_autocast(precision, device):
+                pix2pixmodel.test()
+            visuals = pix2pixmodel.get_current_visuals()
+
+            prediction_mapped = visuals['fake_B'].float()
+            prediction_mapped = (prediction_mapped + 1) / 2
+            mapped = prediction_mapped.squeeze()
+
+            # We use a simple linear polynomial to make sure the result of the merge network would match the values of
+            # base estimate
+            merged = linear_fit(mapped, patch_whole_estimate_base)
+
+            merged = resize_tensor(merged, org_size[0], org_size[1])
+
+            # Get patch size and location
+            w1 = rect[0]
+            h1 = rect[1]
+            w2 = w1 + rect[2]
+            h2 = h1 + rect[3]
+
+            # To speed up the implementation, we only generate the Gaussian mask once with a sufficiently large size
+            # and resize it to our needed size while merging the patches.
+            if mask.shape != org_size:
+                mask = resize_tensor(mask_org, org_size[0], org_size[1], mode='bilinear')
+
+            # Update the whole estimation:
+            # We use a simple Gaussian mask to blend the merged patch region with the base estimate to ensure seamless
+            # blending at the boundaries of the patch region.
+            imageandpatchs.estimation_updated_image[h1:h2, w1:w2].lerp_(merged, mask)
 
-        # Get patch size and location
-        w1 = rect[0]
-        h1 = rect[1]
-        w2 = w1 + rect[2]
-        h2 = h1 + rect[3]
+    # output
+    return cv2.resize(imageandpatchs.estimation_updated_image.cpu().numpy(), (input_resolution[1], input_resolution[0]),
+                      interpolation=cv2.INTER_CUBIC)
 
-        # To speed up the implementation, we only generate the Gaussian mask once with a sufficiently large size
-        # and resize it to our needed size while merging the patches.
-        if mask.shape != org_size:
-            mask = cv2.resize(mask_org, (org_size[1], org_size[0]), interpolation=cv2.INTER_LINEAR)
 
-        tobemergedto = imageandpatchs.estimation_updated_image
+def resize_tensor(image, height, width, mode='bicubic'):
+    # Resizes a 2D tensor, like cv2.resize with INTER_CUBIC (or INTER_LINEAR) does
+    if tuple(image.shape) == (height, width):
+        return image
+    return torch.nn.functional.interpolate(image[None, None], (height, width), mode=mode, align_corners=False)[0, 0]
 
-        # Update the whole estimation:
-        # We use a simple Gaussian mask to blend the merged patch region with the base estimate to ensure seamless
-        # blending at the boundaries of the patch region.
-        tobemergedto[h1:h2, w1:w2] = np.multiply(tobemergedto[h1:h2, w1:w2], 1 - mask) + np.multiply(merged, mask)
-        imageandpatchs.set_updated_estimate(tobemergedto)
 
-    # output
-    return cv2.resize(imageandpatchs.estimation_updated_image, (input_resolution[1], input_resolution[0]),
-                      interpolation=cv2.INTER_CUBIC)
+def linear_fit(x, y):
+    # Least squares fit of y ~ a * x + b, returns a * x + b. Same as np.polyval(np.polyfit(x, y, deg=1), x),
+    # the closed form is evaluated on the device of the tensors. Centering keeps float32 precise enough.
+    x_mean = x.mean()
+    y_mean = y.mean()
+    x_centered = x - x_mean
+    a = (x_centered * (y - y_mean)).sum() / (x_centered * x_centered).sum().clamp_min(torch.finfo(x.dtype).tiny)
+    return x_centered * a + y_mean
 
 
+@functools.lru_cache(maxsize=1)
 def generatemask(size):
-    # Generates a Guassian mask
+    # Generates a Guassian mask. The mask is cached (read-only), it is the same for every image
     mask = np.zeros(size, dtype=np.float32)
     sigma = int(size[0] / 16)
     k_size = int(2 * np.ceil(2 * int(size[0] / 16)) + 1)
@@ -868,6 +1055,7 @@ def generatemask(size):
     mask = cv2.GaussianBlur(mask, (int(k_size), int(k_size)), sigma)
     mask = (mask - mask.min()) / (mask.max() - mask.min())
     mask = mask.astype(np.float32)
+    mask.setflags(write=False)
     return mask
 
 
@@ -876,12 +1064,16 @@ def rgb2gray(rgb):
     return np.dot(rgb[..., :3], [0.2989, 0.5870, 0.1140])
 
 
-def resizewithpool(img, size):
-    i_size = img.shape[0]
+def resizewithpool_fromintegral(integralimage, size):
+    # Max pooling of a binary (0 or 1) square image to about size x size, from its integral image: a block
+    # contains a 1 if its sum is positive. The last blocks are partial, like in skimage.measure.block_reduce.
+    i_size = integralimage.shape[0] - 1
     n = int(np.floor(i_size / size))
-
-    out = skimage.measure.block_reduce(img, (n, n), np.max)
-    return out
+    edges = np.minimum(np.arange(0, i_size + n, n), i_size)
+    x1, x2 = edges[:-1, None], edges[1:, None]
+    y1, y2 = edges[None, :-1], edges[None, 1:]
+    block_sums = integralimage[x2, y2] - integralimage[x1, y2] - integralimage[x2, y1] + integralimage[x1, y1]
+    return (block_sums > 0).astype(np.float64)
 
 
 def calculateprocessingres(img, basesize, confidence=0.1, scale_threshold=3, whole_size_threshold=3000):
@@ -922,9 +1114,12 @@ def calculateprocessingres(img, basesize, confidence=0.1, scale_threshold=3, who
     # Output resolution limit set by the whole_size_threshold and scale_threshold.
     threshold = min(whole_size_threshold, scale_threshold * max(img.shape[:2]))
 
+    # The pooling for every candidate size is done from the integral image, without going through the whole image
+    grad_integral_image = cv2.integral(grad)
+
     outputsize_scale = basesize / speed_scale
     for p_size in range(int(basesize / speed_scale), int(threshold / speed_scale), int(basesize / (2 * speed_scale))):
-        grad_resized = resizewithpool(grad, p_size)
+        grad_resized = resizewithpool_fromintegral(grad_integral_image, p_size)
         grad_resized = cv2.resize(grad_resized, (p_size, p_size), cv2.INTER_NEAREST)
         grad_resized[grad_resized >= 0.5] = 1
         grad_resized[grad_resized < 0.5] = 0
@@ -943,43 +1138,49 @@ def calculateprocessingres(img, basesize, confidence=0.1, scale_threshold=3, who
 
 
 # Generate a double-input depth estimation
-def doubleestimate(img, size1, size2, pix2pixsize, model, net_type, pix2pixmodel):
-    # Generate the low resolution estimation
-    estimate1 = singleestimate(img, size1, model, net_type)
-    # Resize to the inference size of merge network.
-    estimate1 = cv2.resize(estimate1, (pix2pixsize, pix2pixsize), interpolation=cv2.INTER_CUBIC)
-
-    # Generate the high resolution estimation
-    estimate2 = singleestimate(img, size2, model, net_type)
-    # Resize to the inference size of merge network.
-    estimate2 = cv2.resize(estimate2, (pix2pixsize, pix2pixsize), interpolation=cv2.INTER_CUBIC)
+def doubleestimate(img, size1, size2, pix2pixsize, model, net_type, pix2pixmodel, as_tensor=False, precision='fp32'):
+    with boost_autocast(precision, pix2pixmodel.device):
+        # Generate the low resolution estimation
+        estimate1 = singleestimate(img, size1, model, net_type, as_tensor=True)
+        # Generate the high resolution estimation
+        estimate2 = singleestimate(img, size2, model, net_type, as_tensor=True)
+    # Resize both to the inference size of merge network, on its device
+    estimate1 = torch.as_tensor(estimate1, device=pix2pixmodel.device, dtype=torch.float32)
+    estimate1 = resize_tensor(estimate1, pix2pixsize, pix2pixsize)
+    estimate2 = torch.as_tensor(estimate2, device=pix2pixmodel.device, dtype=torch.float32)
+    estimate2 = resize_tensor(estimate2, pix2pixsize, pix2pixsize)
 
     # Inference on the merge model
     pix2pixmodel.set_input(estimate1, estimate2)
-    pix2pixmodel.test()
+    with boost_autocast(precision, pix2pixmodel.device):
+        pix2pixmodel.test()
     visuals = pix2pixmodel.get_current_visuals()
-    prediction_mapped = visuals['fake_B']
+    prediction_mapped = visuals['fake_B'].float()
     prediction_mapped = (prediction_mapped + 1) / 2
     prediction_mapped = (prediction_mapped - torch.min(prediction_mapped)) / (
             torch.max(prediction_mapped) - torch.min(prediction_mapped))
-    prediction_mapped = prediction_mapped.squeeze().cpu().numpy()
+    prediction_mapped = prediction_mapped.squeeze()
 
-    return prediction_mapped
+    return prediction_mapped if as_tensor else prediction_mapped.cpu().numpy()
 
 
 # Generate a single-input depth estimation
-def singleestimate(img, msize, model, net_type):
+# With as_tensor, the estimate stays on the device of the model (except for Marigold, whose pipeline returns NumPy)
+def singleestimate(img, msize, model, net_type, as_tensor=False):
     if net_type == 0:
-        return estimateleres(img, model, msize, msize)
+        return estimateleres(img, model, msize, msize, as_tensor=as_tensor)
     elif net_type == 10:
         return estimatemarigold(img, model, msize, msize)
     elif net_type == 11:
-        return estimatedepthanything(img, model, msize, msize)
+        return estimatedepthanything(img, model, msize, msize, as_tensor=as_tensor)
     elif net_type >= 7:
-        # np to PIL
-        return estimatezoedepth(Image.fromarray(np.uint8(img * 255)).convert('RGB'), model, msize, msize)
+        return estimatezoedepth(img, model, msize, msize, as_tensor=as_tensor)
     else:
-        return estimatemidasBoost(img, model, msize, msize)
+        return estimatemidasBoost(img, model, msize, msize, as_tensor=as_tensor)
+
+
+# A selected patch: its index before sorting, its [x, y, width, height] rect and its size (width)
+PATCH_DTYPE = np.dtype([('id', np.int32), ('rect', np.int32, (4,)), ('size', np.int32)])
 
 
 # Generating local patches to perform the local refinement described in section 6 of the main paper.
@@ -1002,89 +1203,69 @@ def generatepatchs(img, base_size, factor):
     stride = int(round(blsize * 0.75))
 
     # Get initial Grid
-    patch_bound_list = applyGridpatch(blsize, stride, img, [0, 0, 0, 0])
+    rects = applyGridpatch(blsize, stride, img, [0, 0, 0, 0])
 
     # Refine initial Grid of patches by discarding the flat (in terms of gradients of the rgb image) ones. Refine
     # each patch size to ensure that there will be enough depth cues for the network to generate a consistent depth map.
     print("Selecting patches ...")
-    patch_bound_list = adaptiveselection(grad_integral_image, patch_bound_list, gf, factor)
+    rects = adaptiveselection(grad_integral_image, rects, gf, factor)
+
+    patchset = np.zeros(len(rects), dtype=PATCH_DTYPE)
+    patchset['id'] = np.arange(len(rects))
+    patchset['rect'] = rects
+    patchset['size'] = rects[:, 2]
 
     # Sort the patch list to make sure the merging operation will be done with the correct order: starting from biggest
-    # patch
-    patchset = sorted(patch_bound_list.items(), key=lambda x: getitem(x[1], 'size'), reverse=True)
-    return patchset
+    # patch. The sort is stable, patches of the same size keep their order.
+    return patchset[np.argsort(-patchset['size'], kind='stable')]
 
 
 def applyGridpatch(blsize, stride, img, box):
-    # Extract a simple grid patch.
-    counter1 = 0
-    patch_bound_list = {}
-    for k in range(blsize, img.shape[1] - blsize, stride):
-        for j in range(blsize, img.shape[0] - blsize, stride):
-            patch_bound_list[str(counter1)] = {}
-            patchbounds = [j - blsize, k - blsize, j - blsize + 2 * blsize, k - blsize + 2 * blsize]
-            patch_bound = [box[0] + patchbounds[1], box[1] + patchbounds[0], patchbounds[3] - patchbounds[1],
-                           patchbounds[2] - patchbounds[0]]
-            patch_bound_list[str(counter1)]['rect'] = patch_bound
-            patch_bound_list[str(counter1)]['size'] = patch_bound[2]
-            counter1 = counter1 + 1
-    return patch_bound_list
+    # Extract a simple grid patch. Returns the [x, y, width, height] rects in an array, column by column.
+    k, j = np.meshgrid(np.arange(blsize, img.shape[1] - blsize, stride),
+                       np.arange(blsize, img.shape[0] - blsize, stride), indexing='ij')
+    rects = np.empty((k.size, 4), dtype=np.int64)
+    rects[:, 0] = box[0] + k.reshape(-1) - blsize
+    rects[:, 1] = box[1] + j.reshape(-1) - blsize
+    rects[:, 2:] = 2 * blsize
+    return rects
 
 
 # Adaptively select patches
-def adaptiveselection(integral_grad, patch_bound_list, gf, factor):
-    patchlist = {}
-    count = 0
+def adaptiveselection(integral_grad, rects, gf, factor):
     height, width = integral_grad.shape
 
     search_step = int(32 / factor)
-
-    # Go through all patches
-    for c in range(len(patch_bound_list)):
-        # Get patch
-        bbox = patch_bound_list[str(c)]['rect']
-
-        # Compute the amount of gradients present in the patch from the integral image.
-        cgf = getGF_fromintegral(integral_grad, bbox) / (bbox[2] * bbox[3])
-
-        # Check if patching is beneficial by comparing the gradient density of the patch to
-        # the gradient density of the whole image
-        if cgf >= gf:
-            bbox_test = bbox.copy()
-            patchlist[str(count)] = {}
-
-            # Enlarge each patch until the gradient density of the patch is equal
-            # to the whole image gradient density
-            while True:
-
-                bbox_test[0] = bbox_test[0] - int(search_step / 2)
-                bbox_test[1] = bbox_test[1] - int(search_step / 2)
-
-                bbox_test[2] = bbox_test[2] + search_step
-                bbox_test[3] = bbox_test[3] + search_step
-
-                # Check if we are still within the image
-                if bbox_test[0] < 0 or bbox_test[1] < 0 or bbox_test[1] + bbox_test[3] >= height \
-                        or bbox_test[0] + bbox_test[2] >= width:
-                    break
-
-                # Compare gradient density
-                cgf = getGF_fromintegral(integral_grad, bbox_test) / (bbox_test[2] * bbox_test[3])
-                if cgf < gf:
-                    break
-                bbox = bbox_test.copy()
-
-            # Add patch to selected patches
-            patchlist[str(count)]['rect'] = bbox
-            patchlist[str(count)]['size'] = bbox[2]
-            count = count + 1
+    growth = np.array([-int(search_step / 2), -int(search_step / 2), search_step, search_step])
+
+    # Compute the amount of gradients present in the patches from the integral image.
+    # Check if patching is beneficial by comparing the gradient density of the patch to
+    # the gradient density of the whole image
+    cgf = getGF_fromintegral(integral_grad, rects.T) / (rects[:, 2] * rects[:, 3])
+    rects = rects[cgf >= gf]
+    if len(rects) == 0:
+        return rects
+
+    # Enlarge each patch until the gradient density of the patch is equal to the whole image gradient density,
+    # or the patch would leave the image. All growth steps of all patches are evaluated at once:
+    # grown[i, n] is patch i enlarged n + 1 times.
+    max_steps = int(rects[:, :2].min(axis=1).max() // -growth[0]) + 1
+    grown = rects[:, None, :] + np.arange(1, max_steps + 1)[None, :, None] * growth
+    inside = (grown[..., 0] >= 0) & (grown[..., 1] >= 0) & (grown[..., 1] + grown[..., 3] < height) \
+        & (grown[..., 0] + grown[..., 2] < width)
+    # The density of the steps outside the image is not needed, they are looked up at the original rect
+    grown_inside = np.where(inside[..., None], grown, rects[:, None, :])
+    cgf = getGF_fromintegral(integral_grad, np.moveaxis(grown_inside, -1, 0)) / (grown[..., 2] * grown[..., 3])
+    # A patch grows as long as every step passes
+    steps = np.cumprod(inside & (cgf >= gf), axis=1).sum(axis=1)
 
     # Return selected patches
-    return patchlist
+    return rects + steps[:, None] * growth
 
 
 def getGF_fromintegral(integralimage, rect):
     # Computes the gradient density of a given patch from the gradient integral image.
+    # The elements of rect may also be arrays, then the densities of many patches are computed at once.
     x1 = rect[1]
     x2 = rect[1] + rect[3]
     y1 = rect[0]
@@ -1093,7 +1274,8 @@ def getGF_fromintegral(integralimage, rect):
     return value
 
 
-def estimatemidasBoost(img, model, w, h):
+def estimatemidasBoost(img, model, w, h, as_tensor=False):
+    from torchvision.transforms import Compose
     # init transform
     transform = Compose(
         [
@@ -1121,8 +1303,11 @@ def estimatemidasBoost(img, model, w, h):
             sample = sample.to(memory_format=torch.channels_last)
         prediction = model.forward(sample)
 
-    prediction = prediction.squeeze().cpu().numpy()
-    prediction = cv2.resize(prediction, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_CUBIC)
+    if as_tensor:
+        prediction = resize_tensor(prediction.squeeze().float(), img.shape[0], img.shape[1])
+    else:
+        prediction = prediction.squeeze().float().cpu().numpy()
+        prediction = cv2.resize(prediction, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_CUBIC)
 
     # normalization
     depth_min = prediction.min()
@@ -1131,6 +1316,6 @@ def estimatemidasBoost(img, model, w, h):
     if depth_max - depth_min > np.finfo("float").eps:
         prediction = (prediction - depth_min) / (depth_max - depth_min)
     else:
-        prediction = 0
+        prediction = torch.zeros_like(prediction) if as_tensor else 0
 
     return prediction
@@ -0,0 +1,55 @@
+# Edge-aware upsampling of depthmaps, guided by the input image.
+# The model runs at its native resolution and its prediction is brought to the resolution of the input by a guided
+# filter (He et al., "Guided Image Filtering"), which aligns the depth edges with the edges of the image instead of
+# blurring them like the bicubic interpolation does. The linear coefficients of the filter are computed at the
+# resolution of the depth and applied to the guide at the higher resolution ("Fast Guided Filter", He and Sun).
+# The filter is applied multi-scale, doubling the resolution per level. Everything is box filters in float32 (cv2).
+import math
+
+import cv2
+import numpy as np
+
+UPSAMPLING_MODES = ['bicubic', 'guided']
+RADIUS = 1  # Of the box filters, in pixels of the lower resolution of the level
+EPS = 1e-4  # Regularization, relative to the variance of the guide in [0; 1]. Lower values follow the image closer
+
+
+def box_mean(x, radius):
+    return cv2.boxFilter(x, -1, (2 * radius + 1, 2 * radius + 1), borderType=cv2.BORDER_REFLECT)
+
+
+def guided_upsample_level(guide, src, radius=RADIUS, eps=EPS):
+    """One level: src is brought to the size of guide (a single channel float32 array)"""
+    height, width = src.shape
+    low_guide = cv2.resize(guide, (width, height), interpolation=cv2.INTER_AREA)
+    mean_i = box_mean(low_guide, radius)
+    mean_p = box_mean(src, radius)
+    cov_ip = box_mean(low_guide * src, radius) - mean_i * mean_p
+    var_i = box_mean(low_guide * low_guide, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    size = (guide.shape[1], guide.shape[0])
+    return cv2.resize(box_mean(a, radius), size, interpolation=cv2.INTER_LINEAR) * guide + \
+        cv2.resize(box_mean(b, radius), size, interpolation=cv2.INTER_LINEAR)
+
+
+def guided_upsample(depth, image, levels=None, radius=RADIUS, eps=EPS):
+    """Upsamples depth (a prediction of any size) to the size of image (RGB, uint8 or float in [0; 1]).
+    levels is the number of filtering steps, the resolution doubles on every step. None means as many steps as needed
+    to go from the size of the depth to the size of the image, 1 goes to the full resolution at once."""
+    height, width = image.shape[:2]
+    guide = image.astype(np.float32) / (255.0 if image.dtype == np.uint8 else 1.0)
+    guide = cv2.cvtColor(guide, cv2.COLOR_RGB2GRAY) if guide.ndim == 3 else guide
+    depth = depth.astype(np.float32)
+    # The filter works on depth in [0; 1], so that eps does not depend on the units of the model
+    low, high = float(depth.min()), float(depth.max())
+    if high - low <= np.finfo(np.float32).eps:
+        return cv2.resize(depth, (width, height), interpolation=cv2.INTER_LINEAR)
+    out = (depth - low) / (high - low)
+    if levels is None:
+        levels = max(1, math.ceil(math.log2(max(height / depth.shape[0], width / depth.shape[1]))))
+    for level in reversed(range(levels)):
+        size = (max(1, round(width / 2 ** level)), max(1, round(height / 2 ** level)))
+        level_guide = guide if level == 0 else cv2.resize(guide, size, interpolation=cv2.INTER_AREA)
+        out = guided_upsample_level(level_guide, out, radius, eps)
+    return out * (high - low) + low
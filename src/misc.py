@@ -2,7 +2,9 @@ import subprocess
 import os
 import pathlib
 import builtins
+import functools
 
+@functools.lru_cache(maxsize=None)
 def get_commit_hash():
     try:
         file_path = pathlib.Path(__file__).parent
@@ -16,7 +18,18 @@ def get_commit_hash():
 REPOSITORY_NAME = "stable-diffusion-webui-depthmap-script"
 SCRIPT_NAME = "DepthMap"
 SCRIPT_VERSION = "v0.4.6"
-SCRIPT_FULL_NAME = f"{SCRIPT_NAME} {SCRIPT_VERSION} ({get_commit_hash()})"
+
+
+def get_script_full_name():
+    # Spawning git takes a while, so it is only done when the name is actually needed
+    return f"{SCRIPT_NAME} {SCRIPT_VERSION} ({get_commit_hash()})"
+
+
+def __getattr__(name):
+    # Backwards compatibility, SCRIPT_FULL_NAME used to be computed on import
+    if name == 'SCRIPT_FULL_NAME':
+        return get_script_full_name()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def ensure_file_downloaded(filename, url, sha256_hash_prefix=None):
@@ -36,3 +49,14 @@ def ensure_file_downloaded(filename, url, sha256_hash_prefix=None):
         except:
             pass
     raise RuntimeError('Download failed. Try again later or manually download the file to that location.')
+
+
+def model_fingerprint(model, salt=''):
+    """Cheap fingerprint of the weights of a torch module, for keying caches of derived artifacts
+    (so that they are not reused after the model file changes)"""
+    import hashlib
+    h = hashlib.sha256(salt.encode())
+    for name, tensor in model.state_dict().items():
+        h.update(f'{name} {tuple(tensor.shape)} {tensor.dtype}'.encode())
+        h.update(tensor.detach().flatten()[:16].cpu().float().numpy().tobytes())
+    return h.hexdigest()[:16]
@@ -0,0 +1,90 @@
+# ONNX Runtime inference of the MiDaS/DPT and LeReS models on CPU.
+# The models are exported once per input shape: the networks get inputs with sides that are multiples of 32, so for
+# a given net size there are only a few shapes (one per aspect ratio bucket). The exported graphs are cached on disk.
+# A graph is only kept if it reproduces the torch output; if anything fails, the caller falls back to torch.
+import importlib.util
+import inspect
+import os
+
+import numpy as np
+import torch
+
+from src.misc import model_fingerprint
+from src.profiling import profiler
+
+ONNX_MODEL_TYPES = [0, 1, 2, 3, 4, 5, 6]
+ONNX_EXPORT_VERSION = 1
+ONNX_OPSET = 17
+ONNX_TOLERANCE = 1e-3  # Maximal absolute difference from the torch output, relative to the range of the output
+
+
+def is_available():
+    return importlib.util.find_spec('onnxruntime') is not None
+
+
+class OnnxBackend:
+    """Runs `model` (a module taking a normalized NCHW float32 batch) with ONNX Runtime on the CPU.
+    run() returns None for the inputs it can not handle, the caller should then use the torch model."""
+    def __init__(self, model, model_type, model_dir='./models/onnx'):
+        self.model = model
+        self.model_type = model_type
+        self.model_dir = model_dir
+        self.fingerprint = model_fingerprint(model, f'{ONNX_EXPORT_VERSION} {torch.__version__}')
+        self.sessions = {}  # input shape -> InferenceSession, None if the shape is not supported
+
+    def graph_path(self, shape):
+        return os.path.join(self.model_dir, f'{self.model_type}-{shape[-2]}x{shape[-1]}-{self.fingerprint}.onnx')
+
+    def run(self, sample):
+        shape = tuple(sample.shape)
+        if shape not in self.sessions:
+            self.sessions[shape] = self._prepare(sample)
+        session = self.sessions[shape]
+        if session is None:
+            return None
+        output = session.run(None, {'image': sample.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+    def _prepare(self, sample):
+        """Loads the cached graph of this shape, exports it if there is none. Returns None on failure."""
+        path = self.graph_path(sample.shape)
+        if os.path.exists(path):
+            try:
+                return self._create_session(path)
+            except Exception as e:
+                print(f'Could not load {path}, exporting it again. Exception: {str(e)}')
+                os.remove(path)
+        try:
+            with profiler.stage('onnx_export'):
+                self._export(sample, path)
+            session = self._create_session(path)
+            with torch.no_grad():
+                expected = self.model(sample).numpy()
+            actual = session.run(None, {'image': sample.numpy()})[0]
+            error = np.abs(actual - expected).max() / max(float(expected.max() - expected.min()), 1e-6)
+            if not error <= ONNX_TOLERANCE:
+                os.remove(path)
+                raise ValueError(f'the output differs from the torch output (relative error {error:.2e})')
+            return session
+        except Exception as e:
+            print(f'ONNX Runtime can not be used for input shape {tuple(sample.shape)}, using torch. '
+                  f'Exception: {str(e)}')
+            return None
+
+    def _export(self, sample, path):
+        os.makedirs(self.model_dir, exist_ok=True)
+        kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            kwargs['dynamo'] = False  # The TorchScript exporter handles all of these models
+        with torch.no_grad():
+            torch.onnx.export(self.model, (sample,), f'{path}.tmp', input_names=['image'], output_names=['depth'],
+                              opset_version=ONNX_OPSET, do_constant_folding=True, **kwargs)
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def _create_session(path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+        return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
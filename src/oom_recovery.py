@@ -0,0 +1,101 @@
+# Recovery from out of memory errors of a single image. Instead of failing the whole batch, the image is retried with
+# progressively cheaper settings (the rungs of the ladder). Every rung keeps the degradations of the previous ones.
+# The settings are restored before the next image, so an oversized image does not slow down the rest of the batch.
+import torch
+
+from src import backbone
+from src.batch_autotune import is_out_of_memory, free_memory
+
+OOM_RECOVERY_RUNGS = ['free_caches', 'half_batch', 'tiled', 'net_size', 'boost_off', 'cpu']
+MIN_NET_SIZE = 64
+
+
+class OomRecoveryLadder:
+    def __init__(self, model_holder, rungs, load_models):
+        """rungs is a subset of OOM_RECOVERY_RUNGS, they are tried in the order of OOM_RECOVERY_RUNGS.
+        load_models(device, boost) loads the models of the generation, None stands for the original value. It is used
+        to move the models to the CPU, to disable BOOST and to restore the original models afterwards."""
+        self.model_holder = model_holder
+        self.rungs = [x for x in OOM_RECOVERY_RUNGS if x in rungs]
+        self.load_models = load_models
+        self.degraded = {}  # Original values of the settings that were changed by the rungs
+
+    def get_raw_prediction(self, image, net_width, net_height, temporal=False):
+        """ModelHolder.get_raw_prediction with recovery. Returns the prediction, whether it is inverted,
+        and the rung that succeeded (None if the image fitted without recovery)."""
+        self.restore()
+        rungs = list(self.rungs)
+        rung = None
+        while True:
+            try:
+                return (*self.model_holder.get_raw_prediction(image, net_width, net_height, temporal), rung)
+            except Exception as e:
+                if not is_out_of_memory(e) or len(rungs) == 0:
+                    raise
+                # The traceback references the frames of the failed attempt, and their tensors
+                error = e.with_traceback(None)
+            print(f'Out of memory: {str(error).splitlines()[0]}')
+            free_memory()
+            backbone.torch_gc()
+            applied = None
+            while applied is None and len(rungs) > 0:
+                rung = rungs.pop(0)
+                applied = self._apply(rung, net_width, net_height)
+            if applied is None:
+                raise error
+            net_width, net_height = applied
+            print(f'Retrying with the out of memory recovery rung "{rung}"')
+
+    def _apply(self, rung, net_width, net_height):
+        """Applies the rung, returns the (possibly changed) net size, or None if the rung is not applicable"""
+        holder = self.model_holder
+        if rung == 'free_caches':
+            return net_width, net_height  # Already done before every retry
+        if rung == 'half_batch':
+            # Ensemble members of Marigold are the only batched inference path
+            batch_size = holder.last_batch_size
+            if holder.depth_model_type != 10 or batch_size <= 1:
+                return None
+            self.degraded.setdefault('max_batch_size', holder.max_batch_size)
+            holder.update_settings(max_batch_size=batch_size // 2)
+            return net_width, net_height
+        if rung == 'tiled':
+            # The VAE of Marigold is the only model that can be evaluated in tiles without seams
+            model = holder.depth_model
+            if holder.depth_model_type != 10 or model.vae_tiling_threshold <= model.vae_tile_size:
+                return None
+            self.degraded.setdefault('vae_tiling_threshold', model.vae_tiling_threshold)
+            model.vae_tiling_threshold = model.vae_tile_size
+            return net_width, net_height
+        if rung == 'net_size':
+            # BOOST ignores the net size
+            if holder.pix2pix_model is not None or max(net_width, net_height) < 2 * MIN_NET_SIZE:
+                return None
+            return max(MIN_NET_SIZE, net_width // 64 * 32), max(MIN_NET_SIZE, net_height // 64 * 32)
+        if rung == 'boost_off':
+            if holder.pix2pix_model is None:
+                return None
+            self.degraded.setdefault('models', True)
+            self.load_models(holder.device, False)
+            return net_width, net_height
+        if rung == 'cpu':
+            if holder.device == torch.device('cpu'):
+                return None
+            self.degraded.setdefault('models', True)
+            self.load_models(torch.device('cpu'), holder.pix2pix_model is not None)
+            return net_width, net_height
+        raise ValueError(f'Unknown out of memory recovery rung {rung}')
+
+    def restore(self, reload_models=True):
+        """Undoes the degradations of the previous image. Without reload_models, only the settings are restored,
+        the models are left to the next ModelHolder.ensure_models."""
+        if len(self.degraded) == 0:
+            return
+        holder = self.model_holder
+        if 'models' in self.degraded and reload_models:
+            self.load_models(None, None)
+        if 'max_batch_size' in self.degraded:
+            holder.update_settings(max_batch_size=self.degraded['max_batch_size'])
+        if 'vae_tiling_threshold' in self.degraded and holder.depth_model_type == 10:
+            holder.depth_model.vae_tiling_threshold = self.degraded['vae_tiling_threshold']
+        self.degraded = {}
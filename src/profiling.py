@@ -0,0 +1,167 @@
+# Built-in instrumentation of the generation pipeline.
+# Every stage records wall time and memory high-water marks (CUDA allocator and, optionally, tracemalloc),
+# aggregated per stage, model type and resolution. The aggregate can be exported in Prometheus text format
+# (API) or as a JSON report (CLI).
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+RESOLUTION_BUCKETS = [512, 1024, 2048, 4096, 8192]
+
+
+def resolution_bucket(width, height):
+    """Bucket of the longer side of the input, keeps the number of distinct label values small"""
+    longer = max(width, height)
+    for bucket in RESOLUTION_BUCKETS:
+        if longer <= bucket:
+            return str(bucket)
+    return f'>{RESOLUTION_BUCKETS[-1]}'
+
+
+def _cuda():
+    """Returns torch.cuda if CUDA is in use. Does not import torch if nothing has imported it yet."""
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.peak_cuda_bytes = 0
+        self.peak_cpu_bytes = 0
+
+    def as_dict(self):
+        return {'count': self.count, 'total_s': self.total_s, 'mean_s': self.total_s / max(1, self.count),
+                'max_s': self.max_s, 'peak_cuda_bytes': self.peak_cuda_bytes, 'peak_cpu_bytes': self.peak_cpu_bytes}
+
+
+class Profiler:
+    """Thread-safe. Labels (model_type, resolution) are set per thread by the code that knows them,
+    stages that run on other threads (like output encoding) should be given the labels explicitly."""
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.stats = {}  # (stage, model_type, resolution) -> StageStats
+        self.counters = {}
+        self.local = threading.local()
+
+    def enable_cpu_memory_tracing(self):
+        """tracemalloc noticeably slows down the allocations, so it is off unless requested"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def set_labels(self, **labels):
+        self.local.labels = {k: str(v) for k, v in labels.items()}
+
+    def get_labels(self):
+        return dict(getattr(self.local, 'labels', {}))
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def stage(self, name, concurrent=False, **labels):
+        """Measures the enclosed block. Stages may be nested, the memory peak of the outer stage includes
+        the peaks of the inner ones. Stages that run concurrently with the others (like output encoding on the
+        writer threads) must set concurrent=True: the peak counters are global, so memory is not tracked for them,
+        and they do not wait for the GPU."""
+        if not self.enabled:
+            yield
+            return
+        track_memory = not concurrent
+        cuda = _cuda() if track_memory else None
+        tracing = track_memory and tracemalloc.is_tracing()
+        stack = self._stack()
+        frame = {'cuda': 0, 'cpu': 0}
+        if track_memory and len(stack) > 0:
+            # Resetting the counters would lose the peak of the enclosing stage, keep it
+            if cuda is not None:
+                stack[-1]['cuda'] = max(stack[-1]['cuda'], cuda.max_memory_allocated())
+            if tracing:
+                stack[-1]['cpu'] = max(stack[-1]['cpu'], tracemalloc.get_traced_memory()[1])
+        if cuda is not None:
+            cuda.reset_peak_memory_stats()
+        if tracing:
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cuda is not None:
+                cuda.synchronize()  # Otherwise the time of the asynchronous kernels goes to whoever waits for them
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if cuda is not None:
+                frame['cuda'] = max(frame['cuda'], cuda.max_memory_allocated())
+            if tracing:
+                frame['cpu'] = max(frame['cpu'], tracemalloc.get_traced_memory()[1])
+            all_labels = {**self.get_labels(), **{k: str(v) for k, v in labels.items()}}
+            key = (name, all_labels.get('model_type', ''), all_labels.get('resolution', ''))
+            with self.lock:
+                stats = self.stats.setdefault(key, StageStats())
+                stats.count += 1
+                stats.total_s += elapsed
+                stats.max_s = max(stats.max_s, elapsed)
+                stats.peak_cuda_bytes = max(stats.peak_cuda_bytes, frame['cuda'])
+                stats.peak_cpu_bytes = max(stats.peak_cpu_bytes, frame['cpu'])
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.counters = {}
+
+    def report(self):
+        with self.lock:
+            return {
+                'stages': [{'stage': k[0], 'model_type': k[1], 'resolution': k[2], **v.as_dict()}
+                           for k, v in sorted(self.stats.items())],
+                'counters': dict(self.counters),
+            }
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def to_prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        report = self.report()
+        metrics = [
+            ('depthmap_stage_seconds_total', 'counter', 'Total time spent in a stage', 'total_s'),
+            ('depthmap_stage_calls_total', 'counter', 'Number of times a stage was run', 'count'),
+            ('depthmap_stage_seconds_max', 'gauge', 'Longest single run of a stage', 'max_s'),
+            ('depthmap_stage_peak_cuda_memory_bytes', 'gauge', 'CUDA memory high-water mark of a stage',
+             'peak_cuda_bytes'),
+            ('depthmap_stage_peak_cpu_memory_bytes', 'gauge',
+             'Python heap high-water mark of a stage (only if tracemalloc is enabled)', 'peak_cpu_bytes'),
+        ]
+        lines = []
+        for metric, kind, help, field in metrics:
+            lines += [f'# HELP {metric} {help}', f'# TYPE {metric} {kind}']
+            for s in report['stages']:
+                labels = ','.join([f'{k}="{_escape(s[k])}"' for k in ['stage', 'model_type', 'resolution']])
+                lines += [f'{metric}{{{labels}}} {s[field]}']
+        for name, value in sorted(report['counters'].items()):
+            metric = f'depthmap_{name}_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+profiler = Profiler()
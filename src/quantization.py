@@ -0,0 +1,114 @@
+# int8 quantization of the depth models for CPU inference.
+# Transformer models (ViT/BEiT/DINOv2 based) get dynamic quantization of their Linear layers: the weights are stored
+# as int8, activations are quantized on the fly, no calibration is needed. Convolutional encoders (ResNeXt,
+# EfficientNet) get static quantization: activation ranges are calibrated on a few images.
+# The quantized weights are cached on disk, later loads only rebuild the structure and load the cached weights.
+import os
+import warnings
+
+import torch
+
+from src.misc import model_fingerprint
+
+QUANTIZATION_VERSION = 1
+DYNAMIC_MODEL_TYPES = [1, 2, 3, 4, 7, 8, 9, 11]
+STATIC_MODEL_TYPES = [0, 5, 6]
+QUANTIZABLE_MODEL_TYPES = DYNAMIC_MODEL_TYPES + STATIC_MODEL_TYPES
+CALIBRATION_IMAGES = 4
+
+
+def static_targets(model, model_type):
+    """Names of the submodules that are quantized statically, they take and return float tensors"""
+    if model_type == 0:
+        return ['depth_model.encoder_modules']
+    if model_type in [5, 6]:
+        return [f'pretrained.layer{i}' for i in range(1, 5)]
+    return []
+
+
+def quantize_dynamic_linear(model):
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _set_submodule(model, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name) if parent_name else model, child_name, module)
+
+
+def prepare_static(model, targets, example_inputs):
+    """Replaces the targets with their FX-traced versions that have observers inserted"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    for name in targets:
+        prepared = prepare_fx(model.get_submodule(name), qconfig_mapping, example_inputs[name])
+        _set_submodule(model, name, prepared)
+
+
+def convert_static(model, targets):
+    from torch.ao.quantization.quantize_fx import convert_fx
+    for name in targets:
+        _set_submodule(model, name, convert_fx(model.get_submodule(name)))
+
+
+def capture_inputs(model, targets, forward):
+    """Runs forward() and records the arguments every target was called with (first call only)"""
+    inputs = {}
+    hooks = [model.get_submodule(name).register_forward_pre_hook(
+        lambda module, args, name=name: inputs.setdefault(name, tuple(a.detach() for a in args)))
+        for name in targets]
+    try:
+        with torch.no_grad():
+            forward()
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return inputs
+
+
+def quantize_model(model, model_type, model_dir='./models/quantized', calibration_forward=None):
+    """Quantizes a float CPU model (in place, where possible) and returns it.
+    calibration_forward(n) should run the model on the first n calibration images one by one, it is only called if
+    the model needs calibration and there is no cached result. Returns None if the model can not be quantized."""
+    model.eval()
+    targets = static_targets(model, model_type)
+    os.makedirs(model_dir, exist_ok=True)
+    artifact_path = os.path.join(
+        model_dir, f'{model_type}-int8-{model_fingerprint(model, f"{QUANTIZATION_VERSION} {torch.__version__}")}.pt')
+
+    artifact = None
+    if os.path.exists(artifact_path):
+        try:
+            artifact = torch.load(artifact_path, map_location='cpu')
+            assert artifact['version'] == QUANTIZATION_VERSION, 'outdated version'
+        except Exception as e:
+            print(f"Could not load {artifact_path}, quantizing again. Exception: {str(e)}")
+            artifact = None
+    if artifact is not None:
+        if len(targets) > 0:
+            example_inputs = {name: tuple(torch.zeros(shape) for shape in shapes)
+                              for name, shapes in artifact['input_shapes'].items()}
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # The observers are not run, their results are in the state dict
+                prepare_static(model, targets, example_inputs)
+                convert_static(model, targets)
+        quantize_dynamic_linear(model)
+        model.load_state_dict(artifact['state_dict'], strict=True)
+        return model
+
+    input_shapes = {}
+    if len(targets) > 0:
+        if calibration_forward is None:
+            print('No images to calibrate the quantization with, the model is not quantized')
+            return None
+        example_inputs = capture_inputs(model, targets, lambda: calibration_forward(1))
+        input_shapes = {name: [list(a.shape) for a in args] for name, args in example_inputs.items()}
+        prepare_static(model, targets, example_inputs)
+        with torch.no_grad():
+            calibration_forward(CALIBRATION_IMAGES)
+        convert_static(model, targets)
+    quantize_dynamic_linear(model)
+    torch.save({'version': QUANTIZATION_VERSION, 'input_shapes': input_shapes, 'state_dict': model.state_dict()},
+               f"{artifact_path}.tmp")
+    os.replace(f"{artifact_path}.tmp", artifact_path)
+    return model
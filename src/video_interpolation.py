@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+
+INTERPOLATION_MODES = ['optical flow (quality)', 'optical flow (fast)', 'linear']
+
+
+def _gray(frame, max_side=None):
+    arr = np.asarray(frame)
+    if arr.ndim == 3:
+        arr = cv2.cvtColor(np.ascontiguousarray(arr[:, :, :3]), cv2.COLOR_RGB2GRAY)
+    if max_side is not None and max(arr.shape[:2]) > max_side:
+        scale = max_side / max(arr.shape[:2])
+        arr = cv2.resize(arr, (round(arr.shape[1] * scale), round(arr.shape[0] * scale)),
+                         interpolation=cv2.INTER_AREA)
+    return arr
+
+
+def select_keyframes(frames, interval=1, threshold=0.0, shots=None):
+    """Picks the frames that the depth model will be run on. Returns a sorted list of frame indices.
+    :param int interval: every interval-th frame is a keyframe
+    :param float threshold: additionally, a frame becomes a keyframe if its mean absolute difference from the
+      previous keyframe (in [0; 1] units) exceeds this value. 0 disables the adaptive selection.
+    :param shots: (start, end) pairs from video_postprocessing.detect_scene_cuts, both sides of every cut become
+      keyframes. None if cuts are not detected.
+    """
+    count = len(frames)
+    if interval <= 1 or count <= 2:
+        return list(range(count))
+    keyframes = set(range(0, count, interval))
+    keyframes.add(count - 1)
+    # Never interpolate across a scene cut: both sides of a cut are keyframes
+    for start, end in shots or []:
+        keyframes.update([start, end - 1])
+    if threshold > 0:
+        last_key = _gray(frames[0], 256).astype(np.float32)
+        for i in range(1, count):
+            cur = _gray(frames[i], 256).astype(np.float32)
+            if i not in keyframes and np.abs(cur - last_key).mean() / 255.0 > threshold:
+                keyframes.add(i)
+            if i in keyframes:
+                last_key = cur
+    return sorted(keyframes)
+
+
+class _FlowEstimator:
+    """Dense optical flow on CPU. Flow is computed on downscaled grayscale frames and scaled back up."""
+    def __init__(self, mode):
+        self.mode = mode
+        self.max_side = 1024 if mode == 'optical flow (quality)' else 512
+        if mode == 'optical flow (quality)':
+            self.dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+        else:
+            self.dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+
+    def __call__(self, frame_from, frame_to):
+        """Returns flow such that frame_from(p) ~ frame_to(p + flow(p)), in full-resolution pixels"""
+        full_h, full_w = np.asarray(frame_from).shape[:2]
+        a = _gray(frame_from, self.max_side)
+        b = _gray(frame_to, self.max_side)
+        flow = self.dis.calc(a, b, None)
+        if flow.shape[:2] != (full_h, full_w):
+            sx, sy = full_w / flow.shape[1], full_h / flow.shape[0]
+            flow = cv2.resize(flow, (full_w, full_h), interpolation=cv2.INTER_LINEAR)
+            flow[:, :, 0] *= sx
+            flow[:, :, 1] *= sy
+        return flow
+
+
+def _warp(depth, flow, grid):
+    """Samples depth at p + flow(p) for every pixel p"""
+    map_x = grid[0] + flow[:, :, 0]
+    map_y = grid[1] + flow[:, :, 1]
+    return cv2.remap(depth, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def interpolate_depths(frames, key_indices, key_depths, mode='optical flow (quality)'):
+    """Produces a depthmap for every frame from the depthmaps of the keyframes.
+    Intermediate depthmaps are the neighbouring keyframe depthmaps, warped to the intermediate frame using
+    optical flow, blended by temporal distance. Mode 'linear' skips the motion compensation.
+    :param frames: all the RGB frames of the video
+    :param list key_indices: sorted indices of the keyframes
+    :param list key_depths: depthmaps (NumPy arrays) of the keyframes, in the same order
+    """
+    depths = [None] * len(frames)
+    for i, d in zip(key_indices, key_depths):
+        depths[i] = d
+    flow_estimator = _FlowEstimator(mode) if mode != 'linear' else None
+    grid = None
+    for (a, depth_a), (b, depth_b) in zip(zip(key_indices, key_depths), zip(key_indices[1:], key_depths[1:])):
+        depth_a = depth_a.astype(np.float32)
+        depth_b = depth_b.astype(np.float32)
+        if flow_estimator is not None and grid is None:
+            h, w = depth_a.shape[:2]
+            grid = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        for t in range(a + 1, b):
+            weight_b = (t - a) / (b - a)
+            if flow_estimator is None:
+                depths[t] = (1 - weight_b) * depth_a + weight_b * depth_b
+                continue
+            from_a = _warp(depth_a, flow_estimator(frames[t], frames[a]), grid)
+            from_b = _warp(depth_b, flow_estimator(frames[t], frames[b]), grid)
+            depths[t] = (1 - weight_b) * from_a + weight_b * from_b
+    return depths
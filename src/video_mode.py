@@ -1,17 +1,22 @@
 import pathlib
 import traceback
 
+import cv2
 from PIL import Image
 import numpy as np
 import os
 
 from src import core
 from src import backbone
+from src import video_postprocessing
+from src import video_interpolation
+from src.depth_video_io import DepthVideoReader, DepthVideoWriter
 from src.common_constants import GenerationOptions as go
 
 
 def open_path_as_images(path, maybe_depthvideo=False):
-    """Takes the filepath, returns (fps, frames). Every frame is a Pillow Image object"""
+    """Takes the filepath, returns (fps, frames). Every frame is a Pillow Image object,
+    except for 16-bit depthvideos: these are returned as a lazy sequence of uint16 NumPy arrays"""
     suffix = pathlib.Path(path).suffix
     if suffix.lower() == '.gif':
         frames = []
@@ -36,25 +41,12 @@ def open_path_as_images(path, maybe_depthvideo=False):
         container.close()
         return fps, frames
     if suffix.lower() in ['.avi'] and maybe_depthvideo:
+        # If this is a 16-bit depthvideo, frames are decoded lazily (and as NumPy arrays) by the reader
         try:
-            import imageio_ffmpeg
-            # Suppose there are in fact 16 bits per pixel
-            # If this is not the case, this is not a 16-bit depthvideo, so no need to process it this way
-            gen = imageio_ffmpeg.read_frames(path, pix_fmt='gray16le', bits_per_pixel=16)
-            video_info = next(gen)
-            if video_info['pix_fmt'] == 'gray16le':
-                width, height = video_info['size']
-                frames = []
-                for frame in gen:
-                    # Not sure if this is implemented somewhere else
-                    result = np.frombuffer(frame, dtype='uint16')
-                    result.shape = (height, width)  # Why does it work? I don't remotely have any idea.
-                    frames += [Image.fromarray(result)]
-                    # TODO: Wrapping frames into Pillow objects is wasteful
-                return video_info['fps'], frames
-        finally:
-            if 'gen' in locals():
-                gen.close()
+            reader = DepthVideoReader(path)
+            return reader.fps, reader
+        except ValueError:
+            pass  # Not a 16-bit depthvideo, so no need to process it this way
     if suffix.lower() in ['.webm', '.mp4', '.avi']:
         from moviepy.video.io.VideoFileClip import VideoFileClip
         clip = VideoFileClip(path)
@@ -68,18 +60,26 @@ def open_path_as_images(path, maybe_depthvideo=False):
             raise Exception(f"Probably an unsupported file format: {suffix}") from e
 
 
+class ResizedFrames:
+    """Lazy view of a sequence of depthmap frames (NumPy arrays), resized to size (width, height)"""
+    def __init__(self, frames, size):
+        self.frames = frames
+        self.size = size
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return cv2.resize(np.asarray(self.frames[index]), self.size, interpolation=cv2.INTER_CUBIC)
+
+
 def frames_to_video(fps, frames, path, name, colorvids_bitrate=None):
-    if frames[0].mode == 'I;16':  # depthmap video
-        import imageio_ffmpeg
-        writer = imageio_ffmpeg.write_frames(
-            os.path.join(path, f"{name}.avi"), frames[0].size, 'gray16le', 'gray16le', fps, codec='ffv1',
-            macro_block_size=1)
-        try:
-            writer.send(None)
+    first = frames[0]
+    if (isinstance(first, np.ndarray) and first.ndim == 2) or \
+            (not isinstance(first, np.ndarray) and first.mode == 'I;16'):  # depthmap video
+        with DepthVideoWriter(os.path.join(path, f"{name}.avi"), fps) as writer:
             for frame in frames:
-                writer.send(np.array(frame))
-        finally:
-            writer.close()
+                writer.write(np.asarray(frame))
     else:
         arrs = [np.asarray(frame) for frame in frames]
         from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
@@ -100,7 +100,13 @@ def frames_to_video(fps, frames, path, name, colorvids_bitrate=None):
             raise Exception('Saving the video failed!')
 
 
-def process_predicitons(predictions, smoothening='none'):
+def process_predicitons(predictions, smoothening='none', frames=None, detect_cuts=True, shots=None):
+    """Normalizes the raw predictions of a video. Every shot (segment between two scene cuts) is normalized
+    separately, so a cut to a shot with a different depth range does not wash out the other shots.
+    :param frames: RGB frames used for detecting cuts. If not supplied, depth statistics are used instead.
+    :param bool detect_cuts: if False, the whole video is considered to be a single shot
+    :param shots: already detected shots (see video_postprocessing.detect_scene_cuts), used instead of detecting them
+    """
     def global_scaling(objs, a=None, b=None):
         """Normalizes objs, but uses (a, b) instead of (minimum, maximum) value of objs, if supplied"""
         normalized = []
@@ -111,24 +117,31 @@ def process_predicitons(predictions, smoothening='none'):
         return normalized
 
     print('Processing generated depthmaps')
-    # TODO: Detect cuts and process segments separately
-    if smoothening == 'none':
-        return global_scaling(predictions)
-    elif smoothening == 'experimental':
-        processed = []
-        clip = lambda val: min(max(0, val), len(predictions) - 1)
-        for i in range(len(predictions)):
-            f = np.zeros_like(predictions[i])
-            for u, mul in enumerate([0.10, 0.20, 0.40, 0.20, 0.10]):  # Eyeballed it, math person please fix this
-                f += mul * predictions[clip(i + (u - 2))]
-            processed += [f]
-        # This could have been deterministic monte carlo... Oh well, this version is faster.
-        a, b = np.percentile(np.stack(processed), [0.5, 99.5])
-        return global_scaling(predictions, a, b)
-    return predictions
-
-
-def gen_video(video, outpath, inp, custom_depthmap=None, colorvids_bitrate=None, smoothening='none'):
+    if smoothening not in ['none', 'experimental', 'experimental (causal)']:
+        return predictions
+    if detect_cuts:
+        if shots is None:
+            shots = video_postprocessing.detect_scene_cuts(frames if frames is not None else predictions)
+        if len(shots) > 1:
+            print(f'Detected {len(shots) - 1} scene cut(s), shots will be processed separately')
+    else:
+        shots = [(0, len(predictions))]
+
+    processed = []
+    for start, end in shots:
+        shot = predictions[start:end]
+        if smoothening == 'none':
+            processed += global_scaling(shot)
+        else:
+            # Smoothed frames are only used for picking the normalization range
+            a, b = video_postprocessing.smoothed_percentiles(
+                shot, [0.5, 99.5], centered=smoothening == 'experimental')
+            processed += global_scaling(shot, a, b)
+    return processed
+
+
+def gen_video(video, outpath, inp, custom_depthmap=None, colorvids_bitrate=None, smoothening='none',
+              detect_cuts=True, keyframe_interval=1, keyframe_threshold=0.0, interpolation='optical flow (quality)'):
     if inp[go.GEN_SIMPLE_MESH.name.lower()] or inp[go.GEN_INPAINTED_MESH.name.lower()]:
         return 'Creating mesh-videos is not supported. Please split video into frames and use batch processing.'
 
@@ -142,21 +155,41 @@ def gen_video(video, outpath, inp, custom_depthmap=None, colorvids_bitrate=None,
         first_pass_inp = {k: v for (k, v) in inp.items() if k in needed_keys}
         # We need predictions where frames are not normalized separately.
         first_pass_inp[go.DO_OUTPUT_DEPTH_PREDICTION] = True
+        # Frames are consecutive, so models that support it may reuse the results of the previous frame
+        first_pass_inp[go.VIDEO_TEMPORAL_WARM_START] = True
         # No need in normalized frames. Properly processed depth video will be created in the second pass
         first_pass_inp[go.DO_OUTPUT_DEPTH.name] = False
 
-        gen_obj = core.core_generation_funnel(None, input_images, None, None, first_pass_inp)
-        input_depths = [x[2] for x in list(gen_obj)]
-        input_depths = process_predicitons(input_depths, smoothening)
+        shots = video_postprocessing.detect_scene_cuts(input_images) if detect_cuts else None
+        # The depth model only runs on keyframes, depthmaps of other frames are interpolated
+        keyframes = video_interpolation.select_keyframes(input_images, int(keyframe_interval), keyframe_threshold,
+                                                         shots)
+        if len(keyframes) < len(input_images):
+            print(f'Depth model will be run on {len(keyframes)} out of {len(input_images)} frames')
+        # The warm start needs the prediction of the previous frame of the same shot
+        shot_starts = set([start for start, end in shots or []])
+        first_pass_inp[go.VIDEO_TEMPORAL_RESETS] = [
+            i for i, frame in enumerate(keyframes) if i > 0 and (frame != keyframes[i - 1] + 1 or frame in shot_starts)]
+        gen_obj = core.core_generation_funnel(None, [input_images[i] for i in keyframes], None, None, first_pass_inp)
+        input_depths = [x[2] for x in list(gen_obj) if x[1] == 'depth_prediction']
+        if len(keyframes) < len(input_images):
+            print('Interpolating depthmaps between keyframes')
+            input_depths = video_interpolation.interpolate_depths(input_images, keyframes, input_depths, interpolation)
+        input_depths = process_predicitons(input_depths, smoothening, input_images, detect_cuts, shots)
     else:
         print('Using custom depthmap video')
         cdm_fps, input_depths = open_path_as_images(os.path.abspath(custom_depthmap.name), maybe_depthvideo=True)
         assert len(input_depths) == len(input_images), 'Custom depthmap video length does not match input video length'
-        if input_depths[0].size != input_images[0].size:
+        depths_size = input_depths.size if isinstance(input_depths, DepthVideoReader) else input_depths[0].size
+        if depths_size != input_images[0].size:
             print('Warning! Input video size and depthmap video size are not the same!')
+            if isinstance(input_depths, DepthVideoReader):
+                # Pillow frames are resized by the funnel, array frames have to match the input size
+                input_depths = ResizedFrames(input_depths, input_images[0].size)
 
     print('Generating output frames')
-    img_results = list(core.core_generation_funnel(None, input_images, input_depths, None, inp))
+    img_results = [x for x in core.core_generation_funnel(None, input_images, input_depths, None, inp)
+                   if x[1] != 'metadata']
     gens = list(set(map(lambda x: x[1], img_results)))
 
     print('Saving generated frames as video outputs')
@@ -0,0 +1,140 @@
+import numpy as np
+
+
+def _frame_histogram(frame, bins=32):
+    """Normalized histogram of a subsampled grayscale version of the frame, used for shot boundary detection.
+    Works with Pillow Images (RGB frames) and with NumPy arrays (depth frames)."""
+    arr = np.asarray(frame, dtype=np.float32)
+    is_rgb = arr.ndim == 3
+    if is_rgb:
+        arr = arr[:, :, :3].mean(axis=2)
+    # Subsampling is enough here - we only look at the global distribution of values
+    step = max(1, min(arr.shape[:2]) // 64)
+    arr = arr[::step, ::step]
+    if is_rgb:
+        lo, hi = 0.0, 255.0
+    else:
+        # Depth statistics: frames are compared by the shape of their distribution, not by the absolute values
+        lo, hi = float(arr.min()), float(arr.max())
+        if hi - lo <= np.finfo("float32").eps:
+            hi = lo + 1.0
+    hist, _ = np.histogram(arr, bins=bins, range=(lo, hi))
+    return hist.astype(np.float64) / max(1, hist.sum())
+
+
+def detect_scene_cuts(frames, threshold=0.5, min_shot_length=8):
+    """Detects shot boundaries. Returns a list of (start, end) index pairs, one per shot, end is exclusive.
+    :param frames: RGB frames (Pillow Images) or depth frames (NumPy arrays)
+    :param float threshold: L1 distance between histograms of adjacent frames (in [0; 2]) that is considered a cut
+    :param int min_shot_length: cuts that would produce a shot shorter than this are ignored
+    """
+    count = len(frames)
+    if count == 0:
+        return []
+    cuts = [0]
+    prev_hist = _frame_histogram(frames[0])
+    for i in range(1, count):
+        hist = _frame_histogram(frames[i])
+        if np.abs(hist - prev_hist).sum() > threshold and i - cuts[-1] >= min_shot_length:
+            cuts.append(i)
+        prev_hist = hist
+    # The last shot must not be too short either
+    if len(cuts) > 1 and count - cuts[-1] < min_shot_length:
+        cuts.pop()
+    return [(start, end) for start, end in zip(cuts, cuts[1:] + [count])]
+
+
+class SlidingWindowFilter:
+    """Weighted moving average over a ring buffer of frames.
+    Frames are pushed one by one, smoothed frames are returned as soon as they can be computed.
+    Memory usage is O(window) frames. Edges are handled by repeating the first/last frame."""
+    def __init__(self, weights, centered=True):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.weights /= self.weights.sum()
+        self.window = len(self.weights)
+        # Number of frames the output lags behind the input
+        self.delay = self.window // 2 if centered else 0
+        self.buffer = None
+        self.head = 0  # Index of the oldest frame in the buffer
+        self.newest = -1  # Position (in the input sequence) of the newest frame in the buffer
+
+    def _insert(self, frame):
+        if self.buffer is None:
+            # Repeating the first frame is the same as clamping the index at the start of the sequence
+            self.buffer = np.repeat(np.asarray(frame, dtype=np.float32)[None], self.window, axis=0)
+            self.head = 0
+        else:
+            self.buffer[self.head] = frame
+            self.head = (self.head + 1) % self.window
+        self.newest += 1
+
+    def _current(self):
+        if self.newest < self.delay:
+            return None
+        # Rolling the weights is much cheaper than rolling the frames
+        return np.tensordot(np.roll(self.weights, self.head), self.buffer, axes=1)
+
+    def push(self, frame):
+        """Adds a frame. Returns the next smoothed frame or None if more frames are needed"""
+        self._insert(frame)
+        return self._current()
+
+    def flush(self):
+        """Yields the smoothed frames that are still pending and resets the filter"""
+        if self.buffer is not None:
+            last = self.buffer[(self.head - 1) % self.window].copy()
+            for _ in range(self.delay):
+                self._insert(last)
+                smoothed = self._current()
+                if smoothed is not None:
+                    yield smoothed
+        self.buffer = None
+        self.head = 0
+        self.newest = -1
+
+
+class StreamingHistogram:
+    """Approximate percentiles over a stream of arrays in O(bins) memory.
+    The value range must be known in advance; values outside of it are clamped into the edge bins."""
+    def __init__(self, lo, hi, bins=4096):
+        self.lo = float(lo)
+        self.hi = float(hi) if hi > lo else float(lo) + 1.0
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, arr):
+        hist, _ = np.histogram(np.clip(arr, self.lo, self.hi), bins=len(self.counts), range=(self.lo, self.hi))
+        self.counts += hist
+
+    def percentile(self, q):
+        """Like np.percentile, interpolates linearly inside a bin"""
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        cdf = np.cumsum(self.counts)
+        total = cdf[-1]
+        if total == 0:
+            return np.full(q.shape, self.lo)
+        targets = q / 100.0 * total
+        idx = np.clip(np.searchsorted(cdf, targets, side='left'), 0, len(cdf) - 1)
+        below = np.where(idx > 0, cdf[idx - 1], 0)
+        inside = np.maximum(self.counts[idx], 1)
+        frac = np.clip((targets - below) / inside, 0.0, 1.0)
+        bin_width = (self.hi - self.lo) / len(self.counts)
+        return self.lo + (idx + frac) * bin_width
+
+
+SMOOTHENING_WEIGHTS = [0.10, 0.20, 0.40, 0.20, 0.10]  # Eyeballed it, math person please fix this
+
+
+def smoothed_percentiles(predictions, q, weights=SMOOTHENING_WEIGHTS, centered=True, bins=4096):
+    """Percentiles of the temporally smoothed sequence, without ever materializing the smoothed sequence.
+    Smoothing is a convex combination of frames, so the raw min/max bound the smoothed values."""
+    lo = min([p.min() for p in predictions])
+    hi = max([p.max() for p in predictions])
+    hist = StreamingHistogram(lo, hi, bins)
+    smoother = SlidingWindowFilter(weights, centered)
+    for p in predictions:
+        smoothed = smoother.push(p)
+        if smoothed is not None:
+            hist.update(smoothed)
+    for smoothed in smoother.flush():
+        hist.update(smoothed)
+    return hist.percentile(q)